@@ -1,10 +1,76 @@
 import os
-from flask import Flask
+from flask import Flask, request
+from sqlalchemy import event
 
 from .config import Config
 from .extensions import db, socketio, login_manager
-from .models import User
+from .models import User, PrivateMessage, Conversation
 from .routes import register_blueprints
+from .cli import register_commands
+from .history import recent_messages
+from .write_behind import message_writer
+from .blocks import block_index
+from .conversations import rebuild_conversations
+from .bus import init_bus
+from .presence import presence
+from .rate_limit import rate_limiter
+from .identity import identity_cache
+from .passwords import password_hasher
+from .search import ensure_search_index
+from .counters import ensure_counters
+from .jobs import jobs
+from .retention import retention
+
+
+def _create_missing_indexes() -> None:
+    """Add indexes declared after a table was created (create_all skips them)."""
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+
+def _green_engine_options(app) -> dict:
+    """
+    Pool settings for green-thread mode. Thousands of greenlets may want a
+    connection at once: cap the pool and make them wait on it (green-aware
+    once patched). sqlite3 calls block the whole hub, so a greenlet waiting
+    for SQLite's write lock would stall the one holding it: with SQLite
+    there is a single connection and transactions never overlap.
+    """
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite'):
+        if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI']:
+            return {}
+        return {'pool_size': 1, 'max_overflow': 0, 'pool_timeout': 30}
+    return {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': app.config['DB_POOL_SIZE'],
+        'pool_timeout': 30,
+        'pool_pre_ping': True,
+    }
+
+
+def _engine_options(app) -> dict:
+    """Pool settings for the configured async mode (none for in-memory SQLite)."""
+    if ':memory:' in app.config['SQLALCHEMY_DATABASE_URI']:
+        return {}
+    if app.config['SOCKETIO_ASYNC_MODE'] != 'threading':
+        return _green_engine_options(app)
+    # One OS thread per socket client: leave room for bursts of handlers
+    return {
+        'pool_size': app.config['DB_POOL_SIZE'],
+        'max_overflow': 2 * app.config['DB_POOL_SIZE'],
+        'pool_timeout': 10,
+    }
+
+
+def _apply_sqlite_profile(engine, pragmas: dict) -> None:
+    """Run ``PRAGMA name=value`` for every pragma on each new connection."""
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
 
 
 def create_app(config_class=Config) -> Flask:
@@ -19,14 +85,40 @@ def create_app(config_class=Config) -> Flask:
     # Ensure upload folder exists
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
 
+    # Import socket handlers before init_app so they are recorded on the
+    # SocketIO object and re-attached to every server it creates
+    from . import sockets  # noqa: F401
+
     # Initialize extensions
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        **_engine_options(app), **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+    }
     db.init_app(app)
-    socketio.init_app(app)
+    if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite') and app.config['SQLITE_PROFILE']:
+        with app.app_context():
+            _apply_sqlite_profile(db.engine, app.config['SQLITE_PRAGMAS'])
+    # Passed explicitly every time: init_app keeps options between calls
+    client_manager = init_bus(app)
+    socketio.init_app(
+        app,
+        client_manager=client_manager,
+        async_mode=app.config['SOCKETIO_ASYNC_MODE'],
+        transports=['websocket'] if app.config['SOCKETIO_WEBSOCKET_ONLY'] else None
+    )
+    presence.init_app(app, host_id=client_manager.host_id if client_manager else None)
+    sockets.presence_deltas.init_app(app)
+    sockets.typing_users.init_app(app, source=client_manager.host_id if client_manager else None)
+    rate_limiter.init_app(app)
+    identity_cache.init_app(app)
+    password_hasher.init_app(app)
+    jobs.init_app(app)
     login_manager.init_app(app)
 
-    # User loader for Flask-Login
+    # User loader for Flask-Login: socket events get a cached snapshot
     @login_manager.user_loader
     def load_user(user_id):
+        if getattr(request, 'sid', None) is not None:
+            return identity_cache.get(int(user_id))
         return db.session.get(User, int(user_id))
 
     # ── Security headers ──────────────────────────────────────────────────────
@@ -49,14 +141,23 @@ def create_app(config_class=Config) -> Flask:
         )
         return response
 
-    # Register blueprints
+    # Register blueprints and CLI commands
     register_blueprints(app)
+    register_commands(app)
 
-    # Import socket handlers to register them
-    from . import sockets  # noqa: F401
-
-    # Create database tables
+    # Create database tables and warm the in-memory chat history/block index
     with app.app_context():
         db.create_all()
+        _create_missing_indexes()
+        ensure_search_index(app)
+        ensure_counters(app)
+        recent_messages.warm(app.config['CHAT_HISTORY_BUFFER_SIZE'])
+        block_index.load()
+        # Backfill conversation summaries for databases created before them
+        if Conversation.query.first() is None and PrivateMessage.query.first() is not None:
+            rebuild_conversations()
+
+    message_writer.init_app(app)
+    retention.init_app(app)
 
     return app
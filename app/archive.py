@@ -0,0 +1,240 @@
+"""
+Compressed archive of old main chat messages.
+
+Messages moved out of the ``message`` table by the retention policy
+(:mod:`app.retention`) are stored in a separate SQLite file,
+``MESSAGE_ARCHIVE_PATH``. Each archived batch becomes one segment, holding
+the zlib-compressed NDJSON of the message bodies. The ``archived_message``
+table keeps the uncompressed columns the admin filters on (id, author,
+timestamp, drawing reference), so the archive can be browsed by user and
+date range and only the segments of the page shown are decompressed.
+
+The file also keeps a few ``archive_meta`` values shared by all workers:
+when retention last ran and the last compaction report.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from flask import current_app
+
+from .pagination import KeysetPage
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS archive_segment ('
+    ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+    ' archived_at REAL NOT NULL,'
+    ' message_count INTEGER NOT NULL,'
+    ' raw_bytes INTEGER NOT NULL,'
+    ' data BLOB NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS archived_message ('
+    ' id INTEGER PRIMARY KEY,'
+    ' segment_id INTEGER NOT NULL,'
+    ' user_id INTEGER,'
+    ' username TEXT NOT NULL,'
+    ' timestamp TEXT NOT NULL,'
+    ' image_data TEXT)',
+    'CREATE INDEX IF NOT EXISTS ix_archived_message_timestamp ON archived_message (timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS ix_archived_message_username ON archived_message (username, timestamp, id)',
+    'CREATE INDEX IF NOT EXISTS ix_archived_message_segment ON archived_message (segment_id)',
+    'CREATE TABLE IF NOT EXISTS archive_meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+)
+
+# Columns of the index table; the rest of the message goes in the segment
+_INDEXED = ('id', 'user_id', 'username', 'timestamp', 'image_data')
+
+
+def _timestamp(value: datetime) -> str:
+    """Fixed-width UTC text, so timestamps compare correctly as strings."""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=' ', timespec='microseconds')
+
+
+class MessageArchive:
+    def __init__(self):
+        self._local = threading.local()
+
+    def _connection(self) -> sqlite3.Connection:
+        path = current_app.config['MESSAGE_ARCHIVE_PATH']
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(path)
+        if conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            conn = sqlite3.connect(path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            for statement in _SCHEMA:
+                conn.execute(statement)
+            connections[path] = conn
+        return conn
+
+    def store(self, messages: list[dict]) -> int:
+        """Archive ``messages`` (column dicts) as one segment. Returns its id."""
+        bodies = '\n'.join(
+            json.dumps({k: v for k, v in m.items() if k not in _INDEXED} | {'id': m['id']},
+                       ensure_ascii=False)
+            for m in messages
+        ).encode()
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            segment_id = conn.execute(
+                'INSERT INTO archive_segment (archived_at, message_count, raw_bytes, data) VALUES (?, ?, ?, ?)',
+                (time.time(), len(messages), len(bodies), zlib.compress(bodies, 9))
+            ).lastrowid
+            # OR REPLACE: a batch archived before a crash, but never deleted
+            # from the message table, is archived again on the next run
+            conn.executemany(
+                'INSERT OR REPLACE INTO archived_message (id, segment_id, user_id, username, timestamp, image_data)'
+                ' VALUES (?, ?, ?, ?, ?, ?)',
+                [(m['id'], segment_id, m['user_id'], m['username'], _timestamp(m['timestamp']), m['image_data'])
+                 for m in messages]
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return segment_id
+
+    def page(self, username: str | None = None, since: datetime | None = None, until: datetime | None = None,
+             before: int | None = None, after: int | None = None, per_page: int = 50) -> KeysetPage:
+        """One page of archived messages, newest first, like :func:`keyset_page`."""
+        conn = self._connection()
+        where, params = [], []
+        if username:
+            where.append('username = ?')
+            params.append(username)
+        if since is not None:
+            where.append('timestamp >= ?')
+            params.append(_timestamp(since))
+        if until is not None:
+            where.append('timestamp < ?')
+            params.append(_timestamp(until))
+
+        cursor = after if after is not None else before
+        if cursor is not None:
+            anchor = conn.execute('SELECT timestamp, id FROM archived_message WHERE id = ?', (cursor,)).fetchone()
+            if anchor is not None:
+                where.append('(timestamp, id) > (?, ?)' if after is not None else '(timestamp, id) < (?, ?)')
+                params.extend(anchor)
+
+        order = 'ASC' if after is not None else 'DESC'
+        rows = conn.execute(
+            'SELECT id, segment_id, user_id, username, timestamp, image_data FROM archived_message'
+            + (' WHERE ' + ' AND '.join(where) if where else '')
+            + f' ORDER BY timestamp {order}, id {order} LIMIT ?',
+            (*params, per_page + 1)
+        ).fetchall()
+
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if after is not None:
+            if not more:
+                # Back at the newest rows: show a full first page
+                return self.page(username, since, until, per_page=per_page)
+            rows.reverse()
+        items = self._load(conn, rows)
+        if after is not None:
+            return KeysetPage(items, has_prev=True, has_next=True)
+        return KeysetPage(items, has_prev=before is not None, has_next=more)
+
+    def _load(self, conn, rows) -> list[SimpleNamespace]:
+        bodies = {}
+        for segment_id in {row[1] for row in rows}:
+            data = conn.execute('SELECT data FROM archive_segment WHERE id = ?', (segment_id,)).fetchone()[0]
+            for line in zlib.decompress(data).decode().splitlines():
+                body = json.loads(line)
+                bodies[body['id']] = body
+        return [
+            SimpleNamespace(
+                id=id_, user_id=user_id, username=username, image_data=image_data,
+                timestamp=datetime.fromisoformat(timestamp),
+                content=bodies.get(id_, {}).get('content', ''),
+                profile_pic=bodies.get(id_, {}).get('profile_pic') or 'default.jpg',
+            )
+            for id_, _, user_id, username, timestamp, image_data in rows
+        ]
+
+    def messages(self):
+        """Every archived message as a column dict, one segment at a time."""
+        if not os.path.exists(current_app.config['MESSAGE_ARCHIVE_PATH']):
+            return
+        conn = self._connection()
+        segment_id = 0
+        while True:
+            # One segment per query: no read transaction left open between them
+            row = conn.execute('SELECT id, data FROM archive_segment WHERE id > ? ORDER BY id LIMIT 1',
+                               (segment_id,)).fetchone()
+            if row is None:
+                return
+            segment_id, data = row
+            bodies = {}
+            for line in zlib.decompress(data).decode().splitlines():
+                body = json.loads(line)
+                bodies[body['id']] = body
+            # Ids archived again later belong to their newest segment
+            for id_, user_id, username, timestamp, image_data in conn.execute(
+                'SELECT id, user_id, username, timestamp, image_data FROM archived_message'
+                ' WHERE segment_id = ? ORDER BY id', (segment_id,)
+            ).fetchall():
+                yield bodies[id_] | {'id': id_, 'user_id': user_id, 'username': username,
+                                     'timestamp': datetime.fromisoformat(timestamp), 'image_data': image_data}
+
+    def referenced_drawings(self) -> set[str]:
+        """Drawing URLs of archived messages (their blobs must be kept)."""
+        if not os.path.exists(current_app.config['MESSAGE_ARCHIVE_PATH']):
+            return set()
+        return {url for url, in self._connection().execute(
+            'SELECT image_data FROM archived_message WHERE image_data IS NOT NULL'
+        )}
+
+    def claim(self, name: str, interval: float) -> bool:
+        """
+        True if ``name`` last ran more than ``interval`` seconds ago, recording
+        a run now. Only one worker gets True per interval.
+        """
+        conn = self._connection()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT value FROM archive_meta WHERE key = ?', (f'last_run:{name}',)).fetchone()
+            claimed = row is None or now - float(row[0]) >= interval
+            if claimed:
+                conn.execute('INSERT OR REPLACE INTO archive_meta (key, value) VALUES (?, ?)',
+                             (f'last_run:{name}', str(now)))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return claimed
+
+    def set_meta(self, key: str, value) -> None:
+        self._connection().execute('INSERT OR REPLACE INTO archive_meta (key, value) VALUES (?, ?)',
+                                   (key, json.dumps(value)))
+
+    def get_meta(self, key: str, default=None):
+        row = self._connection().execute('SELECT value FROM archive_meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def stats(self) -> dict:
+        conn = self._connection()
+        segments, raw_bytes, stored_bytes = conn.execute(
+            'SELECT count(*), coalesce(sum(raw_bytes), 0), coalesce(sum(length(data)), 0) FROM archive_segment'
+        ).fetchone()
+        return {
+            'messages': conn.execute('SELECT count(*) FROM archived_message').fetchone()[0],
+            'segments': segments,
+            'raw_bytes': raw_bytes,
+            'compressed_bytes': stored_bytes,
+        }
+
+
+message_archive = MessageArchive()
@@ -0,0 +1,118 @@
+"""
+In-memory index of ``BlockedUser`` rows.
+
+Keeps both directions, blocker → blocked and blocked → blockers, so that a
+broadcast only has to look at the users who blocked the sender. It is loaded
+from the database at startup and kept current by session hooks that apply
+``BlockedUser`` inserts/deletes once their transaction commits; other worker
+processes receive the same changes through the Socket.IO bus.
+"""
+from threading import Lock
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from .models import BlockedUser
+from .bus import subscribe, publish
+
+
+class BlockIndex:
+    def __init__(self):
+        self._blocking: dict[int, set[int]] = {}
+        self._blocked_by: dict[int, set[int]] = {}
+        self._lock = Lock()
+
+    def load(self) -> None:
+        """Rebuild the index from the database."""
+        blocking: dict[int, set[int]] = {}
+        blocked_by: dict[int, set[int]] = {}
+        for blocker_id, blocked_id in BlockedUser.query.with_entities(
+            BlockedUser.blocker_id, BlockedUser.blocked_id
+        ):
+            blocking.setdefault(blocker_id, set()).add(blocked_id)
+            blocked_by.setdefault(blocked_id, set()).add(blocker_id)
+        with self._lock:
+            self._blocking = blocking
+            self._blocked_by = blocked_by
+
+    def add(self, blocker_id: int, blocked_id: int) -> None:
+        with self._lock:
+            self._blocking.setdefault(blocker_id, set()).add(blocked_id)
+            self._blocked_by.setdefault(blocked_id, set()).add(blocker_id)
+
+    def remove(self, blocker_id: int, blocked_id: int) -> None:
+        with self._lock:
+            self._discard(self._blocking, blocker_id, blocked_id)
+            self._discard(self._blocked_by, blocked_id, blocker_id)
+
+    def forget_user(self, user_id: int) -> None:
+        """Drop every edge touching a deleted user."""
+        with self._lock:
+            for blocked_id in self._blocking.pop(user_id, set()):
+                self._discard(self._blocked_by, blocked_id, user_id)
+            for blocker_id in self._blocked_by.pop(user_id, set()):
+                self._discard(self._blocking, blocker_id, user_id)
+
+    def blocked_ids(self, user_id: int) -> frozenset[int]:
+        """Users hidden from ``user_id``."""
+        with self._lock:
+            return frozenset(self._blocking.get(user_id, ()))
+
+    def blockers_of(self, user_id: int) -> frozenset[int]:
+        """Users who blocked ``user_id`` (and must not receive its messages)."""
+        with self._lock:
+            return frozenset(self._blocked_by.get(user_id, ()))
+
+    def is_blocked(self, user_id: int, by_user_id: int) -> bool:
+        with self._lock:
+            return user_id in self._blocking.get(by_user_id, ())
+
+    @staticmethod
+    def _discard(index: dict[int, set[int]], key: int, value: int) -> None:
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+
+block_index = BlockIndex()
+
+
+# ── Session hooks ────────────────────────────────────────────────────────────
+# Edges are staged on flush and only applied to the index after commit, so a
+# rolled back block never becomes visible.
+
+@event.listens_for(Session, 'after_flush')
+def _stage_block_changes(session, flush_context):
+    staged = session.info.setdefault('block_index_changes', [])
+    for obj in session.new:
+        if isinstance(obj, BlockedUser):
+            staged.append((True, obj.blocker_id, obj.blocked_id))
+    for obj in session.deleted:
+        if isinstance(obj, BlockedUser):
+            staged.append((False, obj.blocker_id, obj.blocked_id))
+
+
+def _apply(changes):
+    for added, blocker_id, blocked_id in changes:
+        if added:
+            block_index.add(blocker_id, blocked_id)
+        else:
+            block_index.remove(blocker_id, blocked_id)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_block_changes(session):
+    changes = session.info.pop('block_index_changes', [])
+    if changes:
+        _apply(changes)
+        publish('block_changes', changes)
+
+
+subscribe('block_changes', _apply)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_block_changes(session):
+    session.info.pop('block_index_changes', None)
@@ -0,0 +1,125 @@
+"""
+Cross-process fan-out for Socket.IO over a shared SQLite file.
+
+Flask-SocketIO only ships client managers for external brokers (Redis,
+Kafka, ZeroMQ, AMQP). :class:`SQLiteManager` implements the same
+``PubSubManager`` contract on a local SQLite file in WAL mode, so several
+worker processes on one machine share rooms and broadcasts without any
+extra service: ``_publish`` appends a row and every worker's listener polls
+for rows newer than the last one it has seen.
+
+Workers also keep process-local caches (chat history buffer, block index).
+Handlers registered with :func:`subscribe` are called with the data of every
+event coming from *another* worker: Socket.IO emits by event name, and
+plain notifications sent with :func:`publish`.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import socketio
+
+_handlers: dict[str, list] = {}
+_manager = None
+
+
+def subscribe(name: str, handler) -> None:
+    """Call ``handler(data)`` for ``name`` events published by other workers."""
+    _handlers.setdefault(name, []).append(handler)
+
+
+def publish(name: str, data=None) -> None:
+    """Notify the other workers. A no-op when running a single process."""
+    if _manager is not None:
+        _manager._publish({'method': 'sync', 'name': name, 'data': data, 'host_id': _manager.host_id})
+
+
+def _dispatch(name: str, data) -> None:
+    for handler in _handlers.get(name, ()):
+        try:
+            handler(data)
+        except Exception as e:
+            print(f"[ERRORE BUS] {name}: {str(e)}")
+
+
+class SQLiteManager(socketio.PubSubManager):
+    name = 'sqlite'
+
+    def __init__(self, path: str, channel: str = 'flask-socketio', poll_interval: float = 0.01,
+                 retention: float = 60.0, write_only: bool = False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._local = threading.local()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # AUTOINCREMENT: ids are never reused after pruning, so "id > last seen" is safe
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS bus_message ('
+            ' id INTEGER PRIMARY KEY AUTOINCREMENT,'
+            ' channel TEXT NOT NULL,'
+            ' created REAL NOT NULL,'
+            ' payload TEXT NOT NULL)'
+        )
+        # Start from "now": anything older was meant for earlier processes
+        self._last_id = self._connection().execute(
+            'SELECT COALESCE(MAX(id), 0) FROM bus_message'
+        ).fetchone()[0]
+
+    def _connection(self) -> sqlite3.Connection:
+        """One autocommit connection per thread."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _publish(self, data):
+        self._connection().execute(
+            'INSERT INTO bus_message (channel, created, payload) VALUES (?, ?, ?)',
+            (self.channel, time.time(), json.dumps(data))
+        )
+
+    def _listen(self):
+        conn = self._connection()
+        last_id = self._last_id
+        next_prune = time.monotonic() + self.retention
+        sleep = self.server.sleep if self.server is not None else time.sleep
+
+        while True:
+            rows = conn.execute(
+                'SELECT id, payload FROM bus_message WHERE id > ? AND channel = ? ORDER BY id',
+                (last_id, self.channel)
+            ).fetchall()
+            for last_id, payload in rows:
+                message = json.loads(payload)
+                if message.get('host_id') != self.host_id:
+                    if message.get('method') == 'sync':
+                        _dispatch(message['name'], message.get('data'))
+                        continue
+                    if message.get('method') == 'emit' and not message.get('binary'):
+                        data = message['data']
+                        _dispatch(message['event'], data[0] if len(data) == 1 else data)
+                yield message
+
+            if time.monotonic() >= next_prune:
+                conn.execute('DELETE FROM bus_message WHERE created < ?', (time.time() - self.retention,))
+                next_prune = time.monotonic() + self.retention
+            if not rows:
+                sleep(self.poll_interval)
+
+
+def init_bus(app) -> SQLiteManager | None:
+    """
+    Client manager for ``socketio.init_app``: the shared SQLite bus when
+    ``SOCKETIO_BUS_PATH`` is set, otherwise None (in-process rooms only).
+    """
+    global _manager
+    path = app.config.get('SOCKETIO_BUS_PATH')
+    _manager = SQLiteManager(path, poll_interval=app.config['SOCKETIO_BUS_POLL_INTERVAL']) if path else None
+    return _manager
@@ -0,0 +1,136 @@
+import gzip
+
+import click
+from flask import Flask, current_app
+
+from .extensions import db
+from .models import Message
+from .drawings import (
+    store_drawing, is_legacy_data_url, sweep_orphan_drawings, InvalidDrawing, DRAWING_URL_PREFIX
+)
+from .conversations import rebuild_conversations
+from .archive import message_archive
+from .retention import retention, last_compaction, incremental_compaction
+from .export import export_records, ndjson_chunks, import_history, KINDS
+
+
+@click.command('migrate-drawings')
+@click.option('--batch-size', default=200, show_default=True, help='Rows per commit.')
+@click.option('--orphan-min-age', default=3600, show_default=True,
+              help='Seconds before an unreferenced blob is deleted.')
+def migrate_drawings_command(batch_size, orphan_min_age):
+    """Move inline base64 drawings into the blob store and delete orphan blobs."""
+    migrated = skipped = 0
+    last_id = 0
+    while True:
+        rows = Message.query.filter(
+            Message.id > last_id,
+            Message.image_data.like('data:%')
+        ).order_by(Message.id.asc()).limit(batch_size).all()
+        if not rows:
+            break
+
+        for msg in rows:
+            last_id = msg.id
+            if not is_legacy_data_url(msg.image_data):
+                continue
+            try:
+                msg.image_data = store_drawing(msg.image_data)
+                migrated += 1
+            except InvalidDrawing:
+                skipped += 1
+        db.session.commit()
+
+    click.echo(f'Drawings migrated: {migrated}, skipped (invalid): {skipped}')
+
+    # Blobs written for messages that were never saved
+    referenced = {
+        url[len(DRAWING_URL_PREFIX):]
+        for url, in Message.query.with_entities(Message.image_data).filter(
+            Message.image_data.like(f'{DRAWING_URL_PREFIX}%')
+        )
+    }
+    # Archived drawing messages still point to their blobs
+    referenced |= {
+        url[len(DRAWING_URL_PREFIX):]
+        for url in message_archive.referenced_drawings() if url.startswith(DRAWING_URL_PREFIX)
+    }
+    removed = sweep_orphan_drawings(referenced, orphan_min_age)
+    click.echo(f'Orphan drawings removed: {removed}')
+
+
+@click.command('rebuild-conversations')
+def rebuild_conversations_command():
+    """Recompute the inbox conversation summaries from private messages."""
+    written = rebuild_conversations()
+    click.echo(f'Conversation summaries written: {written}')
+
+
+@click.command('archive-messages')
+@click.option('--days', type=int, default=None, help='Archive messages older than this (default: RETENTION_DAYS).')
+@click.option('--keep', type=int, default=None,
+              help='Keep only the newest N messages (default: RETENTION_MAX_MESSAGES).')
+@click.option('--compact', is_flag=True,
+              help='Compact the database even below COMPACTION_MIN_FREE_RATIO; the first time, '
+                   'with a full VACUUM that blocks writers (run it while the server is stopped).')
+def archive_messages_command(days, keep, compact):
+    """Move old chat messages to the archive, then compact the database."""
+    job = retention.run(days, keep, force_compaction=compact, convert=compact, inline=True)
+    if job.state == 'failed':
+        raise click.ClickException(job.error)
+    click.echo(f'Messages archived: {job.done}')
+    report = last_compaction()
+    if report and report['at'] >= job.submitted_at:
+        click.echo(f"Compaction ({report['mode']}): {report['reclaimed_bytes'] / 1024 / 1024:.1f} MiB reclaimed, "
+                   f"{report['bytes_after'] / 1024 / 1024:.1f} MiB left")
+    elif not incremental_compaction():
+        click.echo('Compaction: run once with --compact (full VACUUM) to enable it')
+    else:
+        click.echo('Compaction: not needed')
+
+
+@click.command('export-history')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--type', 'kinds', type=click.Choice(KINDS), multiple=True,
+              help='Rows to export (repeatable; default: all).')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output (implied by a .gz file name).')
+def export_history_command(output, kinds, compress):
+    """Write the chat and private message history to OUTPUT as NDJSON ('-' for stdout)."""
+    compress = compress or output.endswith('.gz')
+    with click.open_file(output, 'wb') as f:
+        for chunk in ndjson_chunks(export_records(kinds or KINDS), compress):
+            f.write(chunk)
+
+
+@click.command('import-history')
+@click.argument('input', type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+def import_history_command(input):
+    """Load an NDJSON history export (gzip detected) into this database."""
+    if current_app.config['MESSAGE_WRITE_BEHIND']:
+        # A running server allocates message ids in memory: rows inserted
+        # here would collide with them
+        raise click.ClickException('MESSAGE_WRITE_BEHIND is enabled: stop the server and '
+                                   'run again with MESSAGE_WRITE_BEHIND=false')
+    with click.open_file(input, 'rb') as f:
+        if f.peek(2)[:2] == b'\x1f\x8b':
+            f = gzip.GzipFile(fileobj=f)
+        try:
+            counts = import_history(f)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"Messages imported: {counts['message']}")
+    click.echo(f"Private messages imported: {counts['private_message']} "
+               f"(skipped, unknown users: {counts['skipped']})")
+    if counts['undated']:
+        click.echo(f"Records without a timestamp (dated now): {counts['undated']}")
+    if counts['missing_drawings']:
+        click.echo(f"Drawings missing from DRAWINGS_FOLDER: {counts['missing_drawings']}")
+
+
+def register_commands(app: Flask) -> None:
+    """Register custom ``flask`` CLI commands."""
+    app.cli.add_command(migrate_drawings_command)
+    app.cli.add_command(rebuild_conversations_command)
+    app.cli.add_command(archive_messages_command)
+    app.cli.add_command(export_history_command)
+    app.cli.add_command(import_history_command)
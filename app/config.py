@@ -12,18 +12,126 @@ class Config:
     # ── Database ─────────────────────────────────────────────────────────────
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///chat.db'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Pooled connections per process (with a green-thread async mode SQLite
+    # always uses 1)
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '10'))
+    # SQLite storage profile, applied to every new connection.
+    # SQLITE_PROFILE=false keeps SQLite's defaults (rollback journal)
+    SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'true').lower() == 'true'
+    SQLITE_PRAGMAS = {
+        # New files only (must precede journal_mode): free pages can be
+        # released in steps; existing files need `flask archive-messages --compact`
+        'auto_vacuum': 'INCREMENTAL',
+        'journal_mode': 'WAL',      # readers no longer wait for a committing writer
+        'synchronous': 'NORMAL',    # fsync at checkpoints only; safe with WAL
+        'busy_timeout': 5000,       # ms to wait for the write lock before failing
+        'cache_size': -65536,       # 64 MiB page cache per connection
+        'mmap_size': 268435456,     # 256 MiB of memory-mapped reads
+        'temp_store': 'MEMORY',     # sorts and temp indexes stay off disk
+    }
+
+    # ── Server ───────────────────────────────────────────────────────────────
+    # 'threading': Werkzeug dev server, one OS thread per client.
+    # 'eventlet' / 'gevent': production green-thread server started by run.py,
+    # which monkey-patches the stdlib before importing the app
+    SOCKETIO_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+    # Concurrent connections of the eventlet server (its own default is 1024)
+    SERVER_MAX_CONNECTIONS = int(os.environ.get('SERVER_MAX_CONNECTIONS', '10000'))
+
+    # ── Chat history ─────────────────────────────────────────────────────────
+    # Newest main chat messages kept in memory to render the chat page
+    CHAT_HISTORY_BUFFER_SIZE = 50
+
+    # ── Admin search ─────────────────────────────────────────────────────────
+    # Message search ranks by relevance among this many newest hits
+    SEARCH_RANK_WINDOW = 2000
+
+    # ── Purge jobs ───────────────────────────────────────────────────────────
+    # User deletions and bulk message deletes run in the background, a
+    # bounded batch per transaction so chat commits can interleave
+    PURGE_BATCH_SIZE = 500
+    PURGE_BATCH_PAUSE = 0.05   # seconds between batches
+    JOBS_HISTORY = 20          # finished jobs kept for the admin pages
+    JOBS_RUN_INLINE = False    # run jobs inside the request (tests)
+
+    # ── Retention / archive ──────────────────────────────────────────────────
+    # Main chat messages older than RETENTION_DAYS, or beyond the newest
+    # RETENTION_MAX_MESSAGES, move to a compressed archive file (0 = no limit)
+    RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', '0'))
+    RETENTION_MAX_MESSAGES = int(os.environ.get('RETENTION_MAX_MESSAGES', '0'))
+    RETENTION_INTERVAL = int(os.environ.get('RETENTION_INTERVAL', '3600'))   # seconds
+    MESSAGE_ARCHIVE_PATH = os.environ.get('MESSAGE_ARCHIVE_PATH') or os.path.join(BASE_DIR, 'instance', 'archive.db')
+    # Each run then compacts the database once this share of it is free pages
+    COMPACTION_MIN_FREE_RATIO = 0.1
+    COMPACTION_STEP_PAGES = 1024        # pages released per incremental vacuum step
+
+    # ── History export / import ──────────────────────────────────────────────
+    EXPORT_BATCH_SIZE = 1000   # rows fetched per cursor batch / inserted per transaction
+
+    # ── Write-behind persistence ─────────────────────────────────────────────
+    # Broadcast chat messages immediately and batch their inserts in a
+    # background writer. Only safe with a single process writing messages.
+    MESSAGE_WRITE_BEHIND = os.environ.get('MESSAGE_WRITE_BEHIND', 'false').lower() == 'true'
+    WRITE_BEHIND_FLUSH_INTERVAL = 0.005   # seconds
+    WRITE_BEHIND_BATCH_SIZE = 200
+
+    # ── Workers / Socket.IO bus ──────────────────────────────────────────────
+    # WORKERS > 1 runs that many server processes on one port (see run.py).
+    # They share rooms, broadcasts and the online list through a SQLite file;
+    # without SOCKETIO_BUS_PATH everything stays in-process.
+    WORKERS = int(os.environ.get('WORKERS', '1'))
+    SOCKETIO_BUS_PATH = os.environ.get('SOCKETIO_BUS_PATH') or None
+    SOCKETIO_BUS_POLL_INTERVAL = 0.01   # seconds
+    # Polling needs sticky sessions, which the pre-fork workers do not have
+    SOCKETIO_WEBSOCKET_ONLY = False
+    PRESENCE_HEARTBEAT_INTERVAL = 5     # seconds
+    PRESENCE_HOST_TIMEOUT = 15          # seconds without heartbeat = dead worker
+    # Joins/leaves within this window go out as one user_joined/user_left batch
+    PRESENCE_COALESCE_WINDOW = 0.25     # seconds
+
+    # ── Typing indicator ─────────────────────────────────────────────────────
+    # At most one typing_users snapshot per interval; typers expire after TTL
+    TYPING_BROADCAST_INTERVAL = 0.5     # seconds
+    TYPING_TTL = 5                      # seconds
+
+    # ── Rate limiting ────────────────────────────────────────────────────────
+    # Token bucket per user: BURST events at once, refilled at RATE per second.
+    # Drawings cost one extra token every DRAW_BYTES_PER_TOKEN bytes, typing 0.1
+    RATE_LIMIT_RATE = 1.25              # tokens per second
+    RATE_LIMIT_BURST = 4
+    RATE_LIMIT_DRAW_BYTES_PER_TOKEN = 150_000
+    RATE_LIMIT_SWEEP_INTERVAL = 60      # seconds between evictions of idle buckets
+
+    # ── Identity cache ───────────────────────────────────────────────────────
+    # Users loaded by socket events are served from a snapshot cache,
+    # invalidated on commit; entries are also dropped after the TTL
+    IDENTITY_CACHE_SIZE = 1024
+    IDENTITY_CACHE_TTL = 300            # seconds
 
     # ── Uploads ──────────────────────────────────────────────────────────────
     UPLOAD_FOLDER = os.path.join(BASE_DIR, 'static', 'uploads', 'profiles')
     MAX_CONTENT_LENGTH = 2 * 1024 * 1024   # 2 MB max
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+    # ── Drawings ─────────────────────────────────────────────────────────────
+    # Content-addressed blob store for drawing canvas messages
+    DRAWINGS_FOLDER = os.environ.get('DRAWINGS_FOLDER') or os.path.join(BASE_DIR, 'instance', 'drawings')
+    DRAWINGS_CACHE_MAX_AGE = 365 * 24 * 3600   # blobs are immutable
+
     # ── Session / Cookie security ─────────────────────────────────────────────
     SESSION_COOKIE_HTTPONLY = True
     SESSION_COOKIE_SAMESITE = 'Lax'
     # Set to True only when served over HTTPS in production
     SESSION_COOKIE_SECURE = os.environ.get('HTTPS', 'false').lower() == 'true'
 
+    # ── Password hashing ─────────────────────────────────────────────────────
+    # werkzeug method string, work factor included ('scrypt:32768:8:1',
+    # 'pbkdf2:sha256:600000', ...). Hashes run in WORKERS processes (0 = in
+    # the request thread); beyond QUEUE_LIMIT pending ones logins are refused
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', '2'))
+    PASSWORD_HASH_QUEUE_LIMIT = 0       # 0 = 4 per worker
+
     # ── Password policy ──────────────────────────────────────────────────────
     PASSWORD_MIN_LENGTH = 6
     USERNAME_MIN_LENGTH = 3
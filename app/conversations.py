@@ -0,0 +1,220 @@
+"""
+Maintenance of the ``Conversation`` summary rows.
+
+Every private message updates both sides of its conversation in the same
+transaction as the insert: the sender's row gets the new preview, the
+recipient's row also gets ``unread_count + 1``. Reading a conversation moves
+the reader's ``last_read_message_id`` high-water mark, a single-row update.
+"""
+from sqlalchemy import func, case, or_, and_
+
+from .extensions import db
+from .models import Conversation, PrivateMessage
+
+CONVERSATION_PAGE_SIZE = 50
+CONVERSATION_MAX_PAGE_SIZE = 100
+
+
+def serialize_private_message(pm: PrivateMessage) -> dict:
+    """JSON payload for a private message (delta API and socket events)."""
+    return {
+        'id': pm.id,
+        'sender_id': pm.sender_id,
+        'content': pm.content,
+        'timestamp': pm.timestamp.strftime('%H:%M')
+    }
+
+
+def between(user_id: int, other_id: int):
+    """Filter selecting the messages exchanged by two users."""
+    return or_(
+        and_(PrivateMessage.sender_id == user_id, PrivateMessage.recipient_id == other_id),
+        and_(PrivateMessage.sender_id == other_id, PrivateMessage.recipient_id == user_id)
+    )
+
+
+def fetch_conversation_page(user_id: int, other_id: int, before_id: int | None = None,
+                            limit: int = CONVERSATION_PAGE_SIZE) -> tuple[list[PrivateMessage], bool]:
+    """
+    One page of a conversation in chronological order plus whether older
+    messages exist, keyed on (timestamp, id) before ``before_id``.
+
+    Each direction is read separately so both are plain range scans on the
+    (sender_id, recipient_id, timestamp) index; the two bounded results are
+    merged in Python.
+    """
+    limit = max(1, min(limit, CONVERSATION_MAX_PAGE_SIZE))
+
+    anchor = db.session.get(PrivateMessage, before_id) if before_id is not None else None
+    if anchor is not None and {anchor.sender_id, anchor.recipient_id} != {user_id, other_id}:
+        anchor = None
+
+    def one_direction(sender_id, recipient_id):
+        query = PrivateMessage.query.filter(
+            PrivateMessage.sender_id == sender_id,
+            PrivateMessage.recipient_id == recipient_id
+        )
+        if anchor is not None:
+            query = query.filter(or_(
+                PrivateMessage.timestamp < anchor.timestamp,
+                and_(PrivateMessage.timestamp == anchor.timestamp, PrivateMessage.id < anchor.id)
+            ))
+        elif before_id is not None:
+            query = query.filter(PrivateMessage.id < before_id)
+        return query.order_by(
+            PrivateMessage.timestamp.desc(), PrivateMessage.id.desc()
+        ).limit(limit + 1).all()
+
+    rows = one_direction(user_id, other_id) + one_direction(other_id, user_id)
+    rows.sort(key=lambda pm: (pm.timestamp, pm.id), reverse=True)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+    return rows, has_more
+
+
+def _apply_last_message(conv: Conversation, pm: PrivateMessage) -> None:
+    conv.last_message_id = pm.id
+    conv.last_sender_id = pm.sender_id
+    conv.last_preview = pm.content[:Conversation.PREVIEW_LENGTH]
+    conv.last_timestamp = pm.timestamp
+
+
+def _insert_dialect():
+    """``INSERT`` construct supporting ``ON CONFLICT`` for the bound database."""
+    if db.session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+
+def record_private_message(pm: PrivateMessage) -> None:
+    """
+    Update both summaries for a flushed (not yet committed) message.
+
+    Each side is a single upsert on (owner_id, peer_id), so two first
+    messages of a new pair sent at the same time do not collide on the
+    unique constraint, and the unread increment happens in SQL.
+    """
+    insert = _insert_dialect()
+    last = {
+        'last_message_id': pm.id,
+        'last_sender_id': pm.sender_id,
+        'last_preview': pm.content[:Conversation.PREVIEW_LENGTH],
+        'last_timestamp': pm.timestamp,
+    }
+    for owner_id, peer_id, unread in ((pm.sender_id, pm.recipient_id, 0),
+                                      (pm.recipient_id, pm.sender_id, 1)):
+        stmt = insert(Conversation).values(owner_id=owner_id, peer_id=peer_id, unread_count=unread, **last)
+        db.session.execute(stmt.on_conflict_do_update(
+            index_elements=['owner_id', 'peer_id'],
+            set_={**last, 'unread_count': Conversation.unread_count + unread}
+        ))
+
+
+def mark_conversation_read(owner_id: int, peer_id: int, up_to_id: int | None = None) -> int | None:
+    """
+    Move ``owner_id``'s read mark to ``up_to_id`` (default: the newest message
+    of the conversation). Returns the new mark, or None when nothing changed.
+    """
+    conv = Conversation.query.filter_by(owner_id=owner_id, peer_id=peer_id).first()
+    if conv is None or conv.unread_count == 0:
+        return None
+
+    last_id = conv.last_message_id
+    if up_to_id is None or up_to_id >= last_id:
+        mark, unread = last_id, 0
+    else:
+        if conv.last_read_message_id is not None and up_to_id <= conv.last_read_message_id:
+            return None
+        # Only part of the conversation was shown: the rest stays unread
+        mark = up_to_id
+        unread = PrivateMessage.query.filter(
+            PrivateMessage.sender_id == peer_id,
+            PrivateMessage.recipient_id == owner_id,
+            PrivateMessage.id > up_to_id
+        ).count()
+
+    # Guarded on last_message_id: a message landing in between keeps its unread count
+    updated = Conversation.query.filter(
+        Conversation.id == conv.id,
+        Conversation.last_message_id == last_id
+    ).update({'unread_count': unread, 'last_read_message_id': mark}, synchronize_session=False)
+    return mark if updated else None
+
+
+def get_peer_read_mark(owner_id: int, peer_id: int) -> int:
+    """Highest message id ``peer_id`` has read in its conversation with ``owner_id``."""
+    mark = db.session.query(Conversation.last_read_message_id).filter_by(
+        owner_id=peer_id, peer_id=owner_id
+    ).scalar()
+    return mark or 0
+
+
+def get_unread_total(owner_id: int) -> int:
+    return db.session.query(
+        func.coalesce(func.sum(Conversation.unread_count), 0)
+    ).filter(Conversation.owner_id == owner_id).scalar()
+
+
+def rebuild_conversations() -> int:
+    """
+    Recompute every summary from ``PrivateMessage``, keeping existing read
+    marks. Returns rows written.
+    """
+    read_marks = {
+        (owner_id, peer_id): mark
+        for owner_id, peer_id, mark in db.session.query(
+            Conversation.owner_id, Conversation.peer_id, Conversation.last_read_message_id
+        )
+        if mark is not None
+    }
+    Conversation.query.delete()
+
+    owner = case(
+        (PrivateMessage.sender_id < PrivateMessage.recipient_id, PrivateMessage.sender_id),
+        else_=PrivateMessage.recipient_id
+    )
+    other = case(
+        (PrivateMessage.sender_id < PrivateMessage.recipient_id, PrivateMessage.recipient_id),
+        else_=PrivateMessage.sender_id
+    )
+    last_ids = db.session.query(func.max(PrivateMessage.id)).group_by(owner, other)
+
+    # Conversations never read through the high-water mark fall back to the
+    # legacy per-row flag
+    legacy_unread = dict(
+        ((recipient_id, sender_id), count)
+        for sender_id, recipient_id, count in db.session.query(
+            PrivateMessage.sender_id, PrivateMessage.recipient_id, func.count()
+        ).filter(PrivateMessage.is_read.is_(False)).group_by(
+            PrivateMessage.sender_id, PrivateMessage.recipient_id
+        )
+    )
+
+    def unread_after(owner_id, peer_id, mark):
+        return PrivateMessage.query.filter(
+            PrivateMessage.sender_id == peer_id,
+            PrivateMessage.recipient_id == owner_id,
+            PrivateMessage.id > mark
+        ).count()
+
+    written = 0
+    for pm in PrivateMessage.query.filter(PrivateMessage.id.in_(last_ids)):
+        for owner_id, peer_id in ((pm.sender_id, pm.recipient_id), (pm.recipient_id, pm.sender_id)):
+            mark = read_marks.get((owner_id, peer_id))
+            conv = Conversation(
+                owner_id=owner_id,
+                peer_id=peer_id,
+                last_read_message_id=mark,
+                unread_count=(
+                    unread_after(owner_id, peer_id, mark) if mark is not None
+                    else legacy_unread.get((owner_id, peer_id), 0)
+                )
+            )
+            _apply_last_message(conv, pm)
+            db.session.add(conv)
+            written += 1
+    db.session.commit()
+    return written
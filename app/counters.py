@@ -0,0 +1,81 @@
+"""
+Row counts for the admin dashboard, maintained incrementally.
+
+On SQLite the ``app_counter`` table holds the number of users, admins and
+messages. Triggers on ``user`` and ``message`` adjust it in the transaction
+of every insert, delete and admin toggle, whatever the write path (ORM,
+bulk deletes, write-behind batches), so the dashboard reads three rows
+instead of running three ``COUNT(*)`` scans. Other databases count on demand.
+"""
+from flask import current_app
+from sqlalchemy import func, select, text
+
+from .extensions import db
+from .models import User, Message
+
+COUNTERS = ('users', 'admins', 'messages')
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS app_counter (name TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+    'CREATE TRIGGER IF NOT EXISTS user_counter_insert AFTER INSERT ON "user" BEGIN'
+    " UPDATE app_counter SET value = value + 1 WHERE name = 'users';"
+    " UPDATE app_counter SET value = value + 1 WHERE name = 'admins' AND new.is_admin;"
+    " END",
+    'CREATE TRIGGER IF NOT EXISTS user_counter_delete AFTER DELETE ON "user" BEGIN'
+    " UPDATE app_counter SET value = value - 1 WHERE name = 'users';"
+    " UPDATE app_counter SET value = value - 1 WHERE name = 'admins' AND old.is_admin;"
+    " END",
+    'CREATE TRIGGER IF NOT EXISTS user_counter_admin AFTER UPDATE OF is_admin ON "user"'
+    " WHEN coalesce(old.is_admin, 0) != coalesce(new.is_admin, 0) BEGIN"
+    " UPDATE app_counter SET value = value + (CASE WHEN new.is_admin THEN 1 ELSE -1 END)"
+    " WHERE name = 'admins';"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS message_counter_insert AFTER INSERT ON message BEGIN"
+    " UPDATE app_counter SET value = value + 1 WHERE name = 'messages';"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS message_counter_delete AFTER DELETE ON message BEGIN"
+    " UPDATE app_counter SET value = value - 1 WHERE name = 'messages';"
+    " END",
+)
+
+
+def ensure_counters(app) -> bool:
+    """Create the counters and their triggers (counting once) if missing. Needs an app context."""
+    available = False
+    if db.engine.dialect.name == 'sqlite':
+        try:
+            with db.engine.begin() as conn:
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'app_counter'"
+                )).first()
+                for statement in _SCHEMA:
+                    conn.execute(text(statement))
+                if not exists:
+                    _recount(conn)
+            available = True
+        except Exception as e:
+            print(f"[ERRORE CONTATORI] {str(e)}")
+    app.extensions['row_counters'] = available
+    return available
+
+
+def _recount(conn) -> None:
+    counts = _count(conn)
+    conn.execute(text("INSERT OR REPLACE INTO app_counter (name, value) VALUES (:name, :value)"),
+                 [{'name': name, 'value': counts[name]} for name in COUNTERS])
+
+
+def _count(conn) -> dict[str, int]:
+    return {
+        'users': conn.scalar(select(func.count()).select_from(User)),
+        'admins': conn.scalar(select(func.count()).select_from(User).where(User.is_admin.is_(True))),
+        'messages': conn.scalar(select(func.count()).select_from(Message)),
+    }
+
+
+def row_counts() -> dict[str, int]:
+    """Current number of users, admins and messages."""
+    if not current_app.extensions.get('row_counters'):
+        return _count(db.session)
+    rows = dict(db.session.execute(text("SELECT name, value FROM app_counter")).all())
+    return {name: rows.get(name, 0) for name in COUNTERS}
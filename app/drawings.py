@@ -0,0 +1,125 @@
+"""
+Content-addressed on-disk store for drawing canvas images.
+
+Drawings arrive over Socket.IO as base64 data URLs. Instead of keeping the
+whole data URL in ``Message.image_data``, the decoded bytes are written once
+under a path derived from their SHA-256 digest and the message only keeps the
+short URL returned by :func:`store_drawing`. Identical drawings share a file.
+
+The blob is written before its message is persisted, so a failed commit (or
+a dropped write-behind batch) leaves an unreferenced file behind;
+:func:`sweep_orphan_drawings` removes those once they are old enough.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from flask import current_app
+
+# MIME type → (file extension, magic bytes)
+_IMAGE_TYPES = {
+    'image/png': ('png', b'\x89PNG\r\n\x1a\n'),
+    'image/jpeg': ('jpg', b'\xff\xd8\xff'),
+}
+
+_DATA_URL_RE = re.compile(r'^data:(image/[a-z]+);base64,(.+)$', re.DOTALL)
+_FILENAME_RE = re.compile(r'^([0-9a-f]{64})\.(png|jpg)$')
+
+DRAWING_URL_PREFIX = '/drawings/'
+
+
+class InvalidDrawing(ValueError):
+    """Raised when a data URL cannot be decoded into a supported image."""
+
+
+def decode_data_url(data_url: str) -> tuple[bytes, str]:
+    """Decode a base64 image data URL. Returns (raw bytes, file extension)."""
+    match = _DATA_URL_RE.match(data_url or '')
+    if not match or match.group(1) not in _IMAGE_TYPES:
+        raise InvalidDrawing('Unsupported data URL')
+
+    ext, magic = _IMAGE_TYPES[match.group(1)]
+    try:
+        raw = base64.b64decode(match.group(2), validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidDrawing('Invalid base64 payload')
+
+    if not raw.startswith(magic):
+        raise InvalidDrawing('Payload does not match declared image type')
+    return raw, ext
+
+
+def drawing_path(filename: str) -> str:
+    """Absolute path of a stored drawing (two-level fan-out on the digest)."""
+    return os.path.join(
+        current_app.config['DRAWINGS_FOLDER'], filename[:2], filename[2:4], filename
+    )
+
+
+def drawing_url(filename: str) -> str:
+    return f'{DRAWING_URL_PREFIX}{filename}'
+
+
+def parse_drawing_filename(filename: str) -> tuple[str, str] | None:
+    """Return (digest, extension) for a valid blob filename, else None."""
+    match = _FILENAME_RE.match(filename)
+    return (match.group(1), match.group(2)) if match else None
+
+
+def store_drawing(data_url: str) -> str:
+    """
+    Persist a drawing data URL and return its URL.
+
+    The write is skipped when a blob with the same digest already exists,
+    otherwise the file is written to a temporary name and atomically renamed
+    so readers never see a partial image.
+    """
+    raw, ext = decode_data_url(data_url)
+    filename = f'{hashlib.sha256(raw).hexdigest()}.{ext}'
+    path = drawing_path(filename)
+
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(raw)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    return drawing_url(filename)
+
+
+def is_legacy_data_url(image_data: str | None) -> bool:
+    """True for rows written before the blob store (inline base64)."""
+    return bool(image_data) and image_data.startswith('data:')
+
+
+def sweep_orphan_drawings(referenced: set[str], min_age: float) -> int:
+    """
+    Delete stored drawings whose filename is not in ``referenced`` and that
+    are older than ``min_age`` seconds (younger ones may belong to a message
+    still being saved). Returns the number of files removed.
+    """
+    cutoff = time.time() - min_age
+    removed = 0
+    for directory, _, filenames in os.walk(current_app.config['DRAWINGS_FOLDER']):
+        for filename in filenames:
+            if not parse_drawing_filename(filename) or filename in referenced:
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+    return removed
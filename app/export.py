@@ -0,0 +1,225 @@
+"""
+NDJSON export and import of the chat and private message history.
+
+:func:`export_records` reads ``message`` and ``private_message`` in keyset
+batches of ``EXPORT_BATCH_SIZE`` rows (``id > last id``), so memory stays
+flat whatever the table size. Each batch runs on its own short-lived
+connection: a slow download never holds a pooled one, which matters in
+green-thread mode where SQLite gets a single one. Archived messages (:mod:`app.archive`)
+come first, one segment at a time. :func:`ndjson_chunks` turns the records
+into NDJSON, optionally gzip-compressed on the fly, for the admin download
+and ``flask export-history``.
+
+Users are referenced by username, not id, so an export can be loaded into
+another database: :func:`import_history` resolves the usernames there and
+inserts the rows in batches of ``EXPORT_BATCH_SIZE``, with new ids.
+Drawings are written as their drawing store URL, never inline: copy
+``DRAWINGS_FOLDER`` along with the export.
+"""
+import json
+import os
+import zlib
+from datetime import datetime, timezone
+from typing import Iterable, Iterator
+
+from flask import current_app
+from sqlalchemy import and_, insert, select
+from sqlalchemy.orm import aliased
+
+from .extensions import db
+from .models import User, Message, PrivateMessage, Conversation
+from .archive import message_archive
+from .conversations import rebuild_conversations
+from .drawings import (
+    store_drawing, is_legacy_data_url, drawing_path, InvalidDrawing, DRAWING_URL_PREFIX
+)
+
+FORMAT = 'pictoflask-history'
+VERSION = 1
+KINDS = ('message', 'private_message')
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def export_records(kinds: Iterable[str] = KINDS) -> Iterator[dict]:
+    """The header, then every row of ``kinds`` as a dict, oldest first."""
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    yield {'type': 'header', 'format': FORMAT, 'version': VERSION,
+           'exported_at': datetime.now(timezone.utc).isoformat()}
+
+    if 'message' in kinds:
+        for row in message_archive.messages():
+            yield _message_record(row)
+        for row in _batches(select(Message.__table__), Message.id, batch_size):
+            yield _message_record(row)
+
+    if 'private_message' in kinds:
+        sender, recipient = aliased(User), aliased(User)
+        rows = _batches(
+            select(PrivateMessage.id, PrivateMessage.content, PrivateMessage.timestamp,
+                   PrivateMessage.is_read, Conversation.last_read_message_id,
+                   sender.username.label('sender'), recipient.username.label('recipient'))
+            .join(sender, sender.id == PrivateMessage.sender_id)
+            .join(recipient, recipient.id == PrivateMessage.recipient_id)
+            # The recipient's read mark
+            .outerjoin(Conversation, and_(Conversation.owner_id == PrivateMessage.recipient_id,
+                                          Conversation.peer_id == PrivateMessage.sender_id)),
+            PrivateMessage.id, batch_size
+        )
+        for row in rows:
+            mark = row['last_read_message_id']
+            yield {
+                'type': 'private_message',
+                'id': row['id'],
+                'sender': row['sender'],
+                'recipient': row['recipient'],
+                'content': row['content'],
+                'timestamp': _isoformat(row['timestamp']),
+                'read': bool(row['is_read'] or (mark is not None and row['id'] <= mark)),
+            }
+
+
+def _batches(statement, key, batch_size: int) -> Iterator:
+    """Rows of ``statement`` in ``key`` order, releasing the connection between batches."""
+    last = None
+    while True:
+        query = statement if last is None else statement.where(key > last)
+        with db.engine.connect() as conn:
+            rows = conn.execute(query.order_by(key).limit(batch_size)).mappings().all()
+        if not rows:
+            return
+        yield from rows
+        last = rows[-1][key.key]
+
+
+def _message_record(row) -> dict:
+    return {
+        'type': 'message',
+        'id': row['id'],
+        'username': row['username'],
+        'content': row['content'],
+        'profile_pic': row['profile_pic'],
+        'timestamp': _isoformat(row['timestamp']),
+        'image_data': _drawing_reference(row['image_data']),
+    }
+
+
+def _drawing_reference(image_data: str | None) -> str | None:
+    if image_data and is_legacy_data_url(image_data):
+        # Rows older than the drawing store: store the blob (as
+        # migrate-drawings would) and export its URL
+        try:
+            return store_drawing(image_data)
+        except InvalidDrawing:
+            return None
+    return image_data
+
+
+def _isoformat(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.isoformat()
+
+
+def ndjson_chunks(records: Iterable[dict], compress: bool = False) -> Iterator[bytes]:
+    """NDJSON of ``records`` in chunks of about 64 KiB, gzip-compressed if asked."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer, size = [], 0
+    for record in records:
+        line = (json.dumps(record, ensure_ascii=False) + '\n').encode()
+        buffer.append(line)
+        size += len(line)
+        if size >= _CHUNK_SIZE:
+            chunk = b''.join(buffer)
+            buffer, size = [], 0
+            chunk = compressor.compress(chunk) if compressor else chunk
+            if chunk:
+                yield chunk
+    chunk = b''.join(buffer)
+    if compressor:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def import_history(lines: Iterable[bytes | str]) -> dict[str, int]:
+    """
+    Insert the records of an export, ``EXPORT_BATCH_SIZE`` rows per
+    transaction. Private messages between users missing here are skipped;
+    chat messages of missing users are kept without a user id.
+    Rows without a timestamp get the import time. Returns the number of
+    rows imported, skipped and undated, and of drawing references whose
+    blob is missing from ``DRAWINGS_FOLDER``.
+    """
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    user_ids: dict[str, int | None] = {}
+    batches = {'message': [], 'private_message': []}
+    counts = {'message': 0, 'private_message': 0, 'skipped': 0, 'undated': 0, 'missing_drawings': 0}
+
+    def user_id(username):
+        if username not in user_ids:
+            user_ids[username] = db.session.scalar(select(User.id).where(User.username == username))
+        return user_ids[username]
+
+    def timestamp(record):
+        if not record.get('timestamp'):
+            counts['undated'] += 1
+            return datetime.now(timezone.utc)
+        return datetime.fromisoformat(record['timestamp'])
+
+    def flush(kind):
+        if batches[kind]:
+            db.session.execute(insert(Message if kind == 'message' else PrivateMessage), batches[kind])
+            db.session.commit()
+            counts[kind] += len(batches[kind])
+            batches[kind] = []
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        kind = record.get('type')
+        if number == 1:
+            if kind != 'header' or record.get('format') != FORMAT:
+                raise ValueError('not a history export')
+            if record.get('version') != VERSION:
+                raise ValueError(f"unsupported export version {record.get('version')}")
+            continue
+
+        if kind == 'message':
+            image_data = record.get('image_data')
+            if image_data and image_data.startswith(DRAWING_URL_PREFIX) \
+                    and not os.path.exists(drawing_path(image_data[len(DRAWING_URL_PREFIX):])):
+                counts['missing_drawings'] += 1
+            batches[kind].append({
+                'user_id': user_id(record['username']),
+                'username': record['username'],
+                'content': record['content'],
+                'profile_pic': record.get('profile_pic') or 'default.jpg',
+                'timestamp': timestamp(record),
+                'image_data': image_data,
+            })
+        elif kind == 'private_message':
+            sender_id, recipient_id = user_id(record['sender']), user_id(record['recipient'])
+            if sender_id is None or recipient_id is None:
+                counts['skipped'] += 1
+                continue
+            batches[kind].append({
+                'sender_id': sender_id,
+                'recipient_id': recipient_id,
+                'content': record['content'],
+                'timestamp': timestamp(record),
+                'is_read': record.get('read', False),
+            })
+        else:
+            raise ValueError(f'line {number}: unknown record type {kind!r}')
+        if len(batches[kind]) >= batch_size:
+            flush(kind)
+
+    flush('message')
+    flush('private_message')
+    if counts['private_message']:
+        rebuild_conversations()
+    return counts
@@ -3,6 +3,7 @@ from flask_socketio import SocketIO
 from flask_login import LoginManager
 
 db = SQLAlchemy()
-socketio = SocketIO(cors_allowed_origins="*", async_mode='threading')
+# async_mode is set by create_app from SOCKETIO_ASYNC_MODE
+socketio = SocketIO(cors_allowed_origins="*")
 login_manager = LoginManager()
 login_manager.login_view = 'auth.login'
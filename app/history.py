@@ -0,0 +1,145 @@
+"""
+Main chat history: serialization and keyset pagination over ``Message``.
+
+Pages are ordered newest-first on ``(timestamp, id)`` and addressed by the id
+of the oldest message the client already has (``before_id``), so every page
+is a bounded index range scan no matter how large the table grows.
+
+The newest page is additionally kept in memory by :data:`recent_messages`,
+fed by the socket handlers, so rendering the chat needs no history query.
+"""
+import json
+from collections import OrderedDict
+from threading import Lock
+
+from sqlalchemy import or_, tuple_
+
+from .extensions import db
+from .models import Message, User
+
+DEFAULT_COLOR = '#61829a'
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def serialize_message(msg: Message, color: str | None = None) -> dict:
+    """Payload shape shared by the history API and live ``message`` events."""
+    return {
+        'id': msg.id,
+        'user_id': msg.user_id,
+        'username': msg.username,
+        'msg': msg.content,
+        'time': msg.timestamp.strftime("%H:%M"),
+        'profile_pic': msg.profile_pic,
+        'color': color or DEFAULT_COLOR,
+        'image_data': msg.image_data or None
+    }
+
+
+def payload_json(payload: dict) -> str:
+    """JSON for a payload that is safe to inline inside a <script> block."""
+    return json.dumps(payload, ensure_ascii=False).replace('<', '\\u003c')
+
+
+def fetch_history_page(before_id: int | None = None, limit: int = HISTORY_PAGE_SIZE,
+                       blocked_ids: set[int] | None = None) -> tuple[list[dict], bool]:
+    """
+    Return one page of history in chronological order and whether older
+    messages exist. ``before_id`` is exclusive; ``None`` means the newest page.
+    """
+    limit = max(1, min(limit, HISTORY_MAX_PAGE_SIZE))
+    query = Message.query
+
+    if before_id is not None:
+        anchor = db.session.get(Message, before_id)
+        if anchor is not None:
+            # Row value comparison, as in app.pagination: one index range
+            query = query.filter(tuple_(Message.timestamp, Message.id) < (anchor.timestamp, anchor.id))
+        else:
+            # Anchor deleted meanwhile: ids grow with time, so fall back to them
+            query = query.filter(Message.id < before_id)
+
+    if blocked_ids:
+        query = query.filter(or_(
+            Message.user_id.is_(None),
+            Message.user_id.notin_(blocked_ids)
+        ))
+
+    rows = query.order_by(Message.timestamp.desc(), Message.id.desc()).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    usernames = {msg.username for msg in rows}
+    users = User.query.filter(User.username.in_(usernames)).all() if usernames else []
+    user_colors = {u.username: u.chat_color for u in users}
+
+    return [serialize_message(msg, user_colors.get(msg.username)) for msg in rows], has_more
+
+
+class RecentMessages:
+    """
+    Bounded ring buffer of the newest ``main_chat`` messages.
+
+    Entries are kept as pre-serialized JSON keyed by message id, oldest first.
+    Until :meth:`warm` has run the buffer reports itself as not ready and
+    callers fall back to :func:`fetch_history_page`.
+    """
+
+    def __init__(self, capacity: int = HISTORY_PAGE_SIZE):
+        self.capacity = capacity
+        self._entries: OrderedDict[int, tuple[dict, str]] = OrderedDict()
+        self._has_older = False
+        self._ready = False
+        self._lock = Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready
+
+    def warm(self, capacity: int | None = None) -> None:
+        """(Re)load the newest messages from the database."""
+        if capacity is not None:
+            self.capacity = capacity
+        payloads, has_more = fetch_history_page(limit=self.capacity)
+        with self._lock:
+            self._entries = OrderedDict((p['id'], (p, payload_json(p))) for p in payloads)
+            self._has_older = has_more
+            self._ready = True
+
+    def append(self, payload: dict) -> None:
+        with self._lock:
+            self._entries[payload['id']] = (payload, payload_json(payload))
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self._has_older = True
+
+    def discard(self, message_id: int) -> bool:
+        with self._lock:
+            return self._entries.pop(message_id, None) is not None
+
+    def discard_user(self, user_id: int) -> None:
+        with self._lock:
+            for message_id in [k for k, (p, _) in self._entries.items() if p['user_id'] == user_id]:
+                del self._entries[message_id]
+
+    def recolor(self, user_id: int, color: str) -> None:
+        """Apply a chat color change to the user's buffered messages."""
+        with self._lock:
+            for message_id, (payload, _) in list(self._entries.items()):
+                if payload['user_id'] == user_id:
+                    payload = dict(payload, color=color)
+                    self._entries[message_id] = (payload, payload_json(payload))
+
+    def page_json(self, blocked_ids: set[int] | None = None) -> tuple[str, bool]:
+        """Buffered history as a JSON array plus whether older messages exist."""
+        with self._lock:
+            items = [
+                raw for payload, raw in self._entries.values()
+                if not blocked_ids or payload['user_id'] not in blocked_ids
+            ]
+            has_older = self._has_older
+        return '[' + ','.join(items) + ']', has_older
+
+
+recent_messages = RecentMessages()
@@ -0,0 +1,139 @@
+"""
+Bounded LRU cache of user identities for Socket.IO handlers.
+
+``login_required`` loads the user on every socket event; with this cache the
+hot handlers authorize and build payloads from an immutable snapshot
+(:class:`UserIdentity`) instead of a primary-key query per message or typing
+report. HTTP requests keep loading the ORM ``User``, since routes modify it.
+
+Snapshots are dropped when a committed transaction changes one of the cached
+columns or deletes the user (session hooks, like the block index), on every
+worker through the bus, and in any case after ``IDENTITY_CACHE_TTL``.
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask_login import UserMixin
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+from .extensions import db
+from .models import User
+from .bus import subscribe, publish
+
+# User columns copied into the snapshot
+IDENTITY_FIELDS = ('id', 'username', 'chat_color', 'profile_pic', 'is_admin', 'session_token')
+
+
+class UserIdentity(UserMixin):
+    """Read-only snapshot of the ``User`` columns the socket handlers use."""
+    __slots__ = IDENTITY_FIELDS
+
+    def __init__(self, user: User):
+        for field in IDENTITY_FIELDS:
+            object.__setattr__(self, field, getattr(user, field))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('UserIdentity è in sola lettura')
+
+    def __repr__(self) -> str:
+        return f'<UserIdentity {self.username}>'
+
+
+class IdentityCache:
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[int, tuple[UserIdentity, float]] = OrderedDict()
+        self._lock = Lock()
+        # Bumped by every invalidation: a load that raced with one is not stored
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+
+    def init_app(self, app) -> None:
+        self.max_size = app.config['IDENTITY_CACHE_SIZE']
+        self.ttl = app.config['IDENTITY_CACHE_TTL']
+        self.clear()
+
+    def get(self, user_id: int) -> UserIdentity | None:
+        """Snapshot of ``user_id``, loaded from the database on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(user_id)
+                self._hits += 1
+                return entry[0]
+            self._misses += 1
+            generation = self._generation
+
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        identity = UserIdentity(user)
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (identity, now + self.ttl)
+                self._entries.move_to_end(user_id)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return identity
+
+    def invalidate(self, user_ids) -> None:
+        with self._lock:
+            self._generation += 1
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._hits = self._misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self._hits, 'misses': self._misses}
+
+
+identity_cache = IdentityCache()
+
+
+# ── Session hooks ────────────────────────────────────────────────────────────
+# Changed users are staged on flush and invalidated after commit, so readers
+# never cache a value that is about to be replaced.
+
+@event.listens_for(Session, 'after_flush')
+def _stage_identity_changes(session, flush_context):
+    staged = session.info.setdefault('identity_changes', set())
+    for obj in session.dirty:
+        if isinstance(obj, User):
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in IDENTITY_FIELDS):
+                staged.add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, User):
+            staged.add(obj.id)
+
+
+def _invalidate(user_ids):
+    identity_cache.invalidate(user_ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _apply_identity_changes(session):
+    user_ids = session.info.pop('identity_changes', None)
+    if user_ids:
+        _invalidate(user_ids)
+        publish('identity_changes', sorted(user_ids))
+
+
+subscribe('identity_changes', _invalidate)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_identity_changes(session):
+    session.info.pop('identity_changes', None)
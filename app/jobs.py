@@ -0,0 +1,281 @@
+"""
+Background purge jobs for the admin panel.
+
+Deleting a user, or every message matching a filter, may touch a large part
+of the tables. A single ``DELETE`` would hold SQLite's write lock for its
+whole duration and stall every chat commit, so :data:`jobs` runs purges in a
+background task instead: each step deletes at most ``PURGE_BATCH_SIZE`` rows
+per transaction and sleeps ``PURGE_BATCH_PAUSE`` seconds between batches,
+letting the socket handlers commit in between. Jobs run one at a time, in
+submission order, in the process that received the request; their progress
+is kept in memory for the admin pages.
+
+Deleted main chat messages are retracted from the clients with one
+``message_deleted`` event per batch (``message_ids``).
+
+With ``JOBS_RUN_INLINE`` (tests) a job runs to completion inside ``submit``.
+"""
+import itertools
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from datetime import datetime
+from threading import Lock
+from typing import Callable
+
+from sqlalchemy import and_, delete, func, or_, select
+
+from .extensions import db, socketio
+from .models import Message, PrivateMessage, Conversation, BlockedUser, User
+from .history import recent_messages
+from .write_behind import message_writer
+from .bus import publish
+from .search import search_filter
+from .sockets import ROOM, forget_deleted_user
+
+
+@dataclass
+class PurgeStep:
+    """
+    Delete every ``model`` row matching ``where``, batch by batch.
+    ``before_delete`` gets each batch of ids first (e.g. to archive them);
+    ``on_batch`` gets it once deleted.
+    """
+    label: str
+    model: type
+    where: object
+    on_batch: Callable[[list[int]], None] | None = None
+    before_delete: Callable[[list[int]], None] | None = None
+
+
+@dataclass
+class Job:
+    id: int
+    key: str
+    title: str
+    steps: list[PurgeStep]
+    finish: Callable[['Job'], None] | None = None
+    state: str = 'queued'
+    total: int = 0
+    deleted: dict[str, int] = field(default_factory=dict)
+    error: str | None = None
+    submitted_at: float = field(default_factory=time.time)
+    finished_at: float | None = None
+
+    @property
+    def done(self) -> int:
+        return sum(self.deleted.values())
+
+    @property
+    def active(self) -> bool:
+        return self.state in ('queued', 'running')
+
+    def as_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'title': self.title,
+            'state': self.state,
+            'total': self.total,
+            'done': self.done,
+            'deleted': dict(self.deleted),
+            'error': self.error,
+            'submitted_at': self.submitted_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobRunner:
+    def __init__(self):
+        self.app = None
+        self.inline = False
+        self.batch_size = 500
+        self.pause = 0.05
+        self.history = 20
+        self._ids = itertools.count(1)
+        self._jobs: OrderedDict[int, Job] = OrderedDict()
+        self._queue: deque[Job] = deque()
+        self._lock = Lock()
+        self._working = False
+
+    def init_app(self, app) -> None:
+        self.app = app
+        self.inline = app.config['JOBS_RUN_INLINE']
+        self.batch_size = app.config['PURGE_BATCH_SIZE']
+        self.pause = app.config['PURGE_BATCH_PAUSE']
+        self.history = app.config['JOBS_HISTORY']
+        with self._lock:
+            self._jobs.clear()
+            self._queue.clear()
+
+    def submit(self, key: str, title: str, steps: list[PurgeStep], finish=None,
+               inline: bool | None = None) -> Job:
+        """
+        Queue a purge. ``key`` identifies its target: while a job with the
+        same key is queued or running, that job is returned instead.
+        ``inline`` overrides ``JOBS_RUN_INLINE`` (CLI commands).
+        """
+        inline = self.inline if inline is None else inline
+        with self._lock:
+            for job in self._jobs.values():
+                if job.key == key and job.active:
+                    return job
+            job = Job(next(self._ids), key, title, steps, finish)
+            self._jobs[job.id] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs.values()))
+                if oldest.active:
+                    break
+                self._jobs.popitem(last=False)
+            if inline:
+                start_worker = False
+            else:
+                self._queue.append(job)
+                start_worker, self._working = not self._working, True
+
+        if inline:
+            self._execute(job)
+        elif start_worker:
+            socketio.start_background_task(self._work)
+        return job
+
+    def get(self, job_id: int) -> Job | None:
+        return self._jobs.get(job_id)
+
+    def recent(self) -> list[Job]:
+        """Known jobs, newest first."""
+        with self._lock:
+            return list(reversed(self._jobs.values()))
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                if not self._queue:
+                    self._working = False
+                    return
+                job = self._queue.popleft()
+            self._execute(job)
+
+    def _execute(self, job: Job) -> None:
+        job.state = 'running'
+        with self.app.app_context():
+            try:
+                job.total = sum(
+                    db.session.scalar(select(func.count()).select_from(step.model).where(step.where))
+                    for step in job.steps
+                )
+                for step in job.steps:
+                    self._purge(job, step)
+                if job.finish is not None:
+                    job.finish(job)
+                job.state = 'done'
+            except Exception as e:
+                db.session.rollback()
+                job.state = 'failed'
+                job.error = str(e)
+                print(f"[ERRORE JOB {job.id}] {str(e)}")
+            finally:
+                job.finished_at = time.time()
+                db.session.remove()
+
+    def _purge(self, job: Job, step: PurgeStep) -> None:
+        job.deleted.setdefault(step.label, 0)
+        while True:
+            ids = db.session.scalars(
+                select(step.model.id).where(step.where).limit(self.batch_size)
+            ).all()
+            if not ids:
+                return
+            if step.before_delete is not None:
+                step.before_delete(ids)
+            db.session.execute(
+                delete(step.model).where(step.model.id.in_(ids)),
+                execution_options={'synchronize_session': False}
+            )
+            db.session.commit()
+            job.deleted[step.label] += len(ids)
+            if step.on_batch is not None:
+                step.on_batch(ids)
+            if not self.inline and self.pause:
+                socketio.sleep(self.pause)
+
+    def stats(self) -> dict:
+        jobs = self.recent()
+        return {
+            'queued': sum(job.state == 'queued' for job in jobs),
+            'running': sum(job.state == 'running' for job in jobs),
+            'failed': sum(job.state == 'failed' for job in jobs),
+            'rows_deleted': sum(job.done for job in jobs),
+        }
+
+
+jobs = JobRunner()
+
+
+def retract_messages(message_ids: list[int]) -> None:
+    """Remove deleted main chat messages from the history buffer and the clients."""
+    for message_id in message_ids:
+        recent_messages.discard(message_id)
+    socketio.emit('message_deleted', {'message_ids': message_ids}, to=ROOM, namespace='/')
+
+
+def purge_user(user: User) -> Job:
+    """Delete a user with their messages, private messages, conversations and blocks."""
+    user_id, username = user.id, user.username
+
+    def finish(job):
+        # Messages written while the purge ran
+        message_writer.withdraw_user(user_id)
+        stragglers = db.session.scalars(select(Message.id).where(Message.user_id == user_id)).all()
+        db.session.execute(delete(Message).where(Message.user_id == user_id))
+        db.session.execute(delete(User).where(User.id == user_id))
+        db.session.commit()
+        if stragglers:
+            job.deleted['message'] += len(stragglers)
+            retract_messages(stragglers)
+        forget_deleted_user(user_id)
+        publish('user_deleted', user_id)
+
+    message_writer.withdraw_user(user_id)
+    return jobs.submit(f'user:{user_id}', f'Eliminazione utente {username}', [
+        PurgeStep('message', Message, Message.user_id == user_id, retract_messages),
+        # Rows written before messages carried a user_id
+        PurgeStep('message', Message, and_(Message.user_id.is_(None), Message.username == username),
+                  retract_messages),
+        PurgeStep('private_message', PrivateMessage, PrivateMessage.sender_id == user_id),
+        PurgeStep('private_message', PrivateMessage, PrivateMessage.recipient_id == user_id),
+        PurgeStep('conversation', Conversation,
+                  or_(Conversation.owner_id == user_id, Conversation.peer_id == user_id)),
+        PurgeStep('blocked_user', BlockedUser,
+                  or_(BlockedUser.blocker_id == user_id, BlockedUser.blocked_id == user_id)),
+    ], finish)
+
+
+def purge_messages(user: User | None = None, since: datetime | None = None,
+                   until: datetime | None = None, search: str | None = None) -> Job:
+    """Delete the main chat messages matching every given filter."""
+    conditions, parts = [], []
+    if user is not None:
+        conditions.append(or_(
+            Message.user_id == user.id,
+            and_(Message.user_id.is_(None), Message.username == user.username)
+        ))
+        parts.append(f'di {user.username}')
+    if since is not None:
+        conditions.append(Message.timestamp >= since)
+        parts.append(f'dal {since:%d/%m/%Y}')
+    if until is not None:
+        conditions.append(Message.timestamp < until)
+        parts.append(f'prima del {until:%d/%m/%Y}')
+    if search:
+        conditions.append(search_filter(search))
+        parts.append(f'"{search}"')
+    if not conditions:
+        raise ValueError('at least one filter is required')
+
+    # Queued messages may match too: write them first
+    if message_writer.enabled:
+        message_writer.flush()
+    title = 'Eliminazione messaggi ' + ', '.join(parts)
+    return jobs.submit(f'messages:{title}', title, [
+        PurgeStep('message', Message, and_(*conditions), retract_messages),
+    ])
@@ -1,9 +1,9 @@
-from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from datetime import datetime, timezone
 import secrets
 
 from .extensions import db
+from .passwords import password_hasher
 
 
 PICTOFLASK_COLORS = [
@@ -26,11 +26,14 @@ class User(UserMixin, db.Model):
     session_token = db.Column(db.String(64), nullable=True)
     is_admin = db.Column(db.Boolean, default=False)
 
+    # Keyset pagination of the admin user list walks (registered_on, id)
+    __table_args__ = (db.Index('ix_user_registered_on_id', 'registered_on', 'id'),)
+
     def set_password(self, password: str) -> None:
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = password_hasher.hash(password)
 
     def check_password(self, password: str) -> bool:
-        return check_password_hash(self.password_hash, password)
+        return password_hasher.verify(self.password_hash, password)
 
     def can_change_username(self) -> bool:
         if self.last_username_change is None:
@@ -55,9 +58,13 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=False)
     profile_pic = db.Column(db.String(120), default='default.jpg')
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
-    # Optional base64-encoded PNG for drawing canvas messages
+    # Drawing canvas messages: URL of the blob in the drawing store
+    # (rows older than the blob store may still hold an inline data URL)
     image_data = db.Column(db.Text, nullable=True)
 
+    # Keyset pagination of the chat history walks (timestamp, id)
+    __table_args__ = (db.Index('ix_message_timestamp_id', 'timestamp', 'id'),)
+
     def __repr__(self) -> str:
         return f'<Message {self.username}: {self.content[:30]}...>'
 
@@ -68,15 +75,52 @@ class PrivateMessage(db.Model):
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc), index=True)
+    # Legacy per-row read flag, no longer written: read state lives in
+    # Conversation.last_read_message_id
     is_read = db.Column(db.Boolean, default=False)
 
     sender = db.relationship('User', foreign_keys=[sender_id], backref='sent_messages')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='received_messages')
 
+    # Conversation pages are read per direction, newest first
+    __table_args__ = (
+        db.Index('ix_private_message_pair_timestamp', 'sender_id', 'recipient_id', 'timestamp'),
+    )
+
     def __repr__(self) -> str:
         return f'<PrivateMessage {self.sender_id} -> {self.recipient_id}>'
 
 
+class Conversation(db.Model):
+    """
+    One user's summary of a private conversation with a peer. Two rows per
+    pair (one per side), maintained on every private message, so the inbox is
+    a single range read on (owner_id, last_timestamp).
+    """
+    PREVIEW_LENGTH = 41
+
+    id = db.Column(db.Integer, primary_key=True)
+    owner_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    peer_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    last_message_id = db.Column(db.Integer, nullable=False)
+    last_sender_id = db.Column(db.Integer, nullable=False)
+    last_preview = db.Column(db.String(PREVIEW_LENGTH), nullable=False, default='')
+    last_timestamp = db.Column(db.DateTime, nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0)
+    # Read high-water mark: every message up to this id has been seen by the owner
+    last_read_message_id = db.Column(db.Integer, nullable=True)
+
+    peer = db.relationship('User', foreign_keys=[peer_id])
+
+    __table_args__ = (
+        db.UniqueConstraint('owner_id', 'peer_id'),
+        db.Index('ix_conversation_owner_last', 'owner_id', 'last_timestamp'),
+    )
+
+    def __repr__(self) -> str:
+        return f'<Conversation {self.owner_id} with {self.peer_id}>'
+
+
 class BlockedUser(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     blocker_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
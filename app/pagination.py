@@ -0,0 +1,60 @@
+"""
+Keyset (cursor) pagination for the admin lists.
+
+Pages are ordered newest-first on ``(column, id)`` and addressed by the id of
+the row at the edge of the page already shown: ``before`` walks to older
+rows, ``after`` back to newer ones. Every page is an index range scan of
+``per_page + 1`` rows, with none of the ``COUNT(*)`` and ``OFFSET`` of
+``paginate()``, so deep pages cost the same as the first one.
+"""
+from dataclasses import dataclass
+
+from sqlalchemy import tuple_
+
+from .extensions import db
+
+
+@dataclass
+class KeysetPage:
+    items: list
+    has_prev: bool
+    has_next: bool
+
+    @property
+    def prev_cursor(self) -> int | None:
+        return self.items[0].id if self.items else None
+
+    @property
+    def next_cursor(self) -> int | None:
+        return self.items[-1].id if self.items else None
+
+
+def keyset_page(query, model, column, before: int | None = None, after: int | None = None,
+                per_page: int = 20) -> KeysetPage:
+    """One page of ``query`` ordered by ``column`` desc, ``model.id`` desc."""
+    if after is not None:
+        rows = _beyond(query, model, column, after, newer=True) \
+            .order_by(column.asc(), model.id.asc()).limit(per_page + 1).all()
+        if len(rows) <= per_page:
+            # Back at the newest rows: show a full first page
+            return keyset_page(query, model, column, per_page=per_page)
+        rows = rows[:per_page]
+        rows.reverse()
+        return KeysetPage(rows, has_prev=True, has_next=True)
+
+    if before is not None:
+        query = _beyond(query, model, column, before, newer=False)
+    rows = query.order_by(column.desc(), model.id.desc()).limit(per_page + 1).all()
+    return KeysetPage(rows[:per_page], has_prev=before is not None, has_next=len(rows) > per_page)
+
+
+def _beyond(query, model, column, cursor: int, newer: bool):
+    """Rows strictly newer (or older) than the row with id ``cursor``."""
+    anchor = db.session.get(model, cursor)
+    if anchor is None:
+        # Anchor deleted meanwhile: ids grow with time, so fall back to them
+        return query.filter(model.id > cursor if newer else model.id < cursor)
+    # Row value comparison: one index range, where an OR of the two
+    # conditions may scan every row sharing the anchor's column value
+    key, edge = tuple_(column, model.id), (getattr(anchor, column.key), anchor.id)
+    return query.filter(key > edge if newer else key < edge)
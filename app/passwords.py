@@ -0,0 +1,100 @@
+"""
+Password hashing off the request thread.
+
+werkzeug's scrypt/PBKDF2 hashes hold the GIL for tens of milliseconds, so a
+burst of logins would stall every socket handler of the process. With
+``PASSWORD_HASH_WORKERS`` > 0 hashing and verification run in a process pool
+instead; at most ``PASSWORD_HASH_QUEUE_LIMIT`` operations may be waiting or
+running, further ones fail at once with :class:`HasherBusy` so the route can
+answer immediately instead of queueing behind the burst.
+
+With a green-thread async mode the work goes to the native thread pool of
+eventlet/gevent instead (process pools do not survive monkey-patching);
+hashlib releases the GIL while hashing, so the hub keeps serving sockets.
+"""
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    """Too many password operations in flight."""
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.method = 'scrypt'
+        self.workers = 0
+        self.queue_limit = 0
+        self.async_mode = 'threading'
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self._rejected = 0
+
+    def init_app(self, app) -> None:
+        self.shutdown()
+        self.method = app.config['PASSWORD_HASH_METHOD']
+        self.workers = app.config['PASSWORD_HASH_WORKERS']
+        self.queue_limit = app.config['PASSWORD_HASH_QUEUE_LIMIT'] or 4 * max(1, self.workers)
+        self.async_mode = app.config['SOCKETIO_ASYNC_MODE']
+        self._slots = threading.BoundedSemaphore(self.queue_limit)
+        self._rejected = 0
+
+    def hash(self, password: str) -> str:
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash: str, password: str) -> bool:
+        return self._run(check_password_hash, password_hash, password)
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(blocking=False):
+            self._rejected += 1
+            raise HasherBusy()
+        if self.async_mode != 'threading':
+            try:
+                return self._run_native(func, *args)
+            finally:
+                self._slots.release()
+        try:
+            future = self._pool().submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._slots.release())
+        return future.result()
+
+    def _run_native(self, func, *args):
+        """Run ``func`` in a real OS thread, blocking only this green thread."""
+        if self.async_mode == 'eventlet':
+            from eventlet import tpool
+            return tpool.execute(func, *args)
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+
+    def _pool(self) -> ProcessPoolExecutor:
+        # Started on first use, so each pre-forked worker gets its own pool.
+        # Spawned, not forked: the server process already runs threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn')
+                )
+            return self._executor
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def stats(self) -> dict:
+        in_flight = self.queue_limit - self._slots._value if self._slots else 0
+        return {'workers': self.workers, 'in_flight': in_flight, 'rejected': self._rejected}
+
+
+password_hasher = PasswordHasher()
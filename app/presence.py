@@ -0,0 +1,318 @@
+"""
+Who is connected to the main chat, by Socket.IO session.
+
+With a single process the sessions live in :class:`LocalPresence`. When the Socket.IO bus
+is shared between worker processes (``SOCKETIO_BUS_PATH``) they are kept in
+the same SQLite file instead, tagged with the worker's host id, so every
+worker sees the whole online list and every session of a user. Each worker
+refreshes a heartbeat row; sessions of a worker that stopped beating (it
+crashed or was killed) are purged by the survivors.
+
+Clients get the full online list once, when they connect, and then only
+``user_joined`` / ``user_left`` deltas, batched by :class:`PresenceDeltas`.
+"""
+import sqlite3
+import threading
+import time
+
+from .extensions import socketio
+
+
+def _public(user: dict) -> dict:
+    """The fields of a presence record sent to clients."""
+    return {'username': user['username'], 'profile_pic': user['profile_pic'], 'color': user['color']}
+
+
+class LocalPresence:
+    """
+    In-process registry: user_id → set of sids (the refcount is its size) and
+    one slot per online user holding its public record. Slots live in a dense
+    list, so removing a user swaps the last slot into its place, and the
+    online list is that list; a read-only snapshot is rebuilt at most once
+    per change, not per call.
+    """
+
+    def __init__(self):
+        self._sids_by_user: dict[int, set[str]] = {}
+        self._user_of_sid: dict[str, int] = {}
+        self._slots: list[dict] = []
+        self._slot_of_user: dict[int, int] = {}
+        self._slot_owner: list[int] = []
+        self._snapshot: list[dict] | None = []
+        self._lock = threading.Lock()
+
+    def add(self, sid: str, user: dict) -> bool:
+        user_id = user['user_id']
+        with self._lock:
+            self._user_of_sid[sid] = user_id
+            sids = self._sids_by_user.setdefault(user_id, set())
+            sids.add(sid)
+            slot = self._slot_of_user.get(user_id)
+            if slot is None:
+                self._slot_of_user[user_id] = len(self._slots)
+                self._slots.append(_public(user))
+                self._slot_owner.append(user_id)
+            else:
+                # Latest tab wins (e.g. a color change since the first one)
+                self._slots[slot] = _public(user)
+            self._snapshot = None
+            return len(sids) == 1
+
+    def remove(self, sid: str) -> tuple[dict | None, bool]:
+        with self._lock:
+            user_id = self._user_of_sid.pop(sid, None)
+            if user_id is None:
+                return None, False
+            sids = self._sids_by_user[user_id]
+            sids.discard(sid)
+            slot = self._slot_of_user[user_id]
+            user = dict(self._slots[slot], user_id=user_id)
+            if sids:
+                return user, False
+
+            del self._sids_by_user[user_id]
+            del self._slot_of_user[user_id]
+            last = len(self._slots) - 1
+            if slot != last:
+                self._slots[slot] = self._slots[last]
+                self._slot_owner[slot] = self._slot_owner[last]
+                self._slot_of_user[self._slot_owner[slot]] = slot
+            self._slots.pop()
+            self._slot_owner.pop()
+            self._snapshot = None
+            return user, True
+
+    def online_users(self) -> list[dict]:
+        with self._lock:
+            if self._snapshot is None:
+                self._snapshot = list(self._slots)
+            return self._snapshot
+
+    def sids_of(self, user_ids) -> list[str]:
+        with self._lock:
+            return [sid for user_id in user_ids for sid in self._sids_by_user.get(user_id, ())]
+
+    def heartbeat(self) -> int:
+        return 0
+
+
+class SQLitePresence:
+    def __init__(self, path: str, host_id: str, host_timeout: float):
+        self.path = path
+        self.host_id = host_id
+        self.host_timeout = host_timeout
+        self._local = threading.local()
+
+        conn = self._connection()
+        conn.execute(
+            'CREATE TABLE IF NOT EXISTS presence_session ('
+            ' sid TEXT PRIMARY KEY,'
+            ' host_id TEXT NOT NULL,'
+            ' user_id INTEGER NOT NULL,'
+            ' username TEXT NOT NULL,'
+            ' profile_pic TEXT,'
+            ' color TEXT,'
+            ' connected REAL NOT NULL)'
+        )
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_presence_session_user ON presence_session (user_id)')
+        conn.execute('CREATE TABLE IF NOT EXISTS presence_host (host_id TEXT PRIMARY KEY, heartbeat REAL NOT NULL)')
+        self.heartbeat()
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def _user_session_count(self, conn, user_id: int) -> int:
+        return conn.execute('SELECT COUNT(*) FROM presence_session WHERE user_id = ?', (user_id,)).fetchone()[0]
+
+    def add(self, sid: str, user: dict) -> bool:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute(
+                'INSERT OR REPLACE INTO presence_session'
+                ' (sid, host_id, user_id, username, profile_pic, color, connected)'
+                ' VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (sid, self.host_id, user['user_id'], user['username'],
+                 user['profile_pic'], user['color'], time.time())
+            )
+            first = self._user_session_count(conn, user['user_id']) == 1
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return first
+
+    def remove(self, sid: str) -> tuple[dict | None, bool]:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'DELETE FROM presence_session WHERE sid = ? RETURNING user_id, username, profile_pic, color',
+                (sid,)
+            ).fetchone()
+            last = row is not None and self._user_session_count(conn, row[0]) == 0
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return (self._as_user(row) if row else None), last
+
+    def online_users(self) -> list[dict]:
+        rows = self._connection().execute(
+            'SELECT s.user_id, s.username, s.profile_pic, s.color FROM presence_session s'
+            ' JOIN presence_host h ON h.host_id = s.host_id'
+            ' WHERE h.heartbeat >= ? GROUP BY s.user_id ORDER BY MIN(s.connected)',
+            (time.time() - self.host_timeout,)
+        ).fetchall()
+        return [_public(self._as_user(row)) for row in rows]
+
+    def sids_of(self, user_ids) -> list[str]:
+        user_ids = list(user_ids)
+        placeholders = ','.join('?' * len(user_ids))
+        return [sid for sid, in self._connection().execute(
+            f'SELECT sid FROM presence_session WHERE user_id IN ({placeholders})', user_ids
+        )]
+
+    def heartbeat(self) -> int:
+        """Refresh this worker's heartbeat and purge dead workers. Returns sessions purged."""
+        now = time.time()
+        conn = self._connection()
+        conn.execute('INSERT OR REPLACE INTO presence_host (host_id, heartbeat) VALUES (?, ?)',
+                     (self.host_id, now))
+        conn.execute('DELETE FROM presence_host WHERE heartbeat < ?', (now - self.host_timeout,))
+        return conn.execute(
+            'DELETE FROM presence_session WHERE host_id NOT IN (SELECT host_id FROM presence_host)'
+        ).rowcount
+
+    @staticmethod
+    def _as_user(row) -> dict:
+        user_id, username, profile_pic, color = row
+        return {'user_id': user_id, 'username': username, 'profile_pic': profile_pic, 'color': color}
+
+
+class PresenceRegistry:
+    def __init__(self):
+        self._store = LocalPresence()
+        self._generation = 0
+        self.on_purge = None
+
+    def init_app(self, app, host_id: str | None = None) -> None:
+        """Use the shared store when the Socket.IO bus is shared, else a local one."""
+        self._generation += 1
+        path = app.config.get('SOCKETIO_BUS_PATH')
+        if not path:
+            self._store = LocalPresence()
+            return
+
+        self._store = SQLitePresence(path, host_id, app.config['PRESENCE_HOST_TIMEOUT'])
+        socketio.start_background_task(
+            self._heartbeat_loop, self._generation, app.config['PRESENCE_HEARTBEAT_INTERVAL']
+        )
+
+    def _heartbeat_loop(self, generation: int, interval: float) -> None:
+        while generation == self._generation:
+            socketio.sleep(interval)
+            try:
+                if self._store.heartbeat() and self.on_purge is not None:
+                    self.on_purge()
+            except Exception as e:
+                print(f"[ERRORE PRESENCE] {str(e)}")
+
+    def add(self, sid: str, user: dict) -> bool:
+        """Register a chat session. True if it is the user's first one."""
+        return self._store.add(sid, user)
+
+    def remove(self, sid: str) -> tuple[dict | None, bool]:
+        """
+        Forget a session. Returns its user (None if it was not in the chat)
+        and whether it was the user's last session.
+        """
+        return self._store.remove(sid)
+
+    def online_users(self) -> list[dict]:
+        """Connected users, once each (shared, do not modify)."""
+        return self._store.online_users()
+
+    def sids_of(self, user_ids) -> list[str]:
+        """Every chat session of the given users, on any worker."""
+        if not user_ids:
+            return []
+        return self._store.sids_of(user_ids)
+
+
+presence = PresenceRegistry()
+
+
+class PresenceDeltas:
+    """
+    Coalesces joins and leaves over ``window`` seconds into one ``user_joined``
+    and one ``user_left`` event. A join and a leave of the same user inside
+    the window cancel out. ``window <= 0`` emits right away.
+    """
+
+    def __init__(self, emit, window: float = 0.25):
+        self._emit = emit
+        self.window = window
+        self._joined: dict[str, dict] = {}
+        self._left: set[str] = set()
+        self._armed = False
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.changes = 0
+
+    def init_app(self, app) -> None:
+        self.window = app.config['PRESENCE_COALESCE_WINDOW']
+
+    def stats(self) -> dict:
+        return {'window_ms': self.window * 1000, 'batches': self.batches, 'changes': self.changes}
+
+    def joined(self, user: dict) -> None:
+        with self._lock:
+            if user['username'] in self._left:
+                self._left.discard(user['username'])
+            else:
+                self._joined[user['username']] = {
+                    'username': user['username'],
+                    'profile_pic': user['profile_pic'],
+                    'color': user['color']
+                }
+        self._schedule()
+
+    def left(self, user: dict) -> None:
+        with self._lock:
+            if self._joined.pop(user['username'], None) is None:
+                self._left.add(user['username'])
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self.window <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._armed:
+                return
+            self._armed = True
+        socketio.start_background_task(self._flush_later)
+
+    def _flush_later(self) -> None:
+        socketio.sleep(self.window)
+        self.flush()
+
+    def flush(self) -> None:
+        with self._lock:
+            joined, self._joined = list(self._joined.values()), {}
+            left, self._left = sorted(self._left), set()
+            self._armed = False
+        if not joined and not left:
+            return
+        self.batches += 1
+        self.changes += len(joined) + len(left)
+        if joined:
+            self._emit('user_joined', {'users': joined})
+        if left:
+            self._emit('user_left', {'usernames': left})
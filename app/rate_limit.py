@@ -0,0 +1,176 @@
+"""
+Token-bucket rate limiting for socket events.
+
+Every user has a bucket of ``burst`` tokens refilled at ``rate`` tokens per
+second; an event is allowed when the bucket holds at least its cost. Costs
+differ per event (see :func:`event_cost`): a drawing is weighted by its size,
+a typing report is cheap.
+
+A bucket that has refilled completely behaves exactly like a missing one, so
+idle buckets are swept periodically and memory stays bounded by the users
+active in the last ``burst / rate`` seconds. With ``SOCKETIO_BUS_PATH`` set
+the buckets live in the shared SQLite file, so the limit holds across
+worker processes.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+# Base cost of each event; draw_message also pays for its size
+EVENT_COSTS = {
+    'message': 1.0,
+    'private_message': 1.0,
+    'draw_message': 1.0,
+    'typing': 0.1,
+}
+
+
+def event_cost(event: str, size: int = 0, bytes_per_token: int = 150_000) -> float:
+    """Tokens charged for ``event``; ``size`` is the payload length in bytes."""
+    cost = EVENT_COSTS.get(event, 1.0)
+    if event == 'draw_message' and bytes_per_token:
+        cost += size / bytes_per_token
+    return cost
+
+
+class LocalBuckets:
+    """Buckets of this process: ``{user_id: (tokens, updated)}``."""
+
+    def __init__(self):
+        self._buckets: dict[int, tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: int, cost: float, rate: float, burst: float, now: float) -> bool:
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            return allowed
+
+    def sweep(self, rate: float, burst: float, now: float) -> int:
+        with self._lock:
+            full = [key for key, (tokens, updated) in self._buckets.items()
+                    if tokens + (now - updated) * rate >= burst]
+            for key in full:
+                del self._buckets[key]
+            return len(full)
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._buckets.clear()
+
+
+class SQLiteBuckets:
+    """Buckets shared by every worker through a SQLite file."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS rate_bucket ('
+            ' user_id INTEGER PRIMARY KEY,'
+            ' tokens REAL NOT NULL,'
+            ' updated REAL NOT NULL)'
+        )
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def take(self, key: int, cost: float, rate: float, burst: float, now: float) -> bool:
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated FROM rate_bucket WHERE user_id = ?', (key,)).fetchone()
+            tokens, updated = row if row else (burst, now)
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            conn.execute('INSERT OR REPLACE INTO rate_bucket (user_id, tokens, updated) VALUES (?, ?, ?)',
+                         (key, tokens, now))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed
+
+    def sweep(self, rate: float, burst: float, now: float) -> int:
+        return self._connection().execute(
+            'DELETE FROM rate_bucket WHERE tokens + (? - updated) * ? >= ?', (now, rate, burst)
+        ).rowcount
+
+    def __len__(self) -> int:
+        return self._connection().execute('SELECT COUNT(*) FROM rate_bucket').fetchone()[0]
+
+    def clear(self) -> None:
+        self._connection().execute('DELETE FROM rate_bucket')
+
+
+class RateLimiter:
+    """Per-user token buckets with periodic eviction of idle ones."""
+
+    def __init__(self):
+        self.rate = 1.25
+        self.burst = 4.0
+        self.sweep_interval = 60.0
+        self.draw_bytes_per_token = 150_000
+        self._store = LocalBuckets()
+        self._next_sweep = 0.0
+        self._allowed = 0
+        self._denied = 0
+        self._swept = 0
+
+    def init_app(self, app) -> None:
+        self.rate = app.config['RATE_LIMIT_RATE']
+        self.burst = app.config['RATE_LIMIT_BURST']
+        self.sweep_interval = app.config['RATE_LIMIT_SWEEP_INTERVAL']
+        self.draw_bytes_per_token = app.config['RATE_LIMIT_DRAW_BYTES_PER_TOKEN']
+        path = app.config.get('SOCKETIO_BUS_PATH')
+        self._store = SQLiteBuckets(path) if path else LocalBuckets()
+        self._next_sweep = time.monotonic() + self.sweep_interval
+        self._allowed = self._denied = self._swept = 0
+
+    def allow(self, user_id: int, event: str = 'message', size: int = 0) -> bool:
+        """Charge ``event`` to ``user_id``'s bucket; False when it is empty."""
+        now = time.time()
+        if time.monotonic() >= self._next_sweep:
+            self._next_sweep = time.monotonic() + self.sweep_interval
+            self._swept += self._store.sweep(self.rate, self.burst, now)
+
+        # Never more than a full bucket, or the event could not be sent at all
+        cost = min(self.burst, event_cost(event, size, self.draw_bytes_per_token))
+        allowed = self._store.take(user_id, cost, self.rate, self.burst, now)
+        if allowed:
+            self._allowed += 1
+        else:
+            self._denied += 1
+        return allowed
+
+    def reset(self) -> None:
+        """Forget every bucket (tests)."""
+        self._store.clear()
+
+    def stats(self) -> dict:
+        return {
+            'buckets': len(self._store),
+            'allowed': self._allowed,
+            'denied': self._denied,
+            'swept': self._swept,
+        }
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,184 @@
+"""
+Retention policy for main chat messages, and database compaction.
+
+Messages older than ``RETENTION_DAYS`` days, or beyond the newest
+``RETENTION_MAX_MESSAGES``, move to the compressed archive
+(:mod:`app.archive`). The move is a purge job (:mod:`app.jobs`): each batch
+is written to the archive, then deleted from ``message`` in its own short
+transaction. The delete triggers take the rows out of the search index and
+the dashboard counters. The newest message always stays, so SQLite never
+hands out an archived id again.
+
+Every run ends with a compaction step. Once ``COMPACTION_MIN_FREE_RATIO``
+of the database is free pages, ``incremental_vacuum`` gives them back to the
+filesystem ``COMPACTION_STEP_PAGES`` pages at a time, each step a short
+write transaction. That needs a file in incremental auto-vacuum mode: new
+databases are created that way (``SQLITE_PRAGMAS``), older ones are
+converted once by ``flask archive-messages --compact``, the only path
+allowed the full ``VACUUM`` that holds the write lock for the whole
+rewrite. The space reclaimed is reported on the admin dashboard.
+
+With a policy set, a background task runs retention every
+``RETENTION_INTERVAL`` seconds. The archive file records the last run, so
+only one worker runs each time.
+"""
+import time
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, text, tuple_
+
+from .extensions import db, socketio
+from .models import Message
+from .history import recent_messages
+from .archive import message_archive
+from .jobs import jobs, PurgeStep, Job
+
+_COLUMNS = [c.key for c in Message.__table__.columns]
+
+
+class Retention:
+    def __init__(self):
+        self.app = None
+        self._generation = 0
+
+    def init_app(self, app) -> None:
+        self.app = app
+        self._generation += 1
+        interval = app.config['RETENTION_INTERVAL']
+        if interval and (app.config['RETENTION_DAYS'] or app.config['RETENTION_MAX_MESSAGES']):
+            socketio.start_background_task(self._loop, self._generation, interval)
+
+    def _loop(self, generation: int, interval: float) -> None:
+        # Wake up more often than the interval: another worker may have run it
+        while True:
+            socketio.sleep(min(interval, 60))
+            if generation != self._generation:
+                return
+            with self.app.app_context():
+                try:
+                    if message_archive.claim('retention', interval):
+                        self.run()
+                except Exception as e:
+                    print(f"[ERRORE RETENTION] {str(e)}")
+
+    def run(self, days: int | None = None, max_messages: int | None = None,
+            force_compaction: bool = False, convert: bool = False, inline: bool | None = None) -> Job:
+        """
+        Archive what the policy (or the given limits) excludes, then compact.
+        ``convert`` allows the one-time full ``VACUUM`` (CLI only).
+        """
+        days = current_app.config['RETENTION_DAYS'] if days is None else days
+        max_messages = current_app.config['RETENTION_MAX_MESSAGES'] if max_messages is None else max_messages
+        condition = expired_condition(days, max_messages)
+        steps = []
+        if condition is not None:
+            steps.append(PurgeStep('archived', Message, condition, _forget_recent, _archive))
+        return jobs.submit('retention', 'Archiviazione e compattazione', steps,
+                           lambda job: compact(force_compaction, convert), inline=inline)
+
+
+retention = Retention()
+
+
+def expired_condition(days: int, max_messages: int):
+    """Condition on ``Message`` for the rows to archive; None if none."""
+    conditions = []
+    if days:
+        conditions.append(Message.timestamp < datetime.now(timezone.utc) - timedelta(days=days))
+    if max_messages:
+        edge = db.session.execute(
+            select(Message.timestamp, Message.id)
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .offset(max_messages - 1).limit(1)
+        ).first()
+        if edge is not None:
+            conditions.append(tuple_(Message.timestamp, Message.id) < tuple(edge))
+    newest_id = db.session.scalar(select(func.max(Message.id)))
+    if not conditions or newest_id is None:
+        return None
+    return and_(or_(*conditions), Message.id < newest_id)
+
+
+def _archive(message_ids: list[int]) -> None:
+    rows = db.session.execute(select(Message.__table__).where(Message.id.in_(message_ids))).mappings()
+    message_archive.store([{key: row[key] for key in _COLUMNS} for row in rows])
+
+
+def _forget_recent(message_ids: list[int]) -> None:
+    # Only reachable with a tiny RETENTION_MAX_MESSAGES or an idle chat;
+    # clients keep showing them until they reload
+    for message_id in message_ids:
+        recent_messages.discard(message_id)
+
+
+def compact(force: bool = False, convert: bool = False) -> dict | None:
+    """
+    Give the free pages of the database back to the filesystem once they
+    reach ``COMPACTION_MIN_FREE_RATIO`` (always with ``force``). A file not in
+    incremental auto-vacuum mode is only compacted with ``convert``, by a
+    full ``VACUUM``. Returns and records the report, or None when nothing
+    was done.
+    """
+    if db.engine.dialect.name != 'sqlite':
+        return None
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        def pragma(name):
+            return conn.execute(text(f'PRAGMA {name}')).scalar()
+
+        # A pooled connection reports the header values it last read
+        # (auto_vacuum goes stale after a VACUUM elsewhere): read first
+        conn.execute(text('SELECT count(*) FROM sqlite_master')).scalar()
+        page_size, pages_before, free_pages = pragma('page_size'), pragma('page_count'), pragma('freelist_count')
+        if not free_pages:
+            return None
+        if not force and free_pages / pages_before < current_app.config['COMPACTION_MIN_FREE_RATIO']:
+            return None
+
+        incremental = pragma('auto_vacuum') == 2
+        if not incremental and not convert:
+            return None
+
+        started = time.perf_counter()
+        if not incremental:
+            # One full rewrite, which also turns on incremental auto-vacuum
+            conn.execute(text('PRAGMA auto_vacuum = INCREMENTAL'))
+            conn.execute(text('VACUUM'))
+            mode = 'vacuum'
+        else:
+            # Each step is its own short write transaction. executescript:
+            # a plain execute steps the pragma once, freeing a single page
+            step = current_app.config['COMPACTION_STEP_PAGES']
+            while pragma('freelist_count'):
+                conn.connection.driver_connection.executescript(f'PRAGMA incremental_vacuum({step})')
+                socketio.sleep(current_app.config['PURGE_BATCH_PAUSE'])
+            mode = 'incremental'
+        if pragma('journal_mode') == 'wal':
+            # Shrink the WAL file too, which the vacuum just filled
+            conn.execute(text('PRAGMA wal_checkpoint(TRUNCATE)')).fetchall()
+        pages_after = pragma('page_count')
+
+    report = {
+        'at': time.time(),
+        'mode': mode,
+        'bytes_before': pages_before * page_size,
+        'bytes_after': pages_after * page_size,
+        'reclaimed_bytes': (pages_before - pages_after) * page_size,
+        'duration_ms': round((time.perf_counter() - started) * 1000, 1),
+    }
+    message_archive.set_meta('last_compaction', report)
+    return report
+
+
+def incremental_compaction() -> bool:
+    """Whether the database can be compacted without a full ``VACUUM``."""
+    if db.engine.dialect.name != 'sqlite':
+        return False
+    with db.engine.connect() as conn:
+        # Refresh the header values first, as in compact()
+        conn.execute(text('SELECT count(*) FROM sqlite_master')).scalar()
+        return conn.execute(text('PRAGMA auto_vacuum')).scalar() == 2
+
+
+def last_compaction() -> dict | None:
+    return message_archive.get_meta('last_compaction')
@@ -1,10 +1,29 @@
+from datetime import datetime, timedelta
 from functools import wraps
+from types import SimpleNamespace
 
-from flask import Blueprint, render_template, redirect, url_for, flash, request, abort
+from flask import (
+    Blueprint, render_template, redirect, url_for, flash, request, abort, jsonify, current_app,
+    Response, stream_with_context
+)
 from flask_login import login_required, current_user
 
 from ..extensions import db
 from ..models import User, Message
+from ..history import recent_messages
+from ..write_behind import message_writer
+from ..bus import publish
+from ..sockets import presence_deltas, typing_users
+from ..rate_limit import rate_limiter
+from ..identity import identity_cache
+from ..passwords import password_hasher
+from ..search import search_messages
+from ..pagination import keyset_page
+from ..counters import row_counts
+from ..jobs import jobs, purge_user, purge_messages
+from ..archive import message_archive
+from ..retention import retention, last_compaction, incremental_compaction
+from ..export import export_records, ndjson_chunks, KINDS
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -20,46 +39,82 @@ def admin_required(f):
     return decorated_function
 
 
+def _keyset_links(page, endpoint: str, label: str | None = None, **args) -> SimpleNamespace:
+    """Previous/next links of a keyset page for the pagination bar."""
+    return SimpleNamespace(
+        label=label,
+        prev_url=url_for(endpoint, after=page.prev_cursor, **args) if page.has_prev else None,
+        next_url=url_for(endpoint, before=page.next_cursor, **args) if page.has_next else None
+    )
+
+
 @admin_bp.route('/')
 @admin_required
 def dashboard():
     """Admin dashboard with stats."""
-    user_count = User.query.count()
-    message_count = Message.query.count()
-    admin_count = User.query.filter_by(is_admin=True).count()
+    counts = row_counts()
+    compaction = last_compaction()
     
     # Recent users (last 5)
     recent_users = User.query.order_by(User.registered_on.desc()).limit(5).all()
     
     return render_template(
         'admin/dashboard.html',
-        user_count=user_count,
-        message_count=message_count,
-        admin_count=admin_count,
+        jobs=jobs.recent(),
+        archive_stats=message_archive.stats(),
+        compaction=compaction,
+        compaction_at=datetime.fromtimestamp(compaction['at']) if compaction else None,
+        compaction_ready=incremental_compaction(),
+        retention_policy={'days': current_app.config['RETENTION_DAYS'],
+                          'max_messages': current_app.config['RETENTION_MAX_MESSAGES']},
+        user_count=counts['users'],
+        message_count=counts['messages'],
+        admin_count=counts['admins'],
         recent_users=recent_users
     )
 
 
+@admin_bp.route('/metrics')
+@admin_required
+def metrics():
+    """Runtime metrics of the in-process chat subsystems (JSON)."""
+    return jsonify({
+        'write_behind': message_writer.stats(),
+        'presence_deltas': presence_deltas.stats(),
+        'typing': typing_users.stats(),
+        'rate_limit': rate_limiter.stats(),
+        'identity_cache': identity_cache.stats(),
+        'password_hashing': password_hasher.stats(),
+        'jobs': jobs.stats(),
+        'archive': message_archive.stats(),
+        'last_compaction': last_compaction()
+    })
+
+
 @admin_bp.route('/users')
 @admin_required
 def users():
     """List all users with search/filter."""
     search = request.args.get('search', '').strip().lower()
-    page = request.args.get('page', 1, type=int)
     per_page = 20
-    
+
     query = User.query
     if search:
         query = query.filter(User.username.contains(search))
-    
-    users_pagination = query.order_by(User.registered_on.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
+
+    page = keyset_page(
+        query, User, User.registered_on,
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        per_page=per_page
     )
-    
+
     return render_template(
         'admin/users.html',
-        users=users_pagination.items,
-        pagination=users_pagination,
+        users=page.items,
+        pagination=_keyset_links(
+            page, 'admin.users', None if search else f"{row_counts()['users']} utenti", search=search
+        ),
         search=search
     )
 
@@ -90,7 +145,7 @@ def toggle_admin(user_id):
 @admin_bp.route('/users/<int:user_id>/delete', methods=['POST'])
 @admin_required
 def delete_user(user_id):
-    """Delete a user."""
+    """Delete a user and everything they wrote (in the background)."""
     user = db.get_or_404(User, user_id)
     
     # Prevent self-deletion
@@ -99,15 +154,13 @@ def delete_user(user_id):
         return redirect(url_for('admin.users'))
     
     username = user.username
-    try:
-        # Delete user's messages
-        Message.query.filter_by(username=username).delete()
-        db.session.delete(user)
-        db.session.commit()
+    job = purge_user(user)
+    if job.state == 'done':
         flash(f'Utente {username} eliminato!', 'success')
-    except Exception as e:
-        db.session.rollback()
+    elif job.state == 'failed':
         flash('Errore durante l\'eliminazione.', 'danger')
+    else:
+        flash(f'Eliminazione di {username} avviata: l\'avanzamento è nella dashboard.', 'info')
     
     return redirect(url_for('admin.users'))
 
@@ -115,39 +168,158 @@ def delete_user(user_id):
 @admin_bp.route('/messages')
 @admin_required
 def messages():
-    """View all messages with pagination."""
+    """View all messages with pagination; searches go through the full-text index."""
     search = request.args.get('search', '').strip()
-    page = request.args.get('page', 1, type=int)
     per_page = 50
-    
-    query = Message.query
+
     if search:
-        query = query.filter(
-            (Message.username.contains(search.lower())) | 
-            (Message.content.contains(search))
+        # Relevance-ordered results have no cursor: they keep numbered pages
+        page = max(request.args.get('page', 1, type=int), 1)
+        items, highlights, has_more = search_messages(search, per_page, (page - 1) * per_page)
+        pagination = SimpleNamespace(
+            label=f'Pagina {page}',
+            prev_url=url_for('admin.messages', page=page - 1, search=search) if page > 1 else None,
+            next_url=url_for('admin.messages', page=page + 1, search=search) if has_more else None
         )
-    
-    messages_pagination = query.order_by(Message.timestamp.desc()).paginate(
-        page=page, per_page=per_page, error_out=False
-    )
-    
+    else:
+        keyset = keyset_page(
+            Message.query, Message, Message.timestamp,
+            before=request.args.get('before', type=int),
+            after=request.args.get('after', type=int),
+            per_page=per_page
+        )
+        items, highlights = keyset.items, {}
+        pagination = _keyset_links(keyset, 'admin.messages', f"{row_counts()['messages']} messaggi")
+
     return render_template(
         'admin/messages.html',
-        messages=messages_pagination.items,
-        pagination=messages_pagination,
+        messages=items,
+        highlights=highlights,
+        pagination=pagination,
         search=search
     )
 
 
+@admin_bp.route('/messages/purge', methods=['POST'])
+@admin_required
+def purge_messages_view():
+    """Delete every message matching the filters, in the background."""
+    username = request.form.get('username', '').strip().lower()
+    search = request.form.get('search', '').strip()
+    try:
+        since = _parse_day(request.form.get('since'))
+        until = _parse_day(request.form.get('until'))
+    except ValueError:
+        flash('Data non valida.', 'danger')
+        return redirect(url_for('admin.messages'))
+
+    user = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            flash(f'Utente {username} non trovato.', 'danger')
+            return redirect(url_for('admin.messages'))
+    if user is None and since is None and until is None and not search:
+        flash('Indica almeno un filtro per l\'eliminazione.', 'danger')
+        return redirect(url_for('admin.messages'))
+
+    # The "until" day is included
+    job = purge_messages(user, since, until + timedelta(days=1) if until else None, search)
+    if job.state == 'done':
+        flash(f'{job.done} messaggi eliminati.', 'success')
+    elif job.state == 'failed':
+        flash('Errore durante l\'eliminazione.', 'danger')
+    else:
+        flash(f'Eliminazione di {job.total} messaggi avviata: l\'avanzamento è nella dashboard.', 'info')
+    return redirect(url_for('admin.messages'))
+
+
+def _parse_day(value: str | None) -> datetime | None:
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+
+@admin_bp.route('/archive')
+@admin_required
+def archive():
+    """Browse the archived messages by user and date range."""
+    username = request.args.get('username', '').strip().lower()
+    try:
+        since = _parse_day(request.args.get('since'))
+        until = _parse_day(request.args.get('until'))
+    except ValueError:
+        flash('Data non valida.', 'danger')
+        return redirect(url_for('admin.archive'))
+
+    page = message_archive.page(
+        username or None, since, until + timedelta(days=1) if until else None,
+        before=request.args.get('before', type=int),
+        after=request.args.get('after', type=int),
+        per_page=50
+    )
+    filters = {'username': username, 'since': request.args.get('since', ''),
+               'until': request.args.get('until', '')}
+    stats = message_archive.stats()
+    return render_template(
+        'admin/archive.html',
+        messages=page.items,
+        pagination=_keyset_links(
+            page, 'admin.archive', None if any(filters.values()) else f"{stats['messages']} messaggi archiviati",
+            **{key: value for key, value in filters.items() if value}
+        ),
+        filters=filters,
+        stats=stats
+    )
+
+
+@admin_bp.route('/retention/run', methods=['POST'])
+@admin_required
+def run_retention():
+    """Apply the retention policy and compact the database now."""
+    job = retention.run(force_compaction=True)
+    if job.state == 'done':
+        flash(f'{job.done} messaggi archiviati.', 'success')
+    elif job.state == 'failed':
+        flash('Errore durante l\'archiviazione.', 'danger')
+    else:
+        flash('Archiviazione avviata: l\'avanzamento è nella dashboard.', 'info')
+    return redirect(url_for('admin.dashboard'))
+
+
+@admin_bp.route('/export')
+@admin_required
+def export_history():
+    """Stream the chat and private message history as NDJSON (``?gzip=1`` compressed)."""
+    kinds = [kind for kind in request.args.getlist('type') if kind in KINDS] or KINDS
+    compress = request.args.get('gzip') == '1'
+    filename = f"history-{datetime.now():%Y%m%d-%H%M%S}.ndjson" + ('.gz' if compress else '')
+    return Response(
+        stream_with_context(ndjson_chunks(export_records(kinds), compress)),
+        mimetype='application/gzip' if compress else 'application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+@admin_bp.route('/jobs')
+@admin_required
+def jobs_status():
+    """Progress of the recent purge jobs (JSON)."""
+    return jsonify([job.as_dict() for job in jobs.recent()])
+
+
 @admin_bp.route('/messages/<int:message_id>/delete', methods=['POST'])
 @admin_required
 def delete_message(message_id):
     """Delete a single message."""
-    message = db.get_or_404(Message, message_id)
-    
+    # With write-behind the message may still be waiting in the queue
+    if message_writer.pending(message_id) is None:
+        db.get_or_404(Message, message_id)
+
     try:
-        db.session.delete(message)
+        if not message_writer.withdraw(message_id):
+            Message.query.filter_by(id=message_id).delete()
         db.session.commit()
+        recent_messages.discard(message_id)
+        publish('chat_message_removed', message_id)
         flash('Messaggio eliminato!', 'success')
     except Exception as e:
         db.session.rollback()
@@ -1,16 +1,21 @@
 import re
+import secrets
 from flask import Blueprint, render_template, request, redirect, url_for, flash, session
 from flask_login import login_user, logout_user, login_required, current_user
 
 from ..extensions import db
 from ..models import User
 from ..config import Config
+from ..sockets import revoke_sessions
+from ..passwords import HasherBusy
 
 auth_bp = Blueprint('auth', __name__)
 
 # Allowed username pattern: letters, numbers, underscores only
 _USERNAME_RE = re.compile(r'^[a-z0-9_]+$')
 
+_BUSY_MSG = 'Troppe richieste in corso, riprova tra qualche secondo.'
+
 
 def _validate_username(username: str) -> str | None:
     """Return an error string if invalid, else None."""
@@ -59,7 +64,11 @@ def register():
             return redirect(url_for('auth.register'))
 
         user = User(username=username)
-        user.set_password(password)
+        try:
+            user.set_password(password)
+        except HasherBusy:
+            flash(_BUSY_MSG, 'danger')
+            return render_template('register.html'), 503
         user.refresh_session_token()
         db.session.add(user)
         try:
@@ -81,7 +90,12 @@ def login():
         password = request.form.get('password', '').strip()
 
         user = User.query.filter_by(username=username).first()
-        if user and user.check_password(password):
+        try:
+            valid = user is not None and user.check_password(password)
+        except HasherBusy:
+            flash(_BUSY_MSG, 'danger')
+            return render_template('login.html'), 503
+        if valid:
             user.refresh_session_token()
             try:
                 db.session.commit()
@@ -90,6 +104,9 @@ def login():
                 print(f"[ERRORE LOGIN COMMIT] {str(e)}")
                 flash('Errore interno.', 'danger')
                 return redirect(url_for('auth.login'))
+            # Identifies this browser's sockets, which the new session keeps
+            client_id = session.setdefault('client_id', secrets.token_hex(8))
+            revoke_sessions(user.id, client_id)
 
             session['session_token'] = user.session_token
             login_user(user, remember=False)
@@ -103,12 +120,14 @@ def login():
 @auth_bp.route('/logout')
 @login_required
 def logout():
-    current_user.session_token = None
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"[ERRORE LOGOUT] {str(e)}")
+    # A session kicked by a newer login must not revoke that login in turn
+    if session.get('session_token') == current_user.session_token:
+        current_user.session_token = None
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            print(f"[ERRORE LOGOUT] {str(e)}")
     logout_user()
     session.clear()
     flash('Logout effettuato.', 'info')
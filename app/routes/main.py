@@ -1,15 +1,18 @@
 import os
-import json
 import secrets
 from datetime import datetime, timezone
 
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, send_from_directory, send_file, current_app, abort
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 
 from ..extensions import db
 from ..models import User, Message, BlockedUser, PICTOFLASK_COLORS
 from ..utils import allowed_file
+from ..drawings import drawing_path, parse_drawing_filename
+from ..blocks import block_index
+from ..bus import publish
+from ..history import fetch_history_page, payload_json, recent_messages, HISTORY_PAGE_SIZE
 import re
 
 main_bp = Blueprint('main', __name__)
@@ -20,44 +23,32 @@ main_bp = Blueprint('main', __name__)
 def index():
     session['session_token'] = current_user.session_token
 
-    blocked_ids = {b.blocked_id for b in BlockedUser.query.filter_by(blocker_id=current_user.id).all()}
-    messages = Message.query.order_by(Message.timestamp.asc()).limit(100).all()
-    
-    usernames = list(set(msg.username for msg in messages))
-    users = User.query.filter(User.username.in_(usernames)).all()
-    user_colors = {u.username: u.chat_color or '#61829a' for u in users}
-
-    history_list = [
-        {
-            'id': msg.id,
-            'user_id': msg.user_id,
-            'username': msg.username,
-            'msg': msg.content,
-            'time': msg.timestamp.strftime("%H:%M"),
-            'profile_pic': msg.profile_pic,
-            'color': user_colors.get(msg.username, '#61829a'),
-            'image_data': msg.image_data or None
-        }
-        for msg in messages
-        if msg.user_id not in blocked_ids
-    ]
-
-    history_json = json.dumps(history_list, ensure_ascii=False)
+    blocked_ids = block_index.blocked_ids(current_user.id)
+    history_json, has_more = recent_messages.page_json(blocked_ids)
+    if not recent_messages.ready or (has_more and history_json == '[]'):
+        history_list, has_more = fetch_history_page(blocked_ids=blocked_ids)
+        history_json = '[' + ','.join(payload_json(p) for p in history_list) + ']'
 
     return render_template(
         'index.html', 
         history_json=history_json,
+        history_has_more=has_more,
         current_user_color=current_user.chat_color or '#61829a',
         is_admin=current_user.is_admin
     )
 
 
-@main_bp.route('/check_session')
+@main_bp.route('/history')
 @login_required
-def check_session():
-    if session.get('session_token') != current_user.session_token:
-        return jsonify({'valid': False})
-    return jsonify({'valid': True})
+def history():
+    """Older chat messages, newest-first pages keyed on ``before_id``."""
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', HISTORY_PAGE_SIZE, type=int)
+
+    blocked_ids = block_index.blocked_ids(current_user.id)
+    messages, has_more = fetch_history_page(before_id, limit, blocked_ids)
+
+    return jsonify({'messages': messages, 'has_more': has_more})
 
 
 @main_bp.route('/profile', methods=['GET', 'POST'])
@@ -100,6 +91,8 @@ def profile():
                 current_user.chat_color = new_color
                 try:
                     db.session.commit()
+                    recent_messages.recolor(current_user.id, new_color)
+                    publish('user_recolored', {'user_id': current_user.id, 'color': new_color})
                     flash('Colore chat aggiornato!', 'success')
                 except Exception as e:
                     db.session.rollback()
@@ -145,10 +138,7 @@ def profile():
 def public_profile(username):
     user = User.query.filter_by(username=username.lower()).first_or_404()
     is_own_profile = (user.id == current_user.id)
-    is_blocked = BlockedUser.query.filter_by(
-        blocker_id=current_user.id, 
-        blocked_id=user.id
-    ).first() is not None
+    is_blocked = block_index.is_blocked(user.id, by_user_id=current_user.id)
 
     days_until_next_change = None
     if user.last_username_change:
@@ -222,3 +212,29 @@ def unblock_user(user_id):
 @main_bp.route('/uploads/profiles/<filename>')
 def uploaded_file(filename):
     return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+
+
+@main_bp.route('/drawings/<filename>')
+@login_required
+def drawing(filename):
+    """Serve a stored drawing. Blobs are content-addressed, so never change."""
+    parsed = parse_drawing_filename(filename)
+    if parsed is None:
+        abort(404)
+    digest, ext = parsed
+
+    path = drawing_path(filename)
+    if not os.path.exists(path):
+        abort(404)
+
+    response = send_file(
+        path,
+        mimetype='image/png' if ext == 'png' else 'image/jpeg',
+        etag=digest,
+        max_age=current_app.config['DRAWINGS_CACHE_MAX_AGE'],
+        conditional=True
+    )
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
@@ -1,64 +1,52 @@
 from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy import or_, and_, func
-
-from ..extensions import db
-from ..models import User, PrivateMessage, BlockedUser
+from sqlalchemy.orm import contains_eager
+
+from ..extensions import db, socketio
+from ..models import User, PrivateMessage, Conversation
+from ..conversations import (
+    record_private_message, mark_conversation_read, get_unread_total,
+    serialize_private_message, between, fetch_conversation_page, get_peer_read_mark,
+    CONVERSATION_PAGE_SIZE
+)
+from ..sockets import notify_private_message, push_unread_count, notify_read_receipt
+from ..blocks import block_index
 
 messages_bp = Blueprint('messages', __name__, url_prefix='/messages')
 
+# Upper bound for one delta response; clients ask again while has_more is set
+DELTA_MAX_MESSAGES = 100
+
 
 def get_unread_count(user_id):
-    return PrivateMessage.query.filter_by(
-        recipient_id=user_id,
-        is_read=False
-    ).count()
+    return get_unread_total(user_id)
+
+
+def _mark_read(peer_id, up_to_id=None):
+    """Advance the current user's read mark; push counter and receipt if it moved."""
+    last_read_id = mark_conversation_read(current_user.id, peer_id, up_to_id)
+    if last_read_id is None:
+        return
+    db.session.commit()
+    push_unread_count(current_user.id)
+    notify_read_receipt(peer_id, current_user.id, last_read_id)
 
 
 @messages_bp.route('/')
 @login_required
 def inbox():
-    subquery = db.session.query(
-        func.max(PrivateMessage.id).label('max_id'),
-        db.case(
-            (PrivateMessage.sender_id == current_user.id, PrivateMessage.recipient_id),
-            else_=PrivateMessage.sender_id
-        ).label('other_user_id')
-    ).filter(
-        or_(
-            PrivateMessage.sender_id == current_user.id,
-            PrivateMessage.recipient_id == current_user.id
-        )
-    ).group_by('other_user_id').subquery()
-
-    conversations = db.session.query(
-        PrivateMessage,
-        User
+    conversations = Conversation.query.filter_by(
+        owner_id=current_user.id
     ).join(
-        subquery,
-        PrivateMessage.id == subquery.c.max_id
-    ).join(
-        User,
-        User.id == subquery.c.other_user_id
-    ).order_by(PrivateMessage.timestamp.desc()).all()
-
-    conversation_list = []
-    for msg, user in conversations:
-        unread = PrivateMessage.query.filter_by(
-            sender_id=user.id,
-            recipient_id=current_user.id,
-            is_read=False
-        ).count()
-        conversation_list.append({
-            'user': user,
-            'last_message': msg,
-            'unread_count': unread
-        })
+        Conversation.peer
+    ).options(
+        contains_eager(Conversation.peer)
+    ).order_by(Conversation.last_timestamp.desc()).all()
 
     return render_template(
         'messages/inbox.html',
-        conversations=conversation_list,
-        total_unread=get_unread_count(current_user.id)
+        conversations=conversations,
+        total_unread=sum(conv.unread_count for conv in conversations)
     )
 
 
@@ -71,42 +59,71 @@ def conversation(user_id):
         flash('Non puoi inviare messaggi a te stesso!', 'warning')
         return redirect(url_for('messages.inbox'))
     
-    is_blocked_by = BlockedUser.query.filter_by(
-        blocker_id=user_id, blocked_id=current_user.id
-    ).first() is not None
+    is_blocked_by = block_index.is_blocked(current_user.id, by_user_id=user_id)
     
     if is_blocked_by:
         flash('Non puoi inviare messaggi a questo utente.', 'danger')
         return redirect(url_for('messages.inbox'))
 
-    messages = PrivateMessage.query.filter(
-        or_(
-            and_(
-                PrivateMessage.sender_id == current_user.id,
-                PrivateMessage.recipient_id == user_id
-            ),
-            and_(
-                PrivateMessage.sender_id == user_id,
-                PrivateMessage.recipient_id == current_user.id
-            )
-        )
-    ).order_by(PrivateMessage.timestamp.asc()).all()
-
-    PrivateMessage.query.filter_by(
-        sender_id=user_id,
-        recipient_id=current_user.id,
-        is_read=False
-    ).update({'is_read': True})
-    db.session.commit()
+    messages, has_more = fetch_conversation_page(current_user.id, user_id)
+
+    _mark_read(user_id)
 
     return render_template(
         'messages/conversation.html',
         other_user=other_user,
         messages=messages,
+        has_more=has_more,
+        peer_last_read_id=get_peer_read_mark(current_user.id, user_id),
         total_unread=get_unread_count(current_user.id)
     )
 
 
+@messages_bp.route('/conversation/<int:user_id>/history')
+@login_required
+def conversation_history(user_id):
+    """Older pages of a conversation (JSON), keyed on ``before_id``."""
+    before_id = request.args.get('before_id', type=int)
+    limit = request.args.get('limit', CONVERSATION_PAGE_SIZE, type=int)
+
+    if block_index.is_blocked(current_user.id, by_user_id=user_id):
+        return jsonify({'success': False, 'error': 'Non puoi inviare messaggi a questo utente'}), 403
+
+    messages, has_more = fetch_conversation_page(current_user.id, user_id, before_id, limit)
+    return jsonify({
+        'success': True,
+        'messages': [serialize_private_message(msg) for msg in messages],
+        'has_more': has_more
+    })
+
+
+@messages_bp.route('/conversation/<int:user_id>/since')
+@login_required
+def conversation_since(user_id):
+    """Messages of a conversation newer than ``since_id`` (JSON), marking them read."""
+    since_id = request.args.get('since_id', 0, type=int)
+
+    if block_index.is_blocked(current_user.id, by_user_id=user_id):
+        return jsonify({'success': False, 'error': 'Non puoi inviare messaggi a questo utente'}), 403
+
+    messages = PrivateMessage.query.filter(
+        between(current_user.id, user_id),
+        PrivateMessage.id > since_id
+    ).order_by(PrivateMessage.id.asc()).limit(DELTA_MAX_MESSAGES + 1).all()
+    has_more = len(messages) > DELTA_MAX_MESSAGES
+    messages = messages[:DELTA_MAX_MESSAGES]
+
+    # Only what is returned counts as read
+    if any(msg.sender_id == user_id for msg in messages):
+        _mark_read(user_id, up_to_id=messages[-1].id)
+
+    return jsonify({
+        'success': True,
+        'messages': [serialize_private_message(msg) for msg in messages],
+        'has_more': has_more
+    })
+
+
 @messages_bp.route('/send/<int:user_id>', methods=['POST'])
 @login_required
 def send_message(user_id):
@@ -115,12 +132,10 @@ def send_message(user_id):
     if other_user.id == current_user.id:
         return jsonify({'success': False, 'error': 'Non puoi inviare messaggi a te stesso'}), 400
     
-    is_blocked = BlockedUser.query.filter(
-        or_(
-            and_(BlockedUser.blocker_id == current_user.id, BlockedUser.blocked_id == user_id),
-            and_(BlockedUser.blocker_id == user_id, BlockedUser.blocked_id == current_user.id)
-        )
-    ).first() is not None
+    is_blocked = (
+        block_index.is_blocked(user_id, by_user_id=current_user.id)
+        or block_index.is_blocked(current_user.id, by_user_id=user_id)
+    )
     
     if is_blocked:
         return jsonify({'success': False, 'error': 'Non puoi inviare messaggi a questo utente'}), 403
@@ -137,20 +152,26 @@ def send_message(user_id):
     db.session.add(message)
     
     try:
+        db.session.flush()
+        record_private_message(message)
         db.session.commit()
-        return jsonify({
-            'success': True,
-            'message': {
-                'id': message.id,
-                'content': message.content,
-                'timestamp': message.timestamp.strftime('%H:%M'),
-                'sender_id': message.sender_id
-            }
-        })
     except Exception as e:
         db.session.rollback()
         return jsonify({'success': False, 'error': 'Errore nel salvataggio'}), 500
 
+    # The message is saved: a failed push must not make the client resend it
+    payload = serialize_private_message(message)
+    try:
+        socketio.emit('pm_received', payload, to=f"user_{user_id}", namespace='/')
+        notify_private_message(user_id, current_user.username)
+    except Exception as e:
+        print(f"[ERRORE NOTIFICA PM] {str(e)}")
+
+    return jsonify({
+        'success': True,
+        'message': payload
+    })
+
 
 @messages_bp.route('/new/<username>')
 @login_required
@@ -0,0 +1,140 @@
+"""
+Full-text search over main chat messages for the admin panel.
+
+On SQLite the ``message_fts`` FTS5 table indexes ``message.content`` and
+``message.username`` as an external-content index: it stores only the
+inverted index, and triggers on ``message`` keep it in sync with every write
+path (socket handlers, write-behind batches, admin deletes). Searches are
+ranked with bm25 among the newest ``SEARCH_RANK_WINDOW`` hits and return
+highlighted content.
+
+Other databases, or SQLite builds without FTS5, fall back to the substring
+``LIKE`` scan.
+"""
+import re
+
+from flask import current_app
+from markupsafe import Markup, escape
+from sqlalchemy import column, false, or_, text
+
+from .extensions import db
+from .models import Message
+
+# Control characters never typed in chat: highlight() wraps hits in them and
+# they become <mark> only after the content has been escaped
+_HIT_START, _HIT_END = '\x02', '\x03'
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+_SCHEMA = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS message_fts USING fts5("
+    " content, username, content='message', content_rowid='id',"
+    " tokenize='unicode61 remove_diacritics 2')",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_insert AFTER INSERT ON message BEGIN"
+    " INSERT INTO message_fts (rowid, content, username) VALUES (new.id, new.content, new.username);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_delete AFTER DELETE ON message BEGIN"
+    " INSERT INTO message_fts (message_fts, rowid, content, username)"
+    " VALUES ('delete', old.id, old.content, old.username);"
+    " END",
+    "CREATE TRIGGER IF NOT EXISTS message_fts_update AFTER UPDATE OF content, username ON message BEGIN"
+    " INSERT INTO message_fts (message_fts, rowid, content, username)"
+    " VALUES ('delete', old.id, old.content, old.username);"
+    " INSERT INTO message_fts (rowid, content, username) VALUES (new.id, new.content, new.username);"
+    " END",
+)
+
+
+def ensure_search_index(app) -> bool:
+    """Create the FTS index (and index existing rows) if missing. Needs an app context."""
+    available = False
+    if db.engine.dialect.name == 'sqlite':
+        try:
+            with db.engine.begin() as conn:
+                exists = conn.execute(text(
+                    "SELECT 1 FROM sqlite_master WHERE name = 'message_fts'"
+                )).first()
+                for statement in _SCHEMA:
+                    conn.execute(text(statement))
+                if not exists:
+                    conn.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+            available = True
+        except Exception as e:
+            print(f"[ERRORE INDICE RICERCA] {str(e)}")
+    app.extensions['message_search'] = available
+    return available
+
+
+def match_expression(search: str) -> str | None:
+    """FTS5 query for the words of ``search``: all of them, each as a prefix."""
+    terms = _TERM_RE.findall(search)
+    if not terms:
+        return None
+    return ' '.join('"' + term.replace('"', '""') + '"*' for term in terms)
+
+
+def highlight(content: str) -> Markup:
+    """Escape ``content`` and turn the FTS5 hit markers into <mark> tags."""
+    return escape(content).replace(_HIT_START, Markup('<mark>')).replace(_HIT_END, Markup('</mark>'))
+
+
+def search_messages(search: str, limit: int, offset: int = 0) -> tuple[list[Message], dict[int, Markup], bool]:
+    """
+    One page of messages matching ``search``: the newest ``SEARCH_RANK_WINDOW``
+    hits best matches first, then the older ones newest first. Returns the
+    messages, their highlighted content by id and whether more results follow.
+    """
+    if not current_app.extensions.get('message_search'):
+        return _like_search(search, limit, offset)
+
+    expression = match_expression(search)
+    if expression is None:
+        return [], {}, False
+    # bm25 over every hit of a common word costs a full doclist walk: rank
+    # only the newest SEARCH_RANK_WINDOW hits, which FTS5 reads in rowid order.
+    # Highlight in the same pass, a second MATCH would pay the prefix merge again
+    window = current_app.config['SEARCH_RANK_WINDOW']
+    params = {'start': _HIT_START, 'end': _HIT_END, 'expression': expression, 'window': window}
+    rows = []
+    if offset < window:
+        rows = db.session.execute(text(
+            "SELECT id, marked FROM ("
+            " SELECT rowid AS id, bm25(message_fts, 1.0, 2.0) AS score,"
+            " highlight(message_fts, 0, :start, :end) AS marked FROM message_fts"
+            " WHERE message_fts MATCH :expression ORDER BY rowid DESC LIMIT :window"
+            ") ORDER BY score, id DESC LIMIT :limit OFFSET :offset"
+        ), params | {'limit': limit + 1, 'offset': offset}).all()
+    if len(rows) <= limit and offset + limit + 1 > window:
+        # Past the window the hits follow unranked, so every match of
+        # search_filter() can be reached
+        rows += db.session.execute(text(
+            "SELECT rowid AS id, highlight(message_fts, 0, :start, :end) AS marked FROM message_fts"
+            " WHERE message_fts MATCH :expression ORDER BY rowid DESC LIMIT :limit OFFSET :offset"
+        ), params | {'limit': limit + 1 - len(rows), 'offset': max(offset, window)}).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    by_id = {m.id: m for m in Message.query.filter(Message.id.in_([r.id for r in rows]))}
+    messages = [by_id[r.id] for r in rows if r.id in by_id]
+    return messages, {r.id: highlight(r.marked) for r in rows}, has_more
+
+
+def search_filter(search: str):
+    """Condition on ``Message`` selecting every message search_messages() pages through."""
+    if not current_app.extensions.get('message_search'):
+        return _like_filter(search)
+    expression = match_expression(search)
+    if expression is None:
+        return false()
+    return Message.id.in_(
+        text("SELECT rowid FROM message_fts WHERE message_fts MATCH :expression")
+        .bindparams(expression=expression).columns(column('rowid'))
+    )
+
+
+def _like_filter(search: str):
+    return or_(Message.username.contains(search.lower()), Message.content.contains(search))
+
+
+def _like_search(search: str, limit: int, offset: int):
+    messages = Message.query.filter(_like_filter(search)).order_by(Message.timestamp.desc()).offset(offset).limit(limit + 1).all()
+    return messages[:limit], {}, len(messages) > limit
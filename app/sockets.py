@@ -1,90 +1,211 @@
-import base64
-from datetime import datetime, timezone
 from flask import session, request
 from flask_socketio import emit, join_room
 from flask_login import current_user, login_required
+from sqlalchemy import update, func
 
 from .extensions import db, socketio
 from .models import Message, PrivateMessage, BlockedUser, User
 from .utils import check_rate_limit
+from .drawings import store_drawing, InvalidDrawing
+from .history import serialize_message, recent_messages
+from .write_behind import message_writer
+from .blocks import block_index
+from .conversations import record_private_message, get_unread_total, serialize_private_message
+from .presence import presence, PresenceDeltas
+from .typing_indicator import TypingAggregator
+from .bus import subscribe, publish
+from .identity import identity_cache
 
 # Max size for a drawing canvas image (base64 PNG, ~300 KB raw ≈ 400 KB b64)
 _MAX_IMAGE_B64 = 450_000
 
 
 def is_blocked(user_id, target_id):
-    return BlockedUser.query.filter_by(blocker_id=target_id, blocked_id=user_id).first() is not None
+    return block_index.is_blocked(user_id, by_user_id=target_id)
 
 
 def get_blocked_ids(user_id):
-    blocked = BlockedUser.query.filter_by(blocker_id=user_id).all()
-    return {b.blocked_id for b in blocked}
+    return block_index.blocked_ids(user_id)
 
 ROOM = "main_chat"
-online_users = {}
-user_sid_map = {}
+
+
+def broadcast_chat_message(payload):
+    """
+    Emit a main chat message to the room, skipping the sessions of users who
+    blocked its author. Nobody blocking the author is the common, free case.
+    """
+    blockers = block_index.blockers_of(payload['user_id'])
+    skip_sids = presence.sids_of(blockers)
+    if not skip_sids:
+        emit('message', payload, room=ROOM)
+    else:
+        emit('message', payload, room=ROOM, skip_sid=skip_sids)
+
+
+def retract_chat_messages(message_ids):
+    """Withdraw broadcast messages that could not be saved."""
+    for message_id in message_ids:
+        recent_messages.discard(message_id)
+        socketio.emit('message_deleted', {'message_id': message_id}, to=ROOM, namespace='/')
+
+
+message_writer.on_drop = retract_chat_messages
+
+
+def save_chat_message(new_message, log_tag, error_msg):
+    """
+    Persist a main chat message and bump the author's message count.
+    With write-behind enabled the message is only queued (it already has its
+    id afterwards). Returns False after notifying the sender on failure.
+    """
+    if message_writer.enabled:
+        message_writer.submit(new_message)
+        return True
+
+    db.session.add(new_message)
+    # current_user is a cached snapshot here: increment in SQL
+    db.session.execute(
+        update(User)
+        .where(User.id == current_user.id)
+        .values(message_count=func.coalesce(User.message_count, 0) + 1)
+    )
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        print(f"[{log_tag}] {str(e)}")
+        emit('status', {'msg': error_msg}, to=request.sid)
+        return False
+    return True
 
 
 def get_online_users_list():
-    seen = set()
-    users = []
-    for data in online_users.values():
-        if data['username'] not in seen:
-            seen.add(data['username'])
-            users.append({
-                'username': data['username'],
-                'profile_pic': data['profile_pic'],
-                'color': data['color']
-            })
-    return users
+    return presence.online_users()
 
 
 def broadcast_online_users():
-    emit('online_users', {'users': get_online_users_list()}, room=ROOM)
+    """Full online list to the whole room; only needed to resync after a purge."""
+    socketio.emit('online_users', {'users': get_online_users_list()}, to=ROOM, namespace='/')
+
+
+# Sessions of a worker that died are purged by the others
+presence.on_purge = broadcast_online_users
+
+presence_deltas = PresenceDeltas(lambda event, data: socketio.emit(event, data, to=ROOM, namespace='/'))
+typing_users = TypingAggregator(lambda event, data: socketio.emit(event, data, to=ROOM, namespace='/'))
+
+
+# ── Cluster sync ─────────────────────────────────────────────────────────────
+# With several workers, keep this process' caches in step with what the
+# other workers handled (no-ops with a single process).
+
+def _forget_deleted_messages(data):
+    # Single deletes carry message_id, purge batches message_ids
+    for message_id in data.get('message_ids') or [data['message_id']]:
+        recent_messages.discard(message_id)
+
+
+subscribe('message', recent_messages.append)
+subscribe('message_deleted', _forget_deleted_messages)
+subscribe('user_recolored', lambda data: recent_messages.recolor(data['user_id'], data['color']))
+subscribe('chat_message_removed', recent_messages.discard)
+
+
+def forget_deleted_user(user_id):
+    """Drop a deleted user from this process' caches and close their sockets."""
+    recent_messages.discard_user(user_id)
+    block_index.forget_user(user_id)
+    # Deleted with a Core statement, which the ORM invalidation hooks miss:
+    # the cached identity would keep the open sockets authorized
+    identity_cache.invalidate([user_id])
+    _disconnect_user(user_id, notice='Account eliminato.')
+
+
+subscribe('user_deleted', forget_deleted_user)
+
+
+# Browser (``session['client_id']``) of each socket connected to this process
+_socket_clients: dict[str, str | None] = {}
+
+
+def _disconnect_user(user_id, keep_client=None, notice=None):
+    """
+    Disconnect the sockets of ``user_id`` connected to this process, except
+    those of the browser ``keep_client``, sending them ``kicked`` first.
+    """
+    sids = [sid for sid, _ in socketio.server.manager.get_participants('/', f"user_{user_id}")]
+    for sid in sids:
+        if keep_client is not None and _socket_clients.get(sid) == keep_client:
+            continue
+        if notice:
+            socketio.server.emit('kicked', {'msg': notice}, to=sid, namespace='/', ignore_queue=True)
+        socketio.server.disconnect(sid, namespace='/', ignore_queue=True)
+
+
+_KICKED_MSG = 'Login effettuato da altro dispositivo. Sessione terminata.'
+
+
+def revoke_sessions(user_id, client_id):
+    """
+    Kick the open sockets of ``user_id`` after a login, on every worker. The
+    tabs of the browser that logged in (``client_id``) share its new session
+    and stay connected: kicking them would send them to /logout with it.
+    """
+    _disconnect_user(user_id, client_id, _KICKED_MSG)
+    publish('sessions_revoked', {'user_id': user_id, 'client_id': client_id})
+
+
+subscribe('sessions_revoked', lambda data: _disconnect_user(data['user_id'], data['client_id'], _KICKED_MSG))
 
 
 @socketio.on('connect')
 @login_required
-def handle_connect():
+def handle_connect(auth=None):
     if session.get('session_token') != current_user.session_token:
-        emit('kicked', {'msg': 'Login effettuato da altro dispositivo. Sessione terminata.'})
+        emit('kicked', {'msg': _KICKED_MSG})
         return False
 
-    join_room(ROOM)
+    _socket_clients[request.sid] = session.get('client_id')
     join_room(f"user_{current_user.id}")
-    
-    online_users[request.sid] = {
+    emit('unread_count', {'count': get_unread_total(current_user.id)})
+
+    # Pages other than the chat only use the socket for notifications
+    if isinstance(auth, dict) and auth.get('chat') is False:
+        return
+
+    join_room(ROOM)
+
+    user = {
+        'user_id': current_user.id,
         'username': current_user.username,
         'profile_pic': current_user.profile_pic,
-        'color': current_user.chat_color or '#61829a',
-        'user_id': current_user.id
+        'color': current_user.chat_color or '#61829a'
     }
-    user_sid_map[current_user.id] = request.sid
-    
-    emit('status', {'msg': f"{current_user.username} è entrato nella chat!"}, room=ROOM)
-    broadcast_online_users()
+    first_session = presence.add(request.sid, user)
+
+    # Full list for this client only; everyone else gets a (batched) delta
+    emit('online_users', {'users': get_online_users_list()}, to=request.sid)
+    # The clients show the join notice from the batched delta
+    if first_session:
+        presence_deltas.joined(user)
 
 
 @socketio.on('disconnect')
 def handle_disconnect():
-    if request.sid in online_users:
-        username = online_users[request.sid]['username']
-        user_id = online_users[request.sid].get('user_id')
-        del online_users[request.sid]
-        if user_id and user_sid_map.get(user_id) == request.sid:
-            del user_sid_map[user_id]
-        emit('status', {'msg': f"{username} ha lasciato la chat."}, room=ROOM)
-        broadcast_online_users()
+    _socket_clients.pop(request.sid, None)
+    user, last_session = presence.remove(request.sid)
+    if user is not None and last_session:
+        typing_users.stop(user['username'])
+        presence_deltas.left(user)
 
 
 @socketio.on('typing')
 @login_required
 def handle_typing(data):
-    is_typing = data.get('typing', False)
-    emit('user_typing', {
-        'username': current_user.username,
-        'typing': is_typing
-    }, room=ROOM, include_self=False)
+    if not check_rate_limit(current_user.id, 'typing'):
+        return
+    typing_users.update(current_user.username, bool(data.get('typing', False)))
 
 
 @socketio.on('message')
@@ -98,94 +219,79 @@ def handle_message(data):
     if not msg:
         return
 
-    current_user.message_count += 1
-
     new_message = Message(
         user_id=current_user.id,
         username=current_user.username,
         content=msg,
         profile_pic=current_user.profile_pic
     )
-    db.session.add(new_message)
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"[ERRORE SALVATAGGIO MSG] {str(e)}")
-        emit('status', {'msg': 'Errore nel salvataggio del messaggio'}, to=request.sid)
+    if not save_chat_message(new_message, 'ERRORE SALVATAGGIO MSG', 'Errore nel salvataggio del messaggio'):
         return
 
-    emit('message', {
-        'id': new_message.id,
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'msg': msg,
-        'time': datetime.now(timezone.utc).strftime("%H:%M"),
-        'profile_pic': current_user.profile_pic,
-        'color': current_user.chat_color or '#61829a'
-    }, room=ROOM)
+    payload = serialize_message(new_message, current_user.chat_color)
+    recent_messages.append(payload)
+    broadcast_chat_message(payload)
+    typing_users.stop(current_user.username)
 
 
 @socketio.on('draw_message')
 @login_required
 def handle_draw_message(data):
     """Send a canvas drawing as a message."""
-    if not check_rate_limit(current_user.id):
-        emit('status', {'msg': "Aspetta un attimo tra un messaggio e l'altro"}, to=request.sid)
-        return
-
     image_data = data.get('image_data', '')
 
     # Basic validation: must be a data URL PNG/JPEG
-    if not image_data or not image_data.startswith('data:image/'):
+    if not isinstance(image_data, str) or not image_data.startswith('data:image/'):
         emit('status', {'msg': 'Immagine non valida'}, to=request.sid)
         return
 
+    # Charged by size before the size guard, so oversized spam is limited too
+    if not check_rate_limit(current_user.id, 'draw_message', len(image_data)):
+        emit('status', {'msg': "Aspetta un attimo tra un messaggio e l'altro"}, to=request.sid)
+        return
+
     # Size guard (prevent huge payloads)
     if len(image_data) > _MAX_IMAGE_B64:
         emit('status', {'msg': 'Immagine troppo grande'}, to=request.sid)
         return
 
-    current_user.message_count += 1
+    try:
+        image_url = store_drawing(image_data)
+    except InvalidDrawing:
+        emit('status', {'msg': 'Immagine non valida'}, to=request.sid)
+        return
+    except OSError as e:
+        print(f"[ERRORE SALVATAGGIO DISEGNO] {str(e)}")
+        emit('status', {'msg': 'Errore nel salvataggio del disegno'}, to=request.sid)
+        return
 
     new_message = Message(
         user_id=current_user.id,
         username=current_user.username,
         content='[Disegno]',
         profile_pic=current_user.profile_pic,
-        image_data=image_data
+        image_data=image_url
     )
-    db.session.add(new_message)
-
-    try:
-        db.session.commit()
-    except Exception as e:
-        db.session.rollback()
-        print(f"[ERRORE SALVATAGGIO DISEGNO] {str(e)}")
-        emit('status', {'msg': 'Errore nel salvataggio del disegno'}, to=request.sid)
+    if not save_chat_message(new_message, 'ERRORE SALVATAGGIO DISEGNO', 'Errore nel salvataggio del disegno'):
         return
 
-    emit('message', {
-        'id': new_message.id,
-        'user_id': current_user.id,
-        'username': current_user.username,
-        'msg': '[Disegno]',
-        'time': datetime.now(timezone.utc).strftime("%H:%M"),
-        'profile_pic': current_user.profile_pic,
-        'color': current_user.chat_color or '#61829a',
-        'image_data': image_data
-    }, room=ROOM)
+    payload = serialize_message(new_message, current_user.chat_color)
+    recent_messages.append(payload)
+    broadcast_chat_message(payload)
+    typing_users.stop(current_user.username)
 
 
 @socketio.on('private_message')
 @login_required
 def handle_private_message(data):
-    if not check_rate_limit(current_user.id):
+    if not check_rate_limit(current_user.id, 'private_message'):
         emit('pm_error', {'msg': "Aspetta un attimo tra un messaggio e l'altro"}, to=request.sid)
         return
 
-    recipient_id = data.get('recipient_id')
+    try:
+        recipient_id = int(data.get('recipient_id'))
+    except (TypeError, ValueError):
+        return
     msg = str(data.get('msg', '')).strip()[:500]
     
     if not msg or not recipient_id:
@@ -199,6 +305,8 @@ def handle_private_message(data):
     db.session.add(new_pm)
 
     try:
+        db.session.flush()
+        record_private_message(new_pm)
         db.session.commit()
     except Exception as e:
         db.session.rollback()
@@ -206,22 +314,35 @@ def handle_private_message(data):
         return
 
     message_data = {
-        'id': new_pm.id,
-        'sender_id': current_user.id,
+        **serialize_private_message(new_pm),
         'sender_username': current_user.username,
-        'sender_profile_pic': current_user.profile_pic,
-        'content': msg,
-        'timestamp': datetime.now(timezone.utc).strftime("%H:%M")
+        'sender_profile_pic': current_user.profile_pic
     }
 
     emit('pm_sent', message_data, to=request.sid)
     emit('pm_received', message_data, room=f"user_{recipient_id}")
+    notify_private_message(recipient_id, current_user.username)
+
+
+def push_unread_count(user_id):
+    """Send the current unread private message count to all of a user's tabs."""
+    socketio.emit('unread_count', {'count': get_unread_total(user_id)},
+                  to=f"user_{user_id}", namespace='/')
+
+
+def notify_read_receipt(sender_id, reader_id, last_read_id):
+    """Tell ``sender_id`` that ``reader_id`` has read up to ``last_read_id``."""
+    socketio.emit('pm_read', {
+        'reader_id': reader_id,
+        'last_read_id': last_read_id
+    }, to=f"user_{sender_id}", namespace='/')
 
 
 def notify_private_message(recipient_id, sender_username):
-    emit('pm_notification', {
+    socketio.emit('pm_notification', {
         'sender': sender_username
-    }, room=f"user_{recipient_id}", namespace='/')
+    }, to=f"user_{recipient_id}", namespace='/')
+    push_unread_count(recipient_id)
 
 
 @socketio.on('delete_message')
@@ -231,7 +352,10 @@ def handle_delete_message(data):
     if not message_id:
         return
     
-    message = db.session.get(Message, message_id)
+    # With write-behind the message may still be waiting in the queue
+    message = message_writer.pending(message_id) if message_writer.enabled else None
+    if message is None:
+        message = db.session.get(Message, message_id)
     if not message:
         emit('status', {'msg': 'Messaggio non trovato'}, to=request.sid)
         return
@@ -241,8 +365,11 @@ def handle_delete_message(data):
         return
     
     try:
-        db.session.delete(message)
-        db.session.commit()
+        deleted_id = message.id
+        if not message_writer.withdraw(deleted_id):
+            db.session.query(Message).filter_by(id=deleted_id).delete()
+            db.session.commit()
+        recent_messages.discard(deleted_id)
         emit('message_deleted', {'message_id': message_id}, room=ROOM)
     except Exception as e:
         db.session.rollback()
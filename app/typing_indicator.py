@@ -0,0 +1,95 @@
+"""
+Server-side aggregation of main chat typing indicators.
+
+Clients report ``typing`` on/off; instead of relaying every report to the
+whole room, :class:`TypingAggregator` keeps who is typing (with an expiry,
+so a client that vanishes mid-sentence does not stay "typing" forever) and
+sends one ``typing_users`` snapshot at most every ``interval`` seconds, only
+when it changed. With several workers each one sends the snapshot of its own
+users, tagged with ``source``; clients merge them.
+"""
+import threading
+import time
+
+from .extensions import socketio
+
+
+class TypingAggregator:
+    def __init__(self, emit, interval: float = 0.5, ttl: float = 5.0):
+        self._emit = emit
+        self.interval = interval
+        self.ttl = ttl
+        self.source = 'local'
+        self._typing: dict[str, float] = {}
+        self._last_sent: tuple[str, ...] = ()
+        self._armed = False
+        self._lock = threading.Lock()
+        self.received = 0
+        self.sent = 0
+
+    def init_app(self, app, source: str | None = None) -> None:
+        self.interval = app.config['TYPING_BROADCAST_INTERVAL']
+        self.ttl = app.config['TYPING_TTL']
+        self.source = source or 'local'
+        with self._lock:
+            self._typing.clear()
+            self._last_sent = ()
+            self.received = self.sent = 0
+
+    def update(self, username: str, typing: bool) -> None:
+        """Record a client report."""
+        with self._lock:
+            self.received += 1
+            if typing:
+                self._typing[username] = time.monotonic() + self.ttl
+            else:
+                self._typing.pop(username, None)
+        self._schedule()
+
+    def stop(self, username: str) -> None:
+        """The user sent a message or left: no longer typing."""
+        with self._lock:
+            if self._typing.pop(username, None) is None:
+                return
+        self._schedule()
+
+    def _schedule(self) -> None:
+        if self.interval <= 0:
+            self.flush()
+            return
+        with self._lock:
+            if self._armed:
+                return
+            self._armed = True
+        socketio.start_background_task(self._run)
+
+    def _run(self) -> None:
+        # Keep ticking while someone is typing so expiries are noticed
+        while True:
+            socketio.sleep(self.interval)
+            self.flush()
+            with self._lock:
+                if not self._typing:
+                    self._armed = False
+                    return
+
+    def flush(self) -> None:
+        """Expire stale typers and send the snapshot if it changed."""
+        now = time.monotonic()
+        with self._lock:
+            for username in [u for u, expires in self._typing.items() if expires <= now]:
+                del self._typing[username]
+            users = tuple(sorted(self._typing))
+            if users == self._last_sent:
+                return
+            self._last_sent = users
+            self.sent += 1
+        self._emit('typing_users', {'source': self.source, 'users': list(users)})
+
+    def stats(self) -> dict:
+        return {
+            'typing': len(self._typing),
+            'reports_received': self.received,
+            'snapshots_sent': self.sent,
+            'events_saved': max(self.received - self.sent, 0),
+        }
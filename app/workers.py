@@ -0,0 +1,107 @@
+"""
+Pre-fork multi-worker server.
+
+The parent binds the listening socket once and forks ``WORKERS`` children
+that each build their own app and accept on the shared socket, so the
+kernel spreads connections across processes (and cores). Children that die
+are restarted. Workers share Socket.IO rooms and presence through the SQLite
+bus (:mod:`app.bus`); clients are limited to the websocket transport since
+long-polling requests of one session could land on different workers.
+"""
+import os
+import signal
+import socket
+import sys
+import traceback
+
+from werkzeug.serving import make_server
+
+from .config import Config, BASE_DIR
+
+
+def worker_config(config_class=Config):
+    """``config_class`` with the settings every worker process needs."""
+    return type('WorkerConfig', (config_class,), {
+        'SOCKETIO_BUS_PATH': config_class.SOCKETIO_BUS_PATH
+        or os.path.join(BASE_DIR, 'instance', 'socketio_bus.db'),
+        'SOCKETIO_WEBSOCKET_ONLY': True,
+    })
+
+
+def _run_worker(app_factory, config_class, sock, host, port) -> None:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    app = app_factory(config_class)
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    print(f" * Worker {os.getpid()} pronto su http://{host}:{port}")
+    server.serve_forever()
+
+
+def _fork(target, *args) -> int:
+    """Run ``target(*args)`` in a child process; returns its pid."""
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            target(*args)
+        except SystemExit:
+            pass
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    return pid
+
+
+def serve(app_factory, host: str, port: int, workers: int, config_class=Config) -> None:
+    """Run ``workers`` server processes on ``host:port`` until interrupted."""
+    if not hasattr(os, 'fork'):
+        raise SystemExit('WORKERS > 1 richiede os.fork (Linux/macOS)')
+    if config_class.SOCKETIO_ASYNC_MODE != 'threading':
+        raise SystemExit('WORKERS > 1 usa server a thread: lascia SOCKETIO_ASYNC_MODE=threading')
+    if config_class.MESSAGE_WRITE_BEHIND:
+        raise SystemExit('MESSAGE_WRITE_BEHIND assegna gli id in-process: non usarlo con WORKERS > 1')
+
+    config = worker_config(config_class)
+    sock = socket.create_server((host, port), backlog=1024)
+    sock.set_inheritable(True)
+
+    children = set()
+    stopping = False
+
+    def spawn():
+        children.add(_fork(_run_worker, app_factory, config, sock, host, port))
+
+    # Build the app once on its own first, so the schema setup in create_app
+    # (tables, indexes, backfills) does not race between workers
+    _, status = os.waitpid(_fork(app_factory, config), 0)
+    if status != 0:
+        raise SystemExit('Inizializzazione dell\'app fallita')
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, _ = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            print(f"[WORKER] processo {pid} terminato, riavvio")
+            spawn()
+
+    sock.close()
@@ -0,0 +1,231 @@
+"""
+Optional write-behind persistence for main chat messages.
+
+When ``MESSAGE_WRITE_BEHIND`` is enabled the socket handlers hand new
+``Message`` objects to :data:`message_writer` instead of committing them.
+The writer assigns the id up front so the message can be broadcast at once,
+then a background task inserts queued rows and the aggregated
+``User.message_count`` increments in a single transaction every
+``WRITE_BEHIND_FLUSH_INTERVAL`` seconds or ``WRITE_BEHIND_BATCH_SIZE`` rows.
+
+Ids are allocated in-process from ``MAX(message.id)``, so write-behind must
+only be enabled when a single process writes chat messages.
+
+A batch that still fails after ``_MAX_RETRIES`` attempts is dropped; those
+messages were already broadcast, so ``on_drop`` is called with their ids to
+retract them.
+"""
+import atexit
+import itertools
+import time
+from collections import deque, Counter
+from datetime import datetime, timezone
+from threading import Event, Lock
+
+from sqlalchemy import func, insert, update
+
+from .extensions import db, socketio
+from .models import Message, User
+
+_MAX_RETRIES = 3
+_COLUMNS = [c.key for c in Message.__table__.columns]
+
+
+class MessageWriter:
+    def __init__(self):
+        self.enabled = False
+        self.app = None
+        self._queue: deque[Message] = deque()
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._wakeup = Event()
+        self._stopping = False
+        self._thread = None
+        self._ids = None
+        self._failed_attempts = 0
+        self._atexit_registered = False
+        self.on_drop = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._stats = {
+            'flushes': 0,
+            'rows_written': 0,
+            'failures': 0,
+            'dropped': 0,
+            'max_queue_depth': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0,
+        }
+
+    def init_app(self, app) -> None:
+        if self._thread is not None:
+            self.stop()
+
+        self.enabled = app.config.get('MESSAGE_WRITE_BEHIND', False)
+        if not self.enabled:
+            return
+
+        self.app = app
+        self.flush_interval = app.config['WRITE_BEHIND_FLUSH_INTERVAL']
+        self.batch_size = app.config['WRITE_BEHIND_BATCH_SIZE']
+        self._queue.clear()
+        self._stopping = False
+        self._failed_attempts = 0
+        self._reset_stats()
+
+        with app.app_context():
+            max_id = db.session.query(func.max(Message.id)).scalar() or 0
+        self._ids = itertools.count(max_id + 1)
+
+        self._thread = socketio.start_background_task(self._run)
+        if not self._atexit_registered:
+            atexit.register(self.stop)
+            self._atexit_registered = True
+
+    # ── Producer side ────────────────────────────────────────────────────────
+
+    def submit(self, message: Message) -> Message:
+        """Assign id/timestamp to a transient message and queue it for insert."""
+        with self._lock:
+            message.id = next(self._ids)
+            if message.timestamp is None:
+                message.timestamp = datetime.now(timezone.utc)
+            self._queue.append(message)
+            depth = len(self._queue)
+            if depth > self._stats['max_queue_depth']:
+                self._stats['max_queue_depth'] = depth
+
+        if depth >= self.batch_size:
+            self._wakeup.set()
+        return message
+
+    def pending(self, message_id) -> Message | None:
+        """Return a queued, not yet persisted message."""
+        with self._lock:
+            return next((m for m in self._queue if m.id == message_id), None)
+
+    def cancel(self, message_id) -> bool:
+        """Drop a queued message before it is written. False if already flushed."""
+        with self._lock:
+            for message in self._queue:
+                if message.id == message_id:
+                    self._queue.remove(message)
+                    return True
+        return False
+
+    def withdraw(self, message_id) -> bool:
+        """
+        Make sure a message being deleted is not written later. True if it
+        was still queued (and is now dropped); False means any row it has is
+        in the database and must be deleted there.
+        """
+        if self.cancel(message_id):
+            return True
+        if not self.enabled:
+            return False
+        # Wait for an in-flight batch that may hold the message; a failed
+        # flush puts it back in the queue, so look again afterwards
+        self.flush()
+        return self.cancel(message_id)
+
+    def withdraw_user(self, user_id) -> None:
+        """Drop every queued message of a user being deleted."""
+        def drop():
+            with self._lock:
+                kept = [m for m in self._queue if m.user_id != user_id]
+                self._queue.clear()
+                self._queue.extend(kept)
+
+        drop()
+        if self.enabled:
+            self.flush()
+            drop()
+
+    # ── Writer side ──────────────────────────────────────────────────────────
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """Write everything currently queued. Returns the number of rows written."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    batch = [self._queue.popleft() for _ in range(min(self.batch_size, len(self._queue)))]
+                if not batch:
+                    return written
+                if not self._write_batch(batch):
+                    return written
+                written += len(batch)
+
+    def _write_batch(self, batch: list[Message]) -> bool:
+        rows = [{key: getattr(m, key) for key in _COLUMNS} for m in batch]
+        counts = Counter(m.user_id for m in batch if m.user_id is not None)
+
+        started = time.perf_counter()
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(Message), rows)
+                for user_id, n in counts.items():
+                    db.session.execute(
+                        update(User)
+                        .where(User.id == user_id)
+                        .values(message_count=func.coalesce(User.message_count, 0) + n)
+                    )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self._stats['failures'] += 1
+                self._failed_attempts += 1
+                print(f"[ERRORE WRITE-BEHIND] {str(e)}")
+                if self._failed_attempts >= _MAX_RETRIES:
+                    self._stats['dropped'] += len(batch)
+                    self._failed_attempts = 0
+                    dropped_ids = [m.id for m in batch]
+                    print(f"[ERRORE WRITE-BEHIND] messaggi scartati: {dropped_ids}")
+                    if self.on_drop is not None:
+                        self.on_drop(dropped_ids)
+                else:
+                    with self._lock:
+                        self._queue.extendleft(reversed(batch))
+                return False
+            finally:
+                db.session.remove()
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self._failed_attempts = 0
+        self._stats['flushes'] += 1
+        self._stats['rows_written'] += len(batch)
+        self._stats['last_flush_ms'] = elapsed_ms
+        self._stats['total_flush_ms'] += elapsed_ms
+        self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+        return True
+
+    def stop(self, timeout: float = 5.0) -> None:
+        """Stop the background task and drain whatever is still queued."""
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join(timeout)
+        self._thread = None
+        self.flush()
+
+    def stats(self) -> dict:
+        flushes = self._stats['flushes']
+        return {
+            'enabled': self.enabled,
+            'queue_depth': len(self._queue),
+            'avg_flush_ms': round(self._stats['total_flush_ms'] / flushes, 3) if flushes else 0.0,
+            **{k: round(v, 3) if isinstance(v, float) else v
+               for k, v in self._stats.items() if k != 'total_flush_ms'},
+        }
+
+
+message_writer = MessageWriter()
@@ -1,7 +1,31 @@
+import os
+
+# Green-thread servers need the stdlib patched before anything else is imported
+_ASYNC_MODE = os.environ.get('SOCKETIO_ASYNC_MODE', 'threading')
+if __name__ == '__main__' and _ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+elif __name__ == '__main__' and _ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
 from app import create_app
+from app.config import Config
 from app.extensions import socketio
 
-app = create_app()
+if __name__ == '__main__' and Config.WORKERS > 1:
+    # Each worker builds its own app after the fork
+    from app.workers import serve
+    serve(create_app, host='0.0.0.0', port=5000, workers=Config.WORKERS)
+elif __name__ != '__mp_main__':
+    # (the password hashing processes re-import this module as __mp_main__)
+    app = create_app()
 
-if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
+    if __name__ == '__main__':
+        if Config.SOCKETIO_ASYNC_MODE == 'threading':
+            socketio.run(app, debug=True, host='0.0.0.0', port=5000, allow_unsafe_werkzeug=True)
+        elif Config.SOCKETIO_ASYNC_MODE == 'eventlet':
+            # eventlet.wsgi: no debug reloader in production
+            socketio.run(app, host='0.0.0.0', port=5000, max_size=Config.SERVER_MAX_CONNECTIONS)
+        else:
+            socketio.run(app, host='0.0.0.0', port=5000)
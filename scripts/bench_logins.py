@@ -0,0 +1,114 @@
+"""
+Login throughput and chat latency during a login burst.
+
+Runs the app in-process on a temporary SQLite file: LOGINS threads post
+/login in a loop while one socket client sends chat messages, for each
+PASSWORD_HASH_WORKERS value given. Prints logins/s and the p50/p99 time a
+chat message spends in its handler.
+
+    python scripts/bench_logins.py --workers 0 2 4 --duration 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app                     # noqa: E402
+from app.config import Config                  # noqa: E402
+from app.extensions import db, socketio        # noqa: E402
+from app.models import User                    # noqa: E402
+from app.passwords import password_hasher     # noqa: E402
+
+
+def make_config(workdir: str, workers: int, method: str):
+    return type('BenchConfig', (Config,), {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        'SERVER_NAME': 'localhost.localdomain',
+        'PASSWORD_HASH_WORKERS': workers,
+        'PASSWORD_HASH_METHOD': method,
+        'PASSWORD_HASH_QUEUE_LIMIT': 1024,
+        'RATE_LIMIT_RATE': 1_000_000,
+        'RATE_LIMIT_BURST': 1_000_000,
+        'PRESENCE_COALESCE_WINDOW': 0,
+        'TYPING_BROADCAST_INTERVAL': 0,
+        'MESSAGE_WRITE_BEHIND': False,
+    })
+
+
+def run(workers: int, logins: int, duration: float, method: str) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        app = create_app(make_config(workdir, workers, method))
+        with app.app_context():
+            for i in range(logins + 1):
+                user = User(username=f'bench{i}')
+                user.set_password('password123')
+                db.session.add(user)
+            db.session.commit()
+
+        stop = threading.Event()
+        login_count = [0]
+        lock = threading.Lock()
+
+        def login_loop(i):
+            client = app.test_client()
+            while not stop.is_set():
+                client.post('/login', data={'username': f'bench{i}', 'password': 'password123'})
+                with lock:
+                    login_count[0] += 1
+
+        http = app.test_client()
+        http.post('/login', data={'username': f'bench{logins}', 'password': 'password123'})
+        chat = socketio.test_client(app, flask_test_client=http, headers={'Host': 'localhost.localdomain'})
+
+        threads = [threading.Thread(target=login_loop, args=(i,), daemon=True) for i in range(logins)]
+        for thread in threads:
+            thread.start()
+
+        latencies = []
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            sent = time.perf_counter()
+            chat.emit('message', {'msg': 'ping'})
+            latencies.append(time.perf_counter() - sent)
+            chat.get_received()
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        for thread in threads:
+            thread.join()
+        chat.disconnect()
+        password_hasher.shutdown()
+
+    latencies.sort()
+    return {
+        'workers': workers,
+        'logins_per_s': login_count[0] / elapsed,
+        'chat_p50_ms': statistics.median(latencies) * 1000,
+        'chat_p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'messages': len(latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', type=int, nargs='+', default=[0, 2])
+    parser.add_argument('--logins', type=int, default=8, help='concurrent login threads')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--method', default=Config.PASSWORD_HASH_METHOD)
+    args = parser.parse_args()
+
+    print(f"{'workers':>8} {'logins/s':>10} {'chat p50 ms':>12} {'chat p99 ms':>12} {'messages':>9}")
+    for workers in args.workers:
+        r = run(workers, args.logins, args.duration, args.method)
+        print(f"{r['workers']:>8} {r['logins_per_s']:>10.1f} {r['chat_p50_ms']:>12.2f} "
+              f"{r['chat_p99_ms']:>12.2f} {r['messages']:>9}")
+
+
+if __name__ == '__main__':
+    main()
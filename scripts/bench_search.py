@@ -0,0 +1,90 @@
+"""
+Admin message search latency: substring LIKE scan versus the FTS5 index.
+
+Builds the app on a temporary SQLite file, fills the message table with
+MESSAGES random chat lines (the index is rebuilt once at the end, as for an
+existing database), then times the first page of results for a few searches
+with both strategies. Prints the median and max latency per search.
+
+    python scripts/bench_search.py --messages 1000000 --repeat 5
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from sqlalchemy import text                    # noqa: E402
+
+from app import create_app                     # noqa: E402
+from app.config import Config                  # noqa: E402
+from app.extensions import db                  # noqa: E402
+from app.search import search_messages         # noqa: E402
+
+WORDS = ['ciao', 'come', 'stai', 'bene', 'grazie', 'stasera', 'partita', 'pizza', 'cinema',
+         'lavoro', 'domani', 'treno', 'ritardo', 'disegno', 'gatto', 'cane', 'mare', 'montagna']
+RARE = ['zanzariera', 'ornitorinco', 'capriolo']
+SEARCHES = ['pizza', 'gatt', 'treno ritardo', 'ornitorinco', 'inesistente']
+
+
+def seed(messages: int, batch: int = 50_000) -> None:
+    rng = random.Random(42)
+    with db.engine.begin() as conn:
+        # Index once at the end instead of row by row
+        conn.execute(text("DROP TRIGGER message_fts_insert"))
+        for start in range(0, messages, batch):
+            rows = []
+            for _ in range(min(batch, messages - start)):
+                words = rng.choices(WORDS, k=rng.randint(3, 12))
+                if rng.random() < 0.001:
+                    words.append(rng.choice(RARE))
+                rows.append({'username': f'utente{rng.randint(1, 500)}', 'content': ' '.join(words)})
+            conn.execute(text(
+                "INSERT INTO message (username, content, timestamp) VALUES (:username, :content, CURRENT_TIMESTAMP)"
+            ), rows)
+        conn.execute(text("INSERT INTO message_fts (message_fts) VALUES ('rebuild')"))
+
+
+def timed(search: str, repeat: int, per_page: int) -> list[float]:
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        search_messages(search, per_page)
+        times.append(time.perf_counter() - started)
+        db.session.remove()
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--per-page', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config = type('BenchConfig', (Config,), {
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        })
+        app = create_app(config)
+        with app.app_context():
+            started = time.perf_counter()
+            seed(args.messages)
+            print(f"seeded {args.messages} messages in {time.perf_counter() - started:.1f}s")
+
+            print(f"{'search':>15} {'strategy':>9} {'p50 ms':>9} {'max ms':>9}")
+            for search in SEARCHES:
+                for strategy, indexed in (('like', False), ('fts5', True)):
+                    app.extensions['message_search'] = indexed
+                    times = timed(search, args.repeat, args.per_page)
+                    print(f"{search:>15} {strategy:>9} {statistics.median(times) * 1000:>9.1f} "
+                          f"{max(times) * 1000:>9.1f}")
+            db.engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Write throughput and reader latency with and without the SQLite profile.
+
+Builds the app on a temporary SQLite file seeded with SEED messages, then
+for DURATION seconds runs WRITERS threads committing one chat message each
+(like the socket handlers) and READERS threads loading the newest history
+page. Prints commits/s and the p50/p99 reader latency, with SQLITE_PROFILE
+on and off.
+
+    python scripts/bench_sqlite.py --writers 4 --readers 4 --duration 10
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from app import create_app                     # noqa: E402
+from app.config import Config                  # noqa: E402
+from app.extensions import db                  # noqa: E402
+from app.history import fetch_history_page     # noqa: E402
+from app.models import Message                 # noqa: E402
+
+
+def run(profile: bool, writers: int, readers: int, duration: float, seed: int) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        config = type('BenchConfig', (Config,), {
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+            'SQLITE_PROFILE': profile,
+        })
+        app = create_app(config)
+        with app.app_context():
+            db.session.bulk_insert_mappings(Message, [
+                {'username': 'seed', 'content': f'messaggio {i}'} for i in range(seed)
+            ])
+            db.session.commit()
+
+        stop = threading.Event()
+        commits, errors, latencies = [0], [0], []
+        lock = threading.Lock()
+
+        def writer():
+            while not stop.is_set():
+                with app.app_context():
+                    db.session.add(Message(username='bench', content='ping'))
+                    try:
+                        db.session.commit()
+                        with lock:
+                            commits[0] += 1
+                    except Exception:
+                        db.session.rollback()
+                        with lock:
+                            errors[0] += 1
+
+        def reader():
+            while not stop.is_set():
+                with app.app_context():
+                    started = time.perf_counter()
+                    fetch_history_page()
+                    elapsed = time.perf_counter() - started
+                with lock:
+                    latencies.append(elapsed)
+
+        threads = [threading.Thread(target=writer) for _ in range(writers)]
+        threads += [threading.Thread(target=reader) for _ in range(readers)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(duration)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        with app.app_context():
+            db.engine.dispose()
+
+    latencies.sort()
+    return {
+        'profile': 'on' if profile else 'off',
+        'commits_per_s': commits[0] / elapsed,
+        'errors': errors[0],
+        'reads': len(latencies),
+        'read_p50_ms': statistics.median(latencies) * 1000 if latencies else float('nan'),
+        'read_p99_ms': latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per run')
+    parser.add_argument('--seed', type=int, default=100_000, help='messages in the table beforehand')
+    args = parser.parse_args()
+
+    print(f"{'profile':>8} {'commits/s':>10} {'errors':>7} {'reads':>7} {'read p50 ms':>12} {'read p99 ms':>12}")
+    for profile in (False, True):
+        r = run(profile, args.writers, args.readers, args.duration, args.seed)
+        print(f"{r['profile']:>8} {r['commits_per_s']:>10.1f} {r['errors']:>7} {r['reads']:>7} "
+              f"{r['read_p50_ms']:>12.2f} {r['read_p99_ms']:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+"""
+Concurrent websocket clients sustained by one server process.
+
+Starts the app in a child process with each SOCKETIO_ASYNC_MODE given (same
+server run.py would start), opens N websocket clients on the main chat with
+one logged-in account, then sends chat messages from the first client and
+measures how long each takes to reach all N. Prints, per mode and N, the
+clients that connected and the p50/max broadcast fan-out time.
+
+    python scripts/bench_websockets.py --modes threading eventlet --clients 100 500 1000
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def serve(mode: str, port: int) -> None:
+    """Child process: run the server like run.py does for ``mode``."""
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    sys.path.insert(0, ROOT)
+    from app import create_app
+    from app.config import Config
+    from app.extensions import socketio
+
+    config = type('BenchConfig', (Config,), {
+        'SOCKETIO_ASYNC_MODE': mode,
+        'SOCKETIO_WEBSOCKET_ONLY': True,
+        'PRESENCE_COALESCE_WINDOW': 0.25,
+        'RATE_LIMIT_RATE': 1_000_000,
+        'RATE_LIMIT_BURST': 1_000_000,
+        'PASSWORD_HASH_WORKERS': 0,
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+    })
+    app = create_app(config)
+    if mode == 'threading':
+        socketio.run(app, host='127.0.0.1', port=port, allow_unsafe_werkzeug=True, log_output=False)
+    elif mode == 'eventlet':
+        socketio.run(app, host='127.0.0.1', port=port, log_output=False, max_size=config.SERVER_MAX_CONNECTIONS)
+    else:
+        socketio.run(app, host='127.0.0.1', port=port, log_output=False)
+
+
+def wait_for_port(port: int, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('server did not start')
+
+
+def login_cookie(port: int) -> str:
+    base = f'http://127.0.0.1:{port}'
+    jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(jar))
+    form = urllib.parse.urlencode({'username': 'bench', 'password': 'password123'}).encode()
+    opener.open(f'{base}/register', form).read()
+    opener.open(f'{base}/login', form).read()
+    return '; '.join(f'{c.name}={c.value}' for c in jar)
+
+
+class Client:
+    """Minimal Engine.IO v4 / Socket.IO v5 websocket client."""
+
+    def __init__(self, port: int, cookie: str, on_message):
+        from simple_websocket import Client as WebSocket
+        self.ws = WebSocket.connect(
+            f'ws://127.0.0.1:{port}/socket.io/?EIO=4&transport=websocket',
+            headers={'Cookie': cookie}
+        )
+        try:
+            deadline = time.monotonic() + 3
+            opening = None
+            while opening is None or not opening.startswith('0'):    # engine.io open
+                if time.monotonic() > deadline:
+                    raise RuntimeError('handshake timed out')
+                opening = self.ws.receive(timeout=1)
+            self.ws.send('40' + json.dumps({'chat': True}))
+            # Events emitted by the connect handler may precede the ack
+            reply = ''
+            while reply is not None and not reply.startswith('40'):
+                reply = self.ws.receive(timeout=10)
+                if reply is not None and reply.startswith('44'):
+                    raise RuntimeError(f'connect refused: {reply!r}')
+            if reply is None:
+                raise RuntimeError('connect timed out')
+        except Exception:
+            self.close()
+            raise
+        self.on_message = on_message
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        try:
+            while True:
+                data = self.ws.receive()
+                if data == '2':
+                    self.ws.send('3')
+                elif data and data.startswith('42'):
+                    event, *args = json.loads(data[2:])
+                    if event == 'message':
+                        self.on_message(args[0]['msg'])
+        except Exception:
+            pass
+
+    def emit(self, event: str, data) -> None:
+        self.ws.send('42' + json.dumps([event, data]))
+
+    def close(self):
+        try:
+            self.ws.close()
+        except Exception:
+            pass
+
+
+def bench(mode: str, clients: int, messages: int, port: int) -> dict:
+    with tempfile.TemporaryDirectory() as workdir:
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+        server = subprocess.Popen(
+            [sys.executable, __file__, '--serve', mode, '--port', str(port)],
+            env=env, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+        try:
+            wait_for_port(port)
+            cookie = login_cookie(port)
+
+            received: dict[str, int] = {}
+            done: dict[str, float] = {}
+            lock = threading.Lock()
+
+            def on_message(content):
+                with lock:
+                    received[content] = received.get(content, 0) + 1
+                    if received[content] == connected:
+                        done[content] = time.perf_counter()
+
+            opened, connected = [], 0
+            for _ in range(clients):
+                # simple_websocket can lose a frame sent together with the
+                # 101 response: retry the handshake a couple of times
+                for _ in range(3):
+                    try:
+                        opened.append(Client(port, cookie, on_message))
+                        break
+                    except Exception:
+                        pass
+            connected = len(opened)
+
+            fan_out = []
+            for i in range(messages if opened else 0):
+                content = f'bench {i}'
+                sent = time.perf_counter()
+                opened[0].emit('message', {'msg': content})
+                deadline = sent + 30
+                while content not in done and time.perf_counter() < deadline:
+                    time.sleep(0.005)
+                if content in done:
+                    fan_out.append(done[content] - sent)
+                time.sleep(0.2)
+
+            for client in opened:
+                client.close()
+        finally:
+            server.terminate()
+            server.wait(timeout=10)
+
+    return {
+        'mode': mode,
+        'clients': clients,
+        'connected': connected,
+        'delivered': f'{len(fan_out)}/{messages}',
+        'fan_out_p50_ms': statistics.median(fan_out) * 1000 if fan_out else float('nan'),
+        'fan_out_max_ms': max(fan_out) * 1000 if fan_out else float('nan'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--modes', nargs='+', default=['threading', 'eventlet'])
+    parser.add_argument('--clients', type=int, nargs='+', default=[100, 250, 500])
+    parser.add_argument('--messages', type=int, default=10)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    print(f"{'mode':>10} {'clients':>8} {'connected':>10} {'delivered':>10} {'p50 ms':>9} {'max ms':>9}")
+    for mode in args.modes:
+        for clients in args.clients:
+            r = bench(mode, clients, args.messages, args.port)
+            print(f"{r['mode']:>10} {r['clients']:>8} {r['connected']:>10} {r['delivered']:>10} "
+                  f"{r['fan_out_p50_ms']:>9.1f} {r['fan_out_max_ms']:>9.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -3,16 +3,24 @@ from app import create_app
 from app.extensions import db, socketio
 from app.models import User
 from app.config import Config
+from app import utils
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
     WTF_CSRF_ENABLED = False
     SERVER_NAME = 'localhost.localdomain'
+    PRESENCE_COALESCE_WINDOW = 0   # deliver presence deltas synchronously
+    TYPING_BROADCAST_INTERVAL = 0  # and typing snapshots
+    PASSWORD_HASH_WORKERS = 0      # hash in the test thread
+    JOBS_RUN_INLINE = True         # purge jobs finish within the request
 
 @pytest.fixture
-def app():
+def app(tmp_path):
     app = create_app(TestConfig)
+    app.config['DRAWINGS_FOLDER'] = str(tmp_path / 'drawings')
+    app.config['MESSAGE_ARCHIVE_PATH'] = str(tmp_path / 'archive.db')
+    utils.rate_limiter.reset()
     
     with app.app_context():
         db.create_all()
@@ -64,8 +72,24 @@ def admin_client(client, init_database):
 @pytest.fixture
 def socket_client(app, auth_client):
     client, user = auth_client
-    sio_client = socketio.test_client(app, flask_test_client=client)
+    # Match SERVER_NAME so the session cookie from the login is sent along
+    sio_client = socketio.test_client(
+        app, flask_test_client=client, headers={'Host': TestConfig.SERVER_NAME}
+    )
     sio_client.user = user
     yield sio_client
     if sio_client.is_connected():
         sio_client.disconnect()
+
+@pytest.fixture
+def second_socket_client(app, init_database):
+    _, user2, _ = init_database
+    client = app.test_client()
+    client.post('/login', data={'username': user2.username, 'password': 'password456'})
+    sio_client = socketio.test_client(
+        app, flask_test_client=client, headers={'Host': TestConfig.SERVER_NAME}
+    )
+    sio_client.user = user2
+    yield sio_client
+    if sio_client.is_connected():
+        sio_client.disconnect()
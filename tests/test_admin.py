@@ -1,5 +1,8 @@
+import re
+
 from app.models import User, Message
 from app.extensions import db
+from tests.test_sockets import write_behind  # noqa: F401 (fixture)
 
 def test_admin_dashboard_nonadmin(auth_client):
     client, _ = auth_client
@@ -72,3 +75,477 @@ def test_admin_delete_message(admin_client, init_database):
     with client.application.app_context():
         m = db.session.get(Message, msg_id)
         assert m is None
+
+def test_admin_metrics(admin_client):
+    client, _ = admin_client
+    response = client.get('/admin/metrics')
+    assert response.status_code == 200
+    data = response.get_json()
+    assert data['write_behind']['enabled'] is False
+    assert data['write_behind']['queue_depth'] == 0
+
+def test_admin_deletes_reach_write_behind_queue(admin_client, init_database, write_behind):
+    client, _ = admin_client
+    _, user2, _ = init_database
+
+    queued = write_behind.submit(Message(user_id=user2.id, username=user2.username, content='queued'))
+    response = client.post(f'/admin/messages/{queued.id}/delete')
+    assert response.status_code == 302
+    assert write_behind.stats()['queue_depth'] == 0
+
+    write_behind.submit(Message(user_id=user2.id, username=user2.username, content='orphan'))
+    client.post(f'/admin/users/{user2.id}/delete')
+    assert write_behind.flush() == 0
+    assert Message.query.count() == 0
+
+def test_admin_message_search_uses_fulltext_index(app, admin_client, init_database):
+    client, _ = admin_client
+    user1, user2, _ = init_database
+    db.session.add_all([
+        Message(user_id=user1.id, username=user1.username, content='Ciao a tutti <b>'),
+        Message(user_id=user2.id, username=user2.username, content='ciaooo ciao ciao'),
+        Message(user_id=user2.id, username=user2.username, content='Buonanotte'),
+    ])
+    db.session.commit()
+    assert app.extensions['message_search']
+
+    html = client.get('/admin/messages?search=ciao').get_data(as_text=True)
+    # Prefix matches, best ranked first, highlighted and still escaped
+    assert html.index('<mark>ciaooo</mark>') < html.index('<mark>Ciao</mark> a tutti &lt;b&gt;')
+    assert 'Buonanotte' not in html
+
+    # Usernames are indexed too, and deletes leave the index
+    assert 'Buonanotte' in client.get('/admin/messages?search=testuser2').get_data(as_text=True)
+    Message.query.filter_by(content='Buonanotte').delete()
+    db.session.commit()
+    assert 'Buonanotte' not in client.get('/admin/messages?search=buona').get_data(as_text=True)
+
+def test_search_pages_reach_every_match_beyond_rank_window(app, init_database):
+    from app.search import search_messages, search_filter
+    user1, _, _ = init_database
+    app.config['SEARCH_RANK_WINDOW'] = 5
+    db.session.add_all([Message(user_id=user1.id, username=user1.username, content=f'pizza {i}')
+                        for i in range(12)])
+    db.session.commit()
+
+    seen, offset, has_more = [], 0, True
+    while has_more:
+        messages, highlights, has_more = search_messages('pizza', limit=4, offset=offset)
+        seen += [m.id for m in messages]
+        offset += 4
+    # The ranked window, then the older hits newest first: no gaps, no repeats
+    matching = [m.id for m in Message.query.filter(search_filter('pizza')).order_by(Message.id.desc())]
+    assert sorted(seen) == sorted(matching) and len(seen) == 12
+    assert seen[5:] == matching[5:]
+
+def test_search_index_built_for_existing_messages(app, init_database):
+    from app.search import ensure_search_index, search_messages
+    user1, _, _ = init_database
+    db.session.add(Message(user_id=user1.id, username=user1.username, content='messaggio storico'))
+    db.session.commit()
+    db.session.execute(db.text('DROP TABLE message_fts'))
+    db.session.commit()
+
+    assert ensure_search_index(app)
+    messages, highlights, has_more = search_messages('storico', limit=10)
+    assert [m.content for m in messages] == ['messaggio storico']
+    assert not has_more
+
+def test_admin_messages_keyset_pages(admin_client, init_database):
+    from datetime import datetime, timezone
+    client, _ = admin_client
+    user1, _, _ = init_database
+    # Same timestamp for all: the id breaks ties
+    same_time = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    db.session.add_all([
+        Message(user_id=user1.id, username=user1.username, content=f'numero {i:03d}', timestamp=same_time)
+        for i in range(120)
+    ])
+    db.session.commit()
+
+    def page(url):
+        html = client.get(url).get_data(as_text=True)
+        shown = sorted(int(n) for n in re.findall(r'numero (\d{3})', html))
+        links = dict(re.findall(r'href="(/admin/messages\?(after|before)=\d+)"', html))
+        return shown, {kind: url.replace('&amp;', '&') for url, kind in links.items()}, html
+
+    first, links, html = page('/admin/messages')
+    assert first == list(range(70, 120)) and set(links) == {'before'}
+    assert '120 messaggi' in html
+    second, links, _ = page(links['before'])
+    assert second == list(range(20, 70)) and set(links) == {'after', 'before'}
+    last, links, _ = page(links['before'])
+    assert last == list(range(0, 20)) and set(links) == {'after'}
+    back, _, _ = page(links['after'])
+    assert back == second
+    # Paging back past the newest rows shows the full first page
+    newest, links, _ = page(f'/admin/messages?after={Message.query.filter_by(content="numero 100").one().id}')
+    assert newest == first and set(links) == {'before'}
+
+def test_dashboard_counters_follow_every_write_path(app, admin_client, init_database):
+    from app.counters import row_counts
+    client, _ = admin_client
+    user1, user2, _ = init_database
+    assert app.extensions['row_counters']
+    assert row_counts() == {'users': 3, 'admins': 1, 'messages': 0}
+
+    db.session.add_all([Message(user_id=user2.id, username=user2.username, content='uno'),
+                        Message(user_id=user2.id, username=user2.username, content='due')])
+    db.session.commit()
+    client.post(f'/admin/users/{user1.id}/toggle-admin')
+    assert row_counts() == {'users': 3, 'admins': 2, 'messages': 2}
+
+    # Bulk delete of the messages and the user
+    client.post(f'/admin/users/{user2.id}/delete')
+    assert row_counts() == {'users': 2, 'admins': 2, 'messages': 0}
+    assert row_counts()['users'] == User.query.count()
+    stats = re.findall(r'ds-stat-value">(\d+)<', client.get('/admin/').get_data(as_text=True))
+    assert stats[:3] == ['2', '0', '2']
+
+def test_user_purge_removes_everything_in_batches(app, socket_client, init_database):
+    from app.models import PrivateMessage, Conversation, BlockedUser
+    from app.conversations import record_private_message
+    from app.jobs import jobs, purge_user
+    from tests.test_sockets import _events
+    user1, user2, _ = init_database
+    app.config['PURGE_BATCH_SIZE'] = 2
+    jobs.init_app(app)
+
+    db.session.add_all([Message(user_id=user2.id, username=user2.username, content=f'm{i}') for i in range(5)])
+    db.session.add(Message(username=user2.username, content='prima degli user_id'))
+    db.session.add(Message(user_id=user1.id, username=user1.username, content='resta'))
+    for sender, recipient in ((user1, user2), (user2, user1)):
+        pm = PrivateMessage(sender_id=sender.id, recipient_id=recipient.id, content='ciao')
+        db.session.add(pm)
+        db.session.flush()
+        record_private_message(pm)
+    db.session.add(BlockedUser(blocker_id=user1.id, blocked_id=user2.id))
+    db.session.commit()
+    socket_client.get_received()
+
+    user2_id = user2.id
+    job = purge_user(user2)
+    assert job.state == 'done'
+    assert job.total == 11 and job.deleted == {
+        'message': 6, 'private_message': 2, 'conversation': 2, 'blocked_user': 1
+    }
+    db.session.expire_all()
+    assert db.session.get(User, user2_id) is None
+    assert [m.content for m in Message.query] == ['resta']
+    assert PrivateMessage.query.count() == Conversation.query.count() == BlockedUser.query.count() == 0
+
+    # One message_deleted event per batch
+    batches = [e['message_ids'] for e in _events(socket_client, 'message_deleted')]
+    assert [len(ids) for ids in batches] == [2, 2, 1, 1]
+
+def test_deleted_user_loses_open_sockets(app, socket_client, init_database):
+    from flask import g
+    from app.identity import identity_cache
+    from app.jobs import purge_user
+    user1 = socket_client.user
+    user_id = user1.id
+    # The socket's identity is cached, as on every event
+    socket_client.emit('message', {'msg': 'prima'})
+    assert identity_cache.get(user_id) is not None
+    socket_client.get_received()
+
+    g.pop('_login_user', None)
+    assert purge_user(user1).state == 'done'
+    db.session.expunge_all()
+    assert identity_cache.get(user_id) is None
+    assert not socket_client.is_connected()
+    assert {'name': 'kicked', 'args': [{'msg': 'Account eliminato.'}], 'namespace': '/'} in socket_client.queue
+    assert Message.query.count() == 0
+
+def test_bulk_message_purge_by_filter(admin_client, init_database):
+    from datetime import datetime
+    client, _ = admin_client
+    user1, user2, _ = init_database
+    db.session.add_all([
+        Message(user_id=user1.id, username=user1.username, content='spam vecchio', timestamp=datetime(2024, 1, 10)),
+        Message(user_id=user1.id, username=user1.username, content='spam nuovo', timestamp=datetime(2024, 3, 1)),
+        Message(user_id=user2.id, username=user2.username, content='spam altrui', timestamp=datetime(2024, 1, 10)),
+        Message(user_id=user1.id, username=user1.username, content='buono', timestamp=datetime(2024, 1, 10)),
+    ])
+    db.session.commit()
+
+    response = client.post('/admin/messages/purge', data={}, follow_redirects=True)
+    assert 'almeno un filtro' in response.get_data(as_text=True)
+
+    response = client.post('/admin/messages/purge', data={
+        'username': user1.username, 'since': '2024-01-01', 'until': '2024-01-31', 'search': 'spam'
+    }, follow_redirects=True)
+    assert '1 messaggi eliminati' in response.get_data(as_text=True)
+    assert sorted(m.content for m in Message.query) == ['buono', 'spam altrui', 'spam nuovo']
+
+    client.post('/admin/messages/purge', data={'search': 'spam'})
+    assert [m.content for m in Message.query] == ['buono']
+    jobs_status = client.get('/admin/jobs').get_json()
+    assert [(j['state'], j['done']) for j in jobs_status] == [('done', 2), ('done', 1)]
+
+def test_purge_job_runs_in_background(app, admin_client, init_database):
+    import time
+    from app.jobs import jobs
+    client, _ = admin_client
+    _, user2, _ = init_database
+    app.config.update(JOBS_RUN_INLINE=False, PURGE_BATCH_SIZE=10, PURGE_BATCH_PAUSE=0)
+    jobs.init_app(app)
+    db.session.add_all([Message(user_id=user2.id, username=user2.username, content='x') for _ in range(35)])
+    db.session.commit()
+
+    response = client.post(f'/admin/users/{user2.id}/delete', follow_redirects=True)
+    assert 'avviata' in response.get_data(as_text=True)
+    deadline = time.monotonic() + 5
+    while jobs.recent()[0].active and time.monotonic() < deadline:
+        time.sleep(0.01)
+    status = client.get('/admin/jobs').get_json()[0]
+    assert status['state'] == 'done' and status['done'] == status['total'] == 35
+    assert Message.query.count() == 0
+    assert client.get('/admin/metrics').get_json()['jobs']['rows_deleted'] == 35
+
+def _old_and_new_messages(user1, user2):
+    from datetime import datetime, timedelta
+    old = datetime.utcnow() - timedelta(days=90)
+    db.session.add_all(
+        [Message(user_id=user1.id, username=user1.username, content=f'vecchio {i}',
+                 timestamp=old + timedelta(minutes=i)) for i in range(5)]
+        + [Message(user_id=user2.id, username=user2.username, content='[Disegno]',
+                   image_data='/drawings/' + 'a' * 64 + '.png', timestamp=old)]
+        + [Message(user_id=user2.id, username=user2.username, content=f'nuovo {i}') for i in range(2)]
+    )
+    db.session.commit()
+
+def test_retention_moves_expired_messages_to_archive(app, admin_client, init_database):
+    from app.retention import retention
+    from app.archive import message_archive
+    from app.counters import row_counts
+    from app.search import search_messages
+    client, _ = admin_client
+    user1, user2, _ = init_database
+    _old_and_new_messages(user1, user2)
+
+    job = retention.run(days=30)
+    assert job.state == 'done' and job.deleted == {'archived': 6}
+    assert sorted(m.content for m in Message.query) == ['nuovo 0', 'nuovo 1']
+    # Triggers followed the rows out of the table
+    assert row_counts()['messages'] == 2
+    assert search_messages('vecchio', 10)[0] == []
+    assert message_archive.stats()['messages'] == 6
+    assert message_archive.referenced_drawings() == {'/drawings/' + 'a' * 64 + '.png'}
+
+    html = client.get('/admin/archive').get_data(as_text=True)
+    assert 'vecchio 4' in html and 'ds-archive-drawing' in html and '6 messaggi in 1 segmenti' in html
+    html = client.get(f'/admin/archive?username={user2.username}').get_data(as_text=True)
+    assert 'ds-archive-drawing' in html and 'vecchio' not in html
+    # Nothing left to archive
+    assert retention.run(days=30).done == 0
+    response = client.post('/admin/retention/run', follow_redirects=True)
+    assert '0 messaggi archiviati' in response.get_data(as_text=True)
+    assert client.get('/admin/metrics').get_json()['archive']['messages'] == 6
+
+def test_retention_keeps_newest_messages(app, init_database):
+    from app.retention import retention
+    from app.archive import message_archive
+    user1, user2, _ = init_database
+    _old_and_new_messages(user1, user2)
+
+    job = retention.run(max_messages=3)
+    assert job.done == 5
+    assert sorted(m.content for m in Message.query) == ['nuovo 0', 'nuovo 1', 'vecchio 4']
+
+    # Keyset pages over the archive, newest first
+    first = message_archive.page(per_page=3)
+    assert [m.content for m in first.items] == ['vecchio 3', 'vecchio 2', 'vecchio 1']
+    second = message_archive.page(before=first.next_cursor, per_page=3)
+    assert [m.content for m in second.items] == ['[Disegno]', 'vecchio 0'] and not second.has_next
+    assert message_archive.page(after=second.prev_cursor, per_page=3).items == first.items
+
+def _file_app(tmp_path, **config):
+    from app import create_app
+    from tests.conftest import TestConfig
+    return create_app(type('FileConfig', (TestConfig,), {
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'chat.db'}",
+        'MESSAGE_ARCHIVE_PATH': str(tmp_path / 'archive.db'),
+        **config,
+    }))
+
+def test_compaction_reclaims_space(tmp_path):
+    from app.retention import last_compaction
+    app = _file_app(tmp_path)
+    with app.app_context():
+        # New databases are created in incremental auto-vacuum mode
+        assert db.session.execute(db.text('PRAGMA auto_vacuum')).scalar() == 2
+        db.session.add_all([Message(username='tizio', content='x' * 2000) for _ in range(300)])
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=['archive-messages', '--keep', '100'])
+        assert 'Messages archived: 200' in result.output
+        report = last_compaction()
+        assert report['mode'] == 'incremental' and report['reclaimed_bytes'] > 200 * 2000
+        assert db.session.execute(db.text('PRAGMA freelist_count')).scalar() == 0
+        db.session.remove()
+
+def test_full_vacuum_only_from_cli(tmp_path):
+    from app.retention import retention, last_compaction, incremental_compaction
+    # A database created before incremental auto-vacuum
+    app = _file_app(tmp_path, SQLITE_PROFILE=False)
+    with app.app_context():
+        assert not incremental_compaction()
+        db.session.add_all([Message(username='tizio', content='x' * 2000) for _ in range(300)])
+        db.session.commit()
+
+        # Scheduled runs and the dashboard button never rewrite the live file
+        assert retention.run(max_messages=200, force_compaction=True).done == 100
+        assert last_compaction() is None
+        result = app.test_cli_runner().invoke(args=['archive-messages', '--keep', '150'])
+        assert 'run once with --compact' in result.output
+
+        result = app.test_cli_runner().invoke(args=['archive-messages', '--keep', '100', '--compact'])
+        assert 'Compaction (vacuum)' in result.output
+        assert incremental_compaction()
+
+        retention.run(max_messages=10, force_compaction=True)
+        report = last_compaction()
+        assert report['mode'] == 'incremental' and report['reclaimed_bytes'] > 90 * 2000
+        assert Message.query.count() == 10
+        db.session.remove()
+
+def _history(user1, user2):
+    from app.models import PrivateMessage
+    from app.conversations import record_private_message, mark_conversation_read
+    from app.drawings import store_drawing
+    from tests.test_sockets import PNG_DATA_URL
+    drawing = store_drawing(PNG_DATA_URL)
+    db.session.add_all([
+        Message(user_id=user1.id, username=user1.username, content='ciao a tutti'),
+        Message(user_id=user2.id, username=user2.username, content='[Disegno]', image_data=drawing),
+        # Written before the drawing store existed
+        Message(user_id=user2.id, username=user2.username, content='[Disegno]', image_data=PNG_DATA_URL),
+    ])
+    for sender, recipient, content in ((user1, user2, 'letto'), (user1, user2, 'non letto'),
+                                       (user2, user1, 'risposta')):
+        pm = PrivateMessage(sender_id=sender.id, recipient_id=recipient.id, content=content)
+        db.session.add(pm)
+        db.session.flush()
+        record_private_message(pm)
+        if content == 'letto':
+            mark_conversation_read(user2.id, user1.id, pm.id)
+    db.session.commit()
+    return drawing
+
+def test_history_export_streams_ndjson(admin_client, init_database):
+    import gzip
+    import json
+    client, _ = admin_client
+    user1, user2, _ = init_database
+    drawing = _history(user1, user2)
+
+    response = client.get('/admin/export')
+    assert response.is_streamed and response.mimetype == 'application/x-ndjson'
+    records = [json.loads(line) for line in response.get_data().splitlines()]
+    assert records[0]['type'] == 'header' and records[0]['version'] == 1
+    messages = [r for r in records if r['type'] == 'message']
+    # Drawings are references, legacy inline ones included
+    assert [m['image_data'] for m in messages] == [None, drawing, drawing]
+    pms = [r for r in records if r['type'] == 'private_message']
+    assert [(p['sender'], p['content'], p['read']) for p in pms] == [
+        (user1.username, 'letto', True), (user1.username, 'non letto', False), (user2.username, 'risposta', False)
+    ]
+
+    response = client.get('/admin/export?type=private_message&gzip=1')
+    assert response.mimetype == 'application/gzip' and '.ndjson.gz' in response.headers['Content-Disposition']
+    lines = gzip.decompress(response.get_data()).splitlines()
+    assert [json.loads(line)['type'] for line in lines] == ['header'] + ['private_message'] * 3
+
+def test_history_export_releases_connection_between_batches(tmp_path):
+    from app.export import export_records
+    app = _file_app(tmp_path, EXPORT_BATCH_SIZE=2)
+    with app.app_context():
+        db.session.add_all([Message(username='tizio', content=str(n)) for n in range(5)])
+        db.session.commit()
+        db.session.close()
+        contents = []
+        for record in export_records(['message']):
+            # A slow download must not hold a pooled connection
+            assert db.engine.pool.checkedout() == 0
+            if record['type'] == 'message':
+                contents.append(record['content'])
+        assert contents == ['0', '1', '2', '3', '4']
+
+def test_history_import_round_trip(app, runner, init_database, tmp_path):
+    import gzip
+    from app.models import PrivateMessage, Conversation
+    from app.retention import retention
+    user1, user2, _ = init_database
+    app.config['EXPORT_BATCH_SIZE'] = 2
+    drawing = _history(user1, user2)
+    # Archived messages are part of the history too
+    retention.run(max_messages=2)
+    expected = [(m.username, m.content) for m in Message.query.order_by(Message.id)]
+    assert len(expected) == 2
+
+    path = tmp_path / 'history.ndjson.gz'
+    result = runner.invoke(args=['export-history', str(path)])
+    assert result.exit_code == 0
+    assert gzip.decompress(path.read_bytes()).count(b'\n') == 1 + 3 + 3
+
+    PrivateMessage.query.delete()
+    Conversation.query.delete()
+    Message.query.delete()
+    db.session.delete(user1)
+    db.session.commit()
+
+    result = runner.invoke(args=['import-history', str(path)])
+    assert 'Messages imported: 3' in result.output
+    assert 'Private messages imported: 0 (skipped, unknown users: 3)' in result.output
+    rows = Message.query.order_by(Message.id).all()
+    assert [(m.username, m.content, m.image_data) for m in rows] == [
+        (user1.username, 'ciao a tutti', None),
+        (user2.username, '[Disegno]', drawing), (user2.username, '[Disegno]', drawing),
+    ]
+    # Messages of users missing here keep their username only
+    assert rows[0].user_id is None and rows[1].user_id == user2.id
+
+    bad = tmp_path / 'bad.ndjson'
+    bad.write_text('{"type": "message"}\n')
+    result = runner.invoke(args=['import-history', str(bad)])
+    assert result.exit_code != 0 and 'not a history export' in result.output
+
+def test_history_import_restores_private_messages(app, runner, init_database, tmp_path):
+    from app.models import PrivateMessage, Conversation
+    from app.conversations import get_unread_total
+    user1, user2, _ = init_database
+    _history(user1, user2)
+    path = tmp_path / 'history.ndjson'
+    runner.invoke(args=['export-history', str(path), '--type', 'private_message'])
+
+    PrivateMessage.query.delete()
+    Conversation.query.delete()
+    db.session.commit()
+    result = runner.invoke(args=['import-history', str(path)])
+    assert 'Private messages imported: 3' in result.output
+    assert [pm.content for pm in PrivateMessage.query.order_by(PrivateMessage.id)] == ['letto', 'non letto', 'risposta']
+    # Conversation summaries rebuilt, with the read state carried over
+    assert Conversation.query.count() == 2
+    assert get_unread_total(user2.id) == 1 and get_unread_total(user1.id) == 1
+
+def test_history_import_dates_undated_records(app, runner, init_database, tmp_path):
+    import json
+    user1, user2, _ = init_database
+    path = tmp_path / 'history.ndjson'
+    path.write_text('\n'.join(json.dumps(record) for record in [
+        {'type': 'header', 'format': 'pictoflask-history', 'version': 1},
+        {'type': 'message', 'username': user1.username, 'content': 'senza data', 'timestamp': None},
+        {'type': 'private_message', 'sender': user1.username, 'recipient': user2.username, 'content': 'ciao'},
+    ]))
+    result = runner.invoke(args=['import-history', str(path)])
+    assert result.exit_code == 0, result.output
+    assert 'Records without a timestamp (dated now): 2' in result.output
+    assert Message.query.filter_by(content='senza data').one().timestamp is not None
+
+def test_history_import_refused_with_write_behind(app, runner, init_database, tmp_path):
+    path = tmp_path / 'history.ndjson'
+    path.write_text('{"type": "header", "format": "pictoflask-history", "version": 1}\n')
+    app.config['MESSAGE_WRITE_BEHIND'] = True
+    result = runner.invoke(args=['import-history', str(path)])
+    assert result.exit_code != 0 and 'MESSAGE_WRITE_BEHIND' in result.output
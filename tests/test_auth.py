@@ -1,3 +1,5 @@
+import threading
+
 from app.models import User
 from app.extensions import db
 
@@ -59,3 +61,69 @@ def test_logout(auth_client):
     assert response.status_code == 200
     assert b'Logout effettuato.' in response.data
     assert b'Login' in response.data
+
+def test_login_elsewhere_kicks_open_sockets(app, socket_client):
+    from flask import g
+    socket_client.get_received()
+    other_device = app.test_client()
+    g.pop('_login_user', None)
+    other_device.post('/login', data={'username': 'testuser1', 'password': 'password123'})
+
+    assert not socket_client.is_connected()
+    # get_received() refuses disconnected clients
+    assert socket_client.queue[0]['name'] == 'kicked'
+
+def test_login_again_in_same_browser_keeps_its_tabs(app, client, socket_client):
+    from flask import g
+    socket_client.get_received()
+    g.pop('_login_user', None)
+    client.post('/login', data={'username': 'testuser1', 'password': 'password123'})
+
+    # Its other tab shares the new session: not kicked, so it never hits /logout
+    assert socket_client.is_connected()
+    assert not [e for e in socket_client.get_received() if e['name'] == 'kicked']
+    g.pop('_login_user', None)
+    assert client.get('/').status_code == 200
+    assert db.session.get(User, socket_client.user.id).session_token is not None
+
+def test_kicked_session_logout_keeps_new_login(app, auth_client):
+    from flask import g
+    old_device, user = auth_client
+    new_device = app.test_client()
+    g.pop('_login_user', None)
+    new_device.post('/login', data={'username': 'testuser1', 'password': 'password123'})
+    token = db.session.get(User, user.id).session_token
+
+    g.pop('_login_user', None)
+    old_device.get('/logout')
+    assert db.session.get(User, user.id).session_token == token
+
+def test_password_hashing_in_process_pool():
+    from app.passwords import PasswordHasher
+    hasher = PasswordHasher()
+    hasher.init_app(type('App', (), {'config': {
+        'PASSWORD_HASH_METHOD': 'pbkdf2:sha256:1000',
+        'PASSWORD_HASH_WORKERS': 1,
+        'PASSWORD_HASH_QUEUE_LIMIT': 0,
+        'SOCKETIO_ASYNC_MODE': 'threading',
+    }}))
+    try:
+        pwhash = hasher.hash('segreta')
+        assert pwhash.startswith('pbkdf2:sha256:1000$')
+        assert hasher.verify(pwhash, 'segreta')
+        assert not hasher.verify(pwhash, 'sbagliata')
+        assert hasher.stats() == {'workers': 1, 'in_flight': 0, 'rejected': 0}
+    finally:
+        hasher.shutdown()
+
+def test_login_refused_fast_when_hasher_busy(client, init_database, monkeypatch):
+    from app.passwords import password_hasher
+    monkeypatch.setattr(password_hasher, 'workers', 1)
+    monkeypatch.setattr(password_hasher, 'queue_limit', 1)
+    monkeypatch.setattr(password_hasher, '_slots', threading.BoundedSemaphore(1))
+    password_hasher._slots.acquire()    # the only slot is taken
+
+    response = client.post('/login', data={'username': 'testuser1', 'password': 'password123'})
+    assert response.status_code == 503
+    assert 'Troppe richieste' in response.get_data(as_text=True)
+    assert password_hasher.stats()['rejected'] == 1
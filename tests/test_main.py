@@ -1,3 +1,5 @@
+import os
+
 from app.models import User, BlockedUser
 from app.extensions import db
 
@@ -68,3 +70,147 @@ def test_unblock_user(auth_client, init_database):
     with client.application.app_context():
         block = BlockedUser.query.filter_by(blocker_id=current_user.id, blocked_id=user2.id).first()
         assert block is None
+
+def test_drawing_served_with_immutable_cache(auth_client):
+    client, _ = auth_client
+    from tests.test_sockets import PNG_DATA_URL
+    from app.drawings import store_drawing
+
+    url = store_drawing(PNG_DATA_URL)
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+
+    cached = client.get(url, headers={'If-None-Match': etag})
+    assert cached.status_code == 304
+
+def test_drawing_unknown_or_invalid_name(auth_client):
+    client, _ = auth_client
+    assert client.get('/drawings/' + 'a' * 64 + '.png').status_code == 404
+    assert client.get('/drawings/../config.py').status_code == 404
+
+def test_migrate_drawings_sweeps_orphans(app, runner, init_database):
+    import base64
+    from tests.test_sockets import PNG_DATA_URL
+    from app.models import Message
+    from app.drawings import store_drawing, drawing_path
+
+    kept = store_drawing(PNG_DATA_URL)
+    db.session.add(Message(user_id=init_database[0].id, username='testuser1',
+                           content='[Disegno]', image_data=kept))
+    db.session.commit()
+    other = 'data:image/png;base64,' + base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'\x01' * 64).decode()
+    orphan = store_drawing(other)
+
+    result = runner.invoke(args=['migrate-drawings', '--orphan-min-age', '0'])
+    assert 'Orphan drawings removed: 1' in result.output
+    assert os.path.exists(drawing_path(kept.rsplit('/', 1)[1]))
+    assert not os.path.exists(drawing_path(orphan.rsplit('/', 1)[1]))
+
+def test_history_keyset_pagination(auth_client, init_database):
+    client, user = auth_client
+    from app.models import Message
+    for i in range(7):
+        db.session.add(Message(user_id=user.id, username=user.username, content=f'msg {i}'))
+    db.session.commit()
+
+    first = client.get('/history?limit=3').get_json()
+    assert [m['msg'] for m in first['messages']] == ['msg 4', 'msg 5', 'msg 6']
+    assert first['has_more'] is True
+
+    second = client.get(f"/history?limit=3&before_id={first['messages'][0]['id']}").get_json()
+    assert [m['msg'] for m in second['messages']] == ['msg 1', 'msg 2', 'msg 3']
+
+    last = client.get(f"/history?limit=3&before_id={second['messages'][0]['id']}").get_json()
+    assert [m['msg'] for m in last['messages']] == ['msg 0']
+    assert last['has_more'] is False
+
+def test_history_pages_through_shared_timestamps(auth_client, init_database):
+    from datetime import datetime
+    from app.models import Message
+    client, user = auth_client
+    same = datetime(2024, 5, 1, 12, 0)
+    for i in range(5):
+        db.session.add(Message(user_id=user.id, username=user.username, content=f'msg {i}', timestamp=same))
+    db.session.commit()
+
+    first = client.get('/history?limit=2').get_json()
+    second = client.get(f"/history?limit=2&before_id={first['messages'][0]['id']}").get_json()
+    last = client.get(f"/history?limit=2&before_id={second['messages'][0]['id']}").get_json()
+    assert [[m['msg'] for m in page['messages']] for page in (last, second, first)] == [
+        ['msg 0'], ['msg 1', 'msg 2'], ['msg 3', 'msg 4']
+    ]
+
+def test_history_hides_blocked_users(auth_client, init_database):
+    client, user = auth_client
+    _, user2, _ = init_database
+    from app.models import Message
+    db.session.add(Message(user_id=user2.id, username=user2.username, content='blocked msg'))
+    db.session.add(Message(user_id=user.id, username=user.username, content='own msg'))
+    db.session.add(BlockedUser(blocker_id=user.id, blocked_id=user2.id))
+    db.session.commit()
+
+    data = client.get('/history').get_json()
+    assert [m['msg'] for m in data['messages']] == ['own msg']
+
+def test_index_serves_history_from_buffer(auth_client):
+    client, user = auth_client
+    from app.history import recent_messages
+    recent_messages.append({
+        'id': 999, 'user_id': user.id, 'username': user.username,
+        'msg': '</script><b>buffered</b>', 'time': '10:00',
+        'profile_pic': 'default.jpg', 'color': '#ff0000', 'image_data': None
+    })
+
+    response = client.get('/')
+    assert b'\\u003c/script>\\u003cb>buffered' in response.data
+    assert b'</script><b>buffered' not in response.data
+
+def test_startup_adds_missing_indexes_to_existing_tables(tmp_path):
+    from sqlalchemy import inspect, text
+    from app import create_app
+    from tests.conftest import TestConfig
+
+    class FileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'chat.db'}"
+
+    app = create_app(FileConfig)
+    with app.app_context():
+        # Simulate a database created before the index existed
+        db.session.execute(text('DROP INDEX ix_message_timestamp_id'))
+        db.session.commit()
+        db.session.remove()
+
+    app = create_app(FileConfig)
+    with app.app_context():
+        names = {ix['name'] for ix in inspect(db.engine).get_indexes('message')}
+        assert 'ix_message_timestamp_id' in names
+        db.session.remove()
+
+def test_green_mode_pool_settings():
+    from app import _green_engine_options
+    fake = lambda uri: type('App', (), {'config': {'SQLALCHEMY_DATABASE_URI': uri, 'DB_POOL_SIZE': 10}})
+    # One SQLite connection: greenlets never wait on each other's write lock
+    assert _green_engine_options(fake('sqlite:///chat.db'))['pool_size'] == 1
+    assert _green_engine_options(fake('sqlite:///:memory:')) == {}
+    options = _green_engine_options(fake('postgresql://db/chat'))
+    assert options['pool_size'] == 10 and options['pool_pre_ping']
+
+def test_sqlite_storage_profile(tmp_path):
+    from app import create_app
+    from tests.conftest import TestConfig
+
+    def pragmas(profile):
+        config = type('FileConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / f'{profile}.db'}",
+            'SQLITE_PROFILE': profile,
+        })
+        app = create_app(config)
+        with app.app_context():
+            return [db.session.execute(db.text(f'PRAGMA {name}')).scalar()
+                    for name in ('journal_mode', 'synchronous', 'busy_timeout', 'temp_store')]
+
+    assert pragmas(True) == ['wal', 1, 5000, 2]
+    assert pragmas(False)[0] == 'delete'
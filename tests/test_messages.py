@@ -66,3 +66,177 @@ def test_sendMessage_to_blocked_user(auth_client, init_database):
     data = response.get_json()
     assert data['success'] is False
     assert 'error' in data
+
+def test_send_message_updates_conversation_summaries(auth_client, init_database):
+    client, current_user = auth_client
+    _, user2, _ = init_database
+    from app.models import Conversation
+
+    client.post(f'/messages/send/{user2.id}', data={'content': 'first'})
+    client.post(f'/messages/send/{user2.id}', data={'content': 'second'})
+
+    mine = Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one()
+    theirs = Conversation.query.filter_by(owner_id=user2.id, peer_id=current_user.id).one()
+    assert mine.last_preview == theirs.last_preview == 'second'
+    assert mine.unread_count == 0
+    assert theirs.unread_count == 2
+
+    response = client.get('/messages/')
+    assert b'second' in response.data
+    assert user2.username.encode() in response.data
+
+def test_rebuild_conversations_matches_live_summaries(auth_client, init_database):
+    client, current_user = auth_client
+    _, user2, _ = init_database
+    from app.models import Conversation
+    from app.conversations import rebuild_conversations
+
+    client.post(f'/messages/send/{user2.id}', data={'content': 'hello'})
+    live = {(c.owner_id, c.peer_id, c.last_preview, c.unread_count) for c in Conversation.query}
+
+    assert rebuild_conversations() == 2
+    rebuilt = {(c.owner_id, c.peer_id, c.last_preview, c.unread_count) for c in Conversation.query}
+    assert rebuilt == live
+
+def test_conversation_since_returns_delta_and_marks_read(auth_client, init_database):
+    client, current_user = auth_client
+    _, user2, _ = init_database
+    from app.models import Conversation
+    from app.conversations import record_private_message
+
+    old = PrivateMessage(sender_id=user2.id, recipient_id=current_user.id, content='old')
+    db.session.add(old)
+    db.session.flush()
+    record_private_message(old)
+    new = PrivateMessage(sender_id=user2.id, recipient_id=current_user.id, content='new')
+    db.session.add(new)
+    db.session.flush()
+    record_private_message(new)
+    db.session.commit()
+
+    response = client.get(f'/messages/conversation/{user2.id}/since?since_id={old.id}')
+    data = response.get_json()
+    assert [m['content'] for m in data['messages']] == ['new']
+
+    db.session.expire_all()
+    conv = Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one()
+    assert conv.unread_count == 0
+
+    empty = client.get(f'/messages/conversation/{user2.id}/since?since_id={new.id}').get_json()
+    assert empty['messages'] == []
+
+def test_conversation_history_pages(auth_client, init_database):
+    client, current_user = auth_client
+    _, user2, user3 = init_database
+    for i in range(5):
+        sender, recipient = (current_user, user2) if i % 2 == 0 else (user2, current_user)
+        db.session.add(PrivateMessage(sender_id=sender.id, recipient_id=recipient.id, content=f'pm {i}'))
+    # Unrelated conversation must not leak into the page
+    db.session.add(PrivateMessage(sender_id=user3.id, recipient_id=current_user.id, content='other'))
+    db.session.commit()
+
+    first = client.get(f'/messages/conversation/{user2.id}/history?limit=3').get_json()
+    assert [m['content'] for m in first['messages']] == ['pm 2', 'pm 3', 'pm 4']
+    assert first['has_more'] is True
+
+    before = first['messages'][0]['id']
+    second = client.get(f'/messages/conversation/{user2.id}/history?limit=3&before_id={before}').get_json()
+    assert [m['content'] for m in second['messages']] == ['pm 0', 'pm 1']
+    assert second['has_more'] is False
+
+def test_reading_moves_high_water_mark_not_rows(auth_client, init_database):
+    client, current_user = auth_client
+    _, user2, _ = init_database
+    from app.models import Conversation
+    from app.conversations import record_private_message, rebuild_conversations, get_peer_read_mark
+
+    pms = []
+    for content in ('one', 'two'):
+        pm = PrivateMessage(sender_id=user2.id, recipient_id=current_user.id, content=content)
+        db.session.add(pm)
+        db.session.flush()
+        record_private_message(pm)
+        pms.append(pm)
+    db.session.commit()
+
+    client.get(f'/messages/conversation/{user2.id}')
+
+    db.session.expire_all()
+    conv = Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one()
+    assert conv.unread_count == 0
+    assert conv.last_read_message_id == pms[-1].id
+    assert get_peer_read_mark(user2.id, current_user.id) == pms[-1].id
+    # Per-row flags are no longer touched
+    assert PrivateMessage.query.filter_by(is_read=True).count() == 0
+
+    # A rebuild keeps the read mark instead of falling back to is_read
+    rebuild_conversations()
+    conv = Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one()
+    assert conv.unread_count == 0
+    assert conv.last_read_message_id == pms[-1].id
+
+def test_startup_adds_pair_index_to_existing_private_message_table(tmp_path):
+    from sqlalchemy import inspect, text
+    from app import create_app
+    from tests.conftest import TestConfig
+
+    class FileConfig(TestConfig):
+        SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp_path / 'chat.db'}"
+
+    app = create_app(FileConfig)
+    with app.app_context():
+        db.session.execute(text('DROP INDEX ix_private_message_pair_timestamp'))
+        db.session.commit()
+        db.session.remove()
+
+    app = create_app(FileConfig)
+    with app.app_context():
+        names = {ix['name'] for ix in inspect(db.engine).get_indexes('private_message')}
+        assert 'ix_private_message_pair_timestamp' in names
+        db.session.remove()
+
+def test_send_message_succeeds_when_push_fails(auth_client, init_database, monkeypatch):
+    client, _ = auth_client
+    _, user2, _ = init_database
+    from app.routes import messages as messages_routes
+
+    def broken_push(*args, **kwargs):
+        raise RuntimeError('socket server down')
+    monkeypatch.setattr(messages_routes, 'notify_private_message', broken_push)
+
+    response = client.post(f'/messages/send/{user2.id}', data={'content': 'saved anyway'})
+    assert response.status_code == 200
+    assert response.get_json()['success'] is True
+    assert PrivateMessage.query.filter_by(content='saved anyway').count() == 1
+
+def test_conversation_since_is_capped_and_marks_only_returned(auth_client, init_database, monkeypatch):
+    client, current_user = auth_client
+    _, user2, _ = init_database
+    from app.models import Conversation
+    from app.conversations import record_private_message
+    from app.routes import messages as messages_routes
+    monkeypatch.setattr(messages_routes, 'DELTA_MAX_MESSAGES', 2)
+
+    pms = []
+    for i in range(3):
+        pm = PrivateMessage(sender_id=user2.id, recipient_id=current_user.id, content=f'n{i}')
+        db.session.add(pm)
+        db.session.flush()
+        record_private_message(pm)
+        pms.append(pm)
+    db.session.commit()
+
+    first = client.get(f'/messages/conversation/{user2.id}/since?since_id=0').get_json()
+    assert [m['content'] for m in first['messages']] == ['n0', 'n1']
+    assert first['has_more'] is True
+
+    db.session.expire_all()
+    conv = Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one()
+    assert conv.last_read_message_id == pms[1].id
+    assert conv.unread_count == 1
+
+    rest = client.get(f'/messages/conversation/{user2.id}/since?since_id={pms[1].id}').get_json()
+    assert [m['content'] for m in rest['messages']] == ['n2']
+    assert rest['has_more'] is False
+    db.session.expire_all()
+    assert Conversation.query.filter_by(owner_id=current_user.id, peer_id=user2.id).one().unread_count == 0
@@ -0,0 +1,446 @@
+import base64
+import os
+
+import pytest
+from flask import g
+
+from app.models import Message, User
+from app.extensions import db
+from app.write_behind import message_writer
+
+PNG_DATA_URL = 'data:image/png;base64,' + base64.b64encode(b'\x89PNG\r\n\x1a\n' + b'\x00' * 64).decode()
+
+def _emit_as(sio_client, event, data):
+    # Tests share one app context, so drop the user Flask-Login cached in g
+    g.pop('_login_user', None)
+    sio_client.emit(event, data)
+
+def _events(sio_client, name):
+    received = [e['args'] for e in sio_client.get_received() if e['name'] == name]
+    return [args[0] if isinstance(args, list) else args for args in received]
+
+def test_draw_message_stored_as_blob(app, socket_client):
+    socket_client.emit('draw_message', {'image_data': PNG_DATA_URL})
+
+    broadcast = _events(socket_client, 'message')
+    assert len(broadcast) == 1
+    url = broadcast[0]['image_data']
+    assert url.startswith('/drawings/') and url.endswith('.png')
+
+    msg = Message.query.one()
+    assert msg.image_data == url
+
+    filename = url.rsplit('/', 1)[1]
+    path = os.path.join(app.config['DRAWINGS_FOLDER'], filename[:2], filename[2:4], filename)
+    assert os.path.exists(path)
+
+def test_draw_message_invalid_payload(socket_client):
+    socket_client.emit('draw_message', {'image_data': 'data:image/png;base64,bm90IGEgcG5n'})
+    socket_client.emit('draw_message', {'image_data': None})
+
+    statuses = _events(socket_client, 'status')
+    assert [s['msg'] for s in statuses].count('Immagine non valida') == 2
+    assert Message.query.count() == 0
+
+def test_identical_drawings_are_deduplicated(app, socket_client):
+    from app import utils
+    socket_client.emit('draw_message', {'image_data': PNG_DATA_URL})
+    utils.rate_limiter.reset()
+    socket_client.emit('draw_message', {'image_data': PNG_DATA_URL})
+
+    urls = {m.image_data for m in Message.query.all()}
+    assert Message.query.count() == 2
+    assert len(urls) == 1
+
+    files = [f for _, _, names in os.walk(app.config['DRAWINGS_FOLDER']) for f in names]
+    assert len(files) == 1
+
+def test_sent_messages_feed_recent_buffer(auth_client, socket_client):
+    client, _ = auth_client
+    socket_client.emit('message', {'msg': 'buffered hello'})
+    sent = _events(socket_client, 'message')[0]
+
+    from app.history import recent_messages
+    history_json, _ = recent_messages.page_json()
+    assert 'buffered hello' in history_json
+
+    socket_client.emit('delete_message', {'message_id': sent['id']})
+    history_json, _ = recent_messages.page_json()
+    assert 'buffered hello' not in history_json
+
+
+@pytest.fixture
+def write_behind(app):
+    app.config['MESSAGE_WRITE_BEHIND'] = True
+    app.config['WRITE_BEHIND_FLUSH_INTERVAL'] = 60   # tests flush explicitly
+    message_writer.init_app(app)
+    yield message_writer
+    message_writer.stop()
+    message_writer.enabled = False
+
+def test_write_behind_broadcasts_before_commit(socket_client, write_behind):
+    socket_client.emit('message', {'msg': 'queued'})
+
+    sent = _events(socket_client, 'message')[0]
+    assert sent['id'] == 1
+    assert Message.query.count() == 0
+    assert write_behind.stats()['queue_depth'] == 1
+
+    assert write_behind.flush() == 1
+    db.session.expire_all()
+    assert db.session.get(Message, sent['id']).content == 'queued'
+    assert db.session.get(User, socket_client.user.id).message_count == 1
+
+    stats = write_behind.stats()
+    assert stats['queue_depth'] == 0
+    assert stats['flushes'] == 1 and stats['rows_written'] == 1
+
+def test_write_behind_delete_pending_message(socket_client, write_behind):
+    socket_client.emit('message', {'msg': 'oops'})
+    sent = _events(socket_client, 'message')[0]
+
+    socket_client.emit('delete_message', {'message_id': sent['id']})
+    assert _events(socket_client, 'message_deleted') == [{'message_id': sent['id']}]
+
+    assert write_behind.flush() == 0
+    assert Message.query.count() == 0
+
+def test_write_behind_withdraw_after_failed_flush(socket_client, write_behind, monkeypatch):
+    from app import write_behind as wb
+    socket_client.emit('message', {'msg': 'retry me'})
+    sent = _events(socket_client, 'message')[0]
+
+    # First lookup misses, as if the message were in a batch being written
+    real_cancel = write_behind.cancel
+    lookups = []
+    def racing_cancel(message_id):
+        lookups.append(message_id)
+        return False if len(lookups) == 1 else real_cancel(message_id)
+    monkeypatch.setattr(write_behind, 'cancel', racing_cancel)
+
+    real_insert = wb.insert
+    def failing_insert(*args):
+        raise RuntimeError('database is locked')
+    monkeypatch.setattr(wb, 'insert', failing_insert)
+
+    # The flush fails and requeues the batch: the message is found again
+    assert write_behind.withdraw(sent['id']) is True
+
+    monkeypatch.setattr(wb, 'insert', real_insert)
+    assert write_behind.flush() == 0
+    assert Message.query.count() == 0
+
+def test_write_behind_dropped_batch_is_retracted(socket_client, write_behind, monkeypatch):
+    from app import write_behind as wb
+    from app.history import recent_messages
+
+    socket_client.emit('message', {'msg': 'lost'})
+    sent = _events(socket_client, 'message')[0]
+
+    def failing_insert(*args):
+        raise RuntimeError('disk full')
+    monkeypatch.setattr(wb, 'insert', failing_insert)
+    for _ in range(wb._MAX_RETRIES):
+        write_behind.flush()
+
+    assert write_behind.stats()['dropped'] == 1
+    assert 'lost' not in recent_messages.page_json()[0]
+    assert _events(socket_client, 'message_deleted') == [{'message_id': sent['id']}]
+
+def test_blocked_author_is_not_delivered(socket_client, second_socket_client):
+    from app.models import BlockedUser
+    db.session.add(BlockedUser(blocker_id=second_socket_client.user.id, blocked_id=socket_client.user.id))
+    db.session.commit()
+    second_socket_client.get_received()
+
+    _emit_as(socket_client, 'message', {'msg': 'you blocked me'})
+    assert _events(socket_client, 'message')[0]['msg'] == 'you blocked me'
+    assert _events(second_socket_client, 'message') == []
+
+    _emit_as(second_socket_client, 'message', {'msg': 'still visible'})
+    assert _events(socket_client, 'message')[0]['msg'] == 'still visible'
+
+def test_blocker_with_two_tabs_gets_nothing(app, socket_client, second_socket_client):
+    from app.extensions import socketio
+    from app.models import BlockedUser
+    from tests.conftest import TestConfig
+    blocker = second_socket_client.user
+    g.pop('_login_user', None)
+    # Same browser session: a second login would kick the first tab
+    second_tab = socketio.test_client(app, flask_test_client=second_socket_client.flask_test_client,
+                                      headers={'Host': TestConfig.SERVER_NAME})
+    assert second_tab.is_connected()
+
+    db.session.add(BlockedUser(blocker_id=blocker.id, blocked_id=socket_client.user.id))
+    db.session.commit()
+    second_socket_client.get_received()
+    second_tab.get_received()
+
+    _emit_as(socket_client, 'message', {'msg': 'blocked everywhere'})
+    assert _events(second_socket_client, 'message') == []
+    assert _events(second_tab, 'message') == []
+    second_tab.disconnect()
+
+def test_block_index_follows_commits(app, init_database):
+    from app.blocks import block_index
+    from app.models import BlockedUser
+    user1, user2, _ = init_database
+
+    block = BlockedUser(blocker_id=user1.id, blocked_id=user2.id)
+    db.session.add(block)
+    db.session.rollback()
+    assert block_index.blockers_of(user2.id) == frozenset()
+
+    db.session.add(BlockedUser(blocker_id=user1.id, blocked_id=user2.id))
+    db.session.commit()
+    assert block_index.blockers_of(user2.id) == {user1.id}
+    assert block_index.blocked_ids(user1.id) == {user2.id}
+
+    db.session.delete(BlockedUser.query.one())
+    db.session.commit()
+    assert not block_index.is_blocked(user2.id, by_user_id=user1.id)
+
+def test_unread_count_snapshot_and_push(auth_client, socket_client, second_socket_client):
+    client, _ = auth_client
+    recipient = second_socket_client.user
+    assert _events(second_socket_client, 'unread_count') == [{'count': 0}]
+    socket_client.get_received()
+
+    g.pop('_login_user', None)
+    client.post(f'/messages/send/{recipient.id}', data={'content': 'ping'})
+    received = {e['name']: e['args'] for e in second_socket_client.get_received()}
+    assert received['unread_count'] == [{'count': 1}]
+    assert received['pm_notification'] == [{'sender': socket_client.user.username}]
+    assert received['pm_received'][0]['content'] == 'ping'
+    assert _events(socket_client, 'unread_count') == []
+
+def test_notification_only_connection_skips_main_chat(app, auth_client):
+    from app.extensions import socketio
+    from app import sockets
+    client, user = auth_client
+    sio_client = socketio.test_client(
+        app, flask_test_client=client, auth={'chat': False},
+        headers={'Host': app.config['SERVER_NAME']}
+    )
+    assert sio_client.is_connected()
+    names = [e['name'] for e in sio_client.get_received()]
+    assert names == ['unread_count']
+    assert sockets.presence.sids_of({user.id}) == []
+    sio_client.disconnect()
+
+def test_sqlite_bus_delivers_between_workers(tmp_path):
+    from app import bus
+    path = str(tmp_path / 'bus.db')
+    worker_a = bus.SQLiteManager(path)
+    worker_b = bus.SQLiteManager(path)
+    listener = worker_b._listen()
+
+    received = []
+    bus.subscribe('test_sync', received.append)
+    try:
+        worker_a._publish({'method': 'emit', 'event': 'message', 'data': [{'id': 1}],
+                           'namespace': '/', 'room': 'main_chat', 'host_id': worker_a.host_id})
+        worker_a._publish({'method': 'sync', 'name': 'test_sync', 'data': 42, 'host_id': worker_a.host_id})
+        # Own messages are handled locally and only yielded, never re-dispatched
+        worker_b._publish({'method': 'sync', 'name': 'test_sync', 'data': 7, 'host_id': worker_b.host_id})
+
+        emitted = next(listener)
+        assert emitted['event'] == 'message' and emitted['data'] == [{'id': 1}]
+        own = next(listener)
+        assert own['host_id'] == worker_b.host_id
+        assert received == [42]
+    finally:
+        bus._handlers.pop('test_sync')
+
+def test_shared_presence_spans_workers_and_purges_dead_ones(tmp_path):
+    from app.presence import SQLitePresence
+    path = str(tmp_path / 'bus.db')
+    worker_a = SQLitePresence(path, 'host-a', host_timeout=15)
+    worker_b = SQLitePresence(path, 'host-b', host_timeout=15)
+
+    user = {'user_id': 1, 'username': 'alice', 'profile_pic': 'default.png', 'color': '#61829a'}
+    worker_a.add('sid-a', user)
+    worker_b.add('sid-b', dict(user, user_id=2, username='bob'))
+
+    assert worker_a.add('sid-a2', user) is False     # second tab
+    assert [u['username'] for u in worker_a.online_users()] == ['alice', 'bob']
+    assert sorted(worker_b.sids_of([1])) == ['sid-a', 'sid-a2']
+
+    # Worker A stops beating: B drops its sessions
+    worker_a._connection().execute("UPDATE presence_host SET heartbeat = 0 WHERE host_id = 'host-a'")
+    assert worker_b.heartbeat() == 2
+    assert [u['username'] for u in worker_b.online_users()] == ['bob']
+    user, last = worker_b.remove('sid-b')
+    assert user['username'] == 'bob' and last is True
+
+def test_presence_snapshot_to_joiner_and_delta_to_room(socket_client, second_socket_client):
+    # socket_client connected first: it sees user2 only as a delta
+    received = socket_client.get_received()
+    joined = [e['args'][0] for e in received if e['name'] == 'user_joined']
+    assert second_socket_client.user.username in [u['username'] for batch in joined for u in batch['users']]
+    assert len([e for e in received if e['name'] == 'online_users']) == 1   # its own connect snapshot
+    # The join notice rides on the batched delta, not a status event per connection
+    assert not [e for e in received if e['name'] == 'status']
+
+    snapshot = _events(second_socket_client, 'online_users')
+    assert len(snapshot) == 1
+    assert {u['username'] for u in snapshot[0]['users']} == {
+        socket_client.user.username, second_socket_client.user.username
+    }
+
+    g.pop('_login_user', None)
+    second_socket_client.disconnect()
+    received = socket_client.get_received()
+    assert [e['args'][0] for e in received if e['name'] == 'user_left'] == [
+        {'usernames': [second_socket_client.user.username]}
+    ]
+    assert not [e for e in received if e['name'] == 'status']
+
+def test_presence_deltas_coalesce_bursts():
+    from app.presence import PresenceDeltas
+    sent = []
+    deltas = PresenceDeltas(lambda event, data: sent.append((event, data)), window=60)
+    user = lambda name: {'username': name, 'profile_pic': 'default.jpg', 'color': '#000000'}
+
+    deltas.joined(user('a'))
+    deltas.joined(user('b'))
+    deltas.left(user('b'))       # joined and left in the same window: nothing
+    deltas.left(user('c'))
+    deltas.joined(user('c'))     # reconnect of an online user: nothing
+    deltas.left(user('d'))
+    deltas.flush()
+
+    assert sent == [('user_joined', {'users': [user('a')]}), ('user_left', {'usernames': ['d']})]
+    assert deltas.stats()['batches'] == 1
+
+def test_local_presence_counts_tabs_per_user():
+    from app.presence import LocalPresence
+    registry = LocalPresence()
+    user = lambda uid, name: {'user_id': uid, 'username': name, 'profile_pic': 'default.jpg', 'color': '#000000'}
+
+    assert registry.add('a1', user(1, 'alice')) is True
+    assert registry.add('a2', user(1, 'alice')) is False
+    assert registry.add('b1', user(2, 'bob')) is True
+    assert registry.add('c1', user(3, 'carol')) is True
+    assert [u['username'] for u in registry.online_users()] == ['alice', 'bob', 'carol']
+    assert sorted(registry.sids_of([1])) == ['a1', 'a2']
+
+    assert registry.remove('a1')[1] is False
+    assert registry.remove('a2')[1] is True
+    # carol's slot moved into alice's place
+    assert [u['username'] for u in registry.online_users()] == ['carol', 'bob']
+    assert registry.remove('b1')[1] is True
+    assert registry.remove('missing') == (None, False)
+    assert registry.sids_of([1, 2]) == []
+
+def test_typing_reports_are_aggregated(socket_client, second_socket_client):
+    from app.sockets import typing_users
+    second_socket_client.get_received()
+    name = socket_client.user.username
+
+    for _ in range(3):
+        _emit_as(socket_client, 'typing', {'typing': True})
+    snapshots = _events(second_socket_client, 'typing_users')
+    assert [s['users'] for s in snapshots] == [[name]]
+
+    _emit_as(socket_client, 'message', {'msg': 'done typing'})
+    assert [s['users'] for s in _events(second_socket_client, 'typing_users')] == [[]]
+    # 3 reports in, 2 snapshots out
+    assert typing_users.stats()['events_saved'] == 1
+
+def test_typing_aggregator_expires_stale_typers(monkeypatch):
+    from app import typing_indicator
+    sent = []
+    aggregator = typing_indicator.TypingAggregator(lambda event, data: sent.append(data), interval=60, ttl=5)
+    clock = [100.0]
+    monkeypatch.setattr(typing_indicator.time, 'monotonic', lambda: clock[0])
+    monkeypatch.setattr(aggregator, '_schedule', lambda: None)
+
+    aggregator.update('alice', True)
+    aggregator.flush()
+    clock[0] += 6
+    aggregator.flush()
+    aggregator.flush()    # unchanged: nothing sent
+    assert [d['users'] for d in sent] == [['alice'], []]
+
+def test_rate_limit_burst_then_refill(socket_client, monkeypatch):
+    from app import rate_limit
+    clock = [1000.0]
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: clock[0])
+
+    for i in range(5):
+        socket_client.emit('message', {'msg': f'm{i}'})
+    assert Message.query.count() == 4
+    assert any('Aspetta' in s['msg'] for s in _events(socket_client, 'status'))
+
+    clock[0] += 1       # one token back (1.25 per second)
+    socket_client.emit('message', {'msg': 'again'})
+    assert Message.query.count() == 5
+
+def test_rate_limit_costs_and_idle_sweep(monkeypatch):
+    from app import rate_limit
+    clock = [1000.0]
+    monkeypatch.setattr(rate_limit.time, 'time', lambda: clock[0])
+    monkeypatch.setattr(rate_limit.time, 'monotonic', lambda: clock[0])
+    limiter = rate_limit.RateLimiter()
+
+    # A 450 KB drawing empties the bucket, typing barely touches it
+    assert limiter.allow(1, 'draw_message', 450_000)
+    assert not limiter.allow(1, 'message')
+    assert 39 <= sum(limiter.allow(2, 'typing') for _ in range(50)) <= 40
+
+    limiter._next_sweep = clock[0] + 5
+    clock[0] += 3.3     # users 1 and 2 refilled, but not swept yet
+    assert limiter.allow(3, 'message')
+    assert limiter.stats()['buckets'] == 3
+    clock[0] += 2       # sweep: every bucket is full again
+    limiter.allow(3, 'message')
+    assert limiter.stats()['buckets'] == 1
+    assert limiter.stats()['swept'] == 3
+
+def test_shared_rate_limit_spans_workers(tmp_path):
+    from app.rate_limit import SQLiteBuckets
+    path = str(tmp_path / 'bus.db')
+    worker_a, worker_b = SQLiteBuckets(path), SQLiteBuckets(path)
+
+    assert worker_a.take(1, 3, rate=1.25, burst=4, now=10.0)
+    assert not worker_b.take(1, 3, rate=1.25, burst=4, now=10.0)
+    assert worker_b.take(1, 1, rate=1.25, burst=4, now=10.0)
+    assert worker_a.sweep(rate=1.25, burst=4, now=12.0) == 0
+    assert worker_b.sweep(rate=1.25, burst=4, now=14.0) == 1
+    assert len(worker_a) == 0
+
+def test_socket_events_use_cached_identity(app, socket_client, monkeypatch):
+    from app.identity import identity_cache, UserIdentity
+    from app.models import User as UserModel
+    user = socket_client.user
+    assert identity_cache.get(user.id).session_token == user.session_token
+
+    loads = []
+    real_get = db.session.get
+    monkeypatch.setattr(db.session, 'get', lambda model, *a, **kw: loads.append(model) or real_get(model, *a, **kw))
+    _emit_as(socket_client, 'message', {'msg': 'from cache'})
+    _emit_as(socket_client, 'typing', {'typing': True})
+    assert UserModel not in loads
+    assert db.session.get(UserModel, user.id).message_count == 1
+
+    # A committed change drops the snapshot
+    db_user = db.session.get(UserModel, user.id)
+    db_user.chat_color = '#fb0018'
+    db.session.commit()
+    assert identity_cache.get(user.id).chat_color == '#fb0018'
+    assert isinstance(identity_cache.get(user.id), UserIdentity)
+
+    db.session.delete(db_user)
+    db.session.commit()
+    assert identity_cache.get(user.id) is None
+
+def test_identity_cache_is_bounded(app, init_database):
+    from app.identity import IdentityCache
+    cache = IdentityCache(max_size=2, ttl=60)
+    user1, user2, user3 = init_database
+    for user in (user1, user2, user1, user3):
+        cache.get(user.id)
+    # user2 was the least recently used
+    assert list(cache._entries) == [user1.id, user3.id]
+    assert cache.stats() == {'size': 2, 'hits': 1, 'misses': 3}